@@ -98,11 +98,13 @@ class QTextEditLogger(logging.Handler, QtCore.QObject):
     def emit(self, record): self.log_received.emit(self.format(record))
 class AIWorker(QtCore.QObject):
     finished = QtCore.pyqtSignal(str); error = QtCore.pyqtSignal(str); action_update = QtCore.pyqtSignal(str)
-    def __init__(self, ai_iface, history):
-        super().__init__(); self.ai = ai_iface; self.history = history; self.ai.action_started.connect(self.action_update)
+    token_update = QtCore.pyqtSignal(str); stream_reset = QtCore.pyqtSignal() # Потоковый вывод ответа
+    def __init__(self, ai_iface, history, memory_namespace=None):
+        super().__init__(); self.ai = ai_iface; self.history = history; self.memory_namespace = memory_namespace; self.ai.action_started.connect(self.action_update)
+        self.ai.token_received.connect(self.token_update); self.ai.stream_reset.connect(self.stream_reset)
     @QtCore.pyqtSlot()
     def run(self):
-        try: self.finished.emit(self.ai.call_ai(self.history))
+        try: self.finished.emit(self.ai.call_ai(self.history, memory_namespace=self.memory_namespace))
         except Exception as e: logging.error(f"Критическая ошибка: {e}", exc_info=True); self.error.emit(str(e))
 class SettingsDialog(QtWidgets.QDialog):
     def __init__(self, settings_manager, parent=None):
@@ -118,12 +120,15 @@ class SettingsDialog(QtWidgets.QDialog):
         self.settings_manager.save_settings(); super().accept()
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, ai_iface, models):
+    def __init__(self, ai_iface, models, ai_bridge=None):
         super().__init__()
         self.settings_manager = SettingsManager(); self.setWindowTitle("AI + MCP Управление ПК"); self.resize(900, 700)
         self.ai = ai_iface; self.chat_manager = ChatManager(); self.current_chat_id = None
+        self.pending_chat_id = None # ID нового чата, зарезервированный до первого сохранения (см. _memory_namespace)
+        self.ai_bridge = ai_bridge # Асинхронный режим: сессии агента выполняются в цикле asyncio, а не в QThread
         self.current_messages = []; self.loading_timer = QtCore.QTimer(self); self.loading_timer.timeout.connect(self._update_loading_animation)
         self.loading_dot_count = 0; self.attached_image_path = None
+        self.stream_item = None; self.stream_widget = None; self.stream_text = "" # Пузырь ответа, который пишется потоком
         self.setup_ui(models)
         self.log_handler = QTextEditLogger(self.log_view); self.log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
         logging.getLogger().addHandler(self.log_handler); logging.getLogger().setLevel(logging.INFO); logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -184,6 +189,30 @@ class MainWindow(QtWidgets.QMainWindow):
             self.anim.setStartValue(0.0); self.anim.setEndValue(1.0); self.anim.setEasingCurve(QtCore.QEasingCurve.InQuad); self.anim.start(QtCore.QAbstractAnimation.DeleteWhenStopped)
         QtCore.QTimer.singleShot(50, self.chat_history_list.scrollToBottom)
 
+    def _on_stream_token(self, token):
+        self.stream_text += token
+        if self.stream_widget is None:
+            self._stop_loading_animation(); self._add_message_static(self.stream_text, 'assistant')
+            self.stream_item = self.chat_history_list.item(self.chat_history_list.count() - 1); self.stream_widget = self.chat_history_list.itemWidget(self.stream_item)
+        else:
+            self.stream_widget.text_label.setText(self.stream_text); self.stream_item.setSizeHint(self.stream_widget.sizeHint())
+        self.chat_history_list.scrollToBottom()
+
+    def _clear_stream_bubble(self):
+        if self.stream_item is not None: self.chat_history_list.takeItem(self.chat_history_list.row(self.stream_item))
+        self.stream_item = None; self.stream_widget = None; self.stream_text = ""
+
+    def _on_stream_reset(self):
+        # Показанный текст был лишь преамбулой к вызову инструментов - агент продолжает работу
+        self._clear_stream_bubble(); self._start_loading_animation()
+
+    def _finish_stream_bubble(self, reply):
+        """Превращает потоковый пузырь в финальный ответ. Возвращает False, если потока не было."""
+        if self.stream_widget is None: return False
+        if reply != self.stream_text: self.stream_widget.text_label.setText(reply); self.stream_item.setSizeHint(self.stream_widget.sizeHint())
+        self.stream_item = None; self.stream_widget = None; self.stream_text = ""
+        QtCore.QTimer.singleShot(50, self.chat_history_list.scrollToBottom); return True
+
     def apply_theme_and_settings(self):
         theme_name = self.settings_manager.get("color_theme"); chat_font_size = self.settings_manager.get("font_size_chat"); logs_font_size = self.settings_manager.get("font_size_logs")
         base_stylesheet = get_stylesheet(theme_name)
@@ -224,7 +253,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         if not current_item: return
         chat_id = current_item.data(QtCore.Qt.UserRole)
-        self.current_chat_id = chat_id
+        self.current_chat_id = chat_id; self.pending_chat_id = None
         messages, title = self.chat_manager.load_chat_history(chat_id)
         self.current_messages = messages
         self.chat_history_list.clear()
@@ -304,7 +333,7 @@ class MainWindow(QtWidgets.QMainWindow):
     # --- ВОССТАНОВЛЕННЫЕ МЕТОДЫ УПРАВЛЕНИЯ ЧАТАМИ ---
     def on_new_chat(self):
         self.chat_list_widget.setCurrentItem(None)
-        self.current_chat_id = None
+        self.current_chat_id = None; self.pending_chat_id = None
         self.current_messages = []
         self.chat_history_list.clear()
         self.prompt_input.setPlaceholderText("Введите первое сообщение...")
@@ -344,16 +373,34 @@ class MainWindow(QtWidgets.QMainWindow):
                 content_list.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_data_b64}"}})
             except Exception as e: logging.error(f"Ошибка кодирования: {e}"); self.add_message_to_chat(f"Ошибка: {e}", "error"); self.set_input_state(enabled=True); return
         self.current_messages.append({"role": "user", "content": content_list}); self.add_message_to_chat(prompt, 'user', image_path=self.attached_image_path); self.prompt_input.clear(); self._remove_attachment()
-        self.worker = AIWorker(self.ai, self.current_messages.copy()); self.thread = QtCore.QThread()
-        self.worker.moveToThread(self.thread); self.thread.started.connect(self.worker.run); self.worker.finished.connect(self.handle_ai_reply); self.worker.error.connect(self.handle_ai_error); self.worker.action_update.connect(self.statusBar().showMessage)
+        memory_namespace = self._memory_namespace()
+        if self.ai_bridge is not None:
+            self.worker = self.ai_bridge.submit(self.ai, self.current_messages.copy(), memory_namespace=memory_namespace); self._connect_worker(self.worker)
+            self.worker.finished.connect(self.worker.deleteLater); self.worker.error.connect(self.worker.deleteLater); return
+        self.worker = AIWorker(self.ai, self.current_messages.copy(), memory_namespace); self.thread = QtCore.QThread()
+        self.worker.moveToThread(self.thread); self.thread.started.connect(self.worker.run); self._connect_worker(self.worker)
         self.worker.finished.connect(self.thread.quit); self.worker.finished.connect(self.worker.deleteLater); self.thread.finished.connect(self.thread.deleteLater); self.thread.start()
 
+    def _memory_namespace(self):
+        """
+        MEMORY_NAMESPACE=chat: у каждого чата своя семантическая память (пространство имен chat_<id чата>).
+        Пространство передается в сам запрос: запрос, еще идущий для прежнего чата, пишет в память своего чата.
+        """
+        if os.getenv("MEMORY_NAMESPACE") != "chat": return None
+        # Новый чат сохраняется только после ответа - его ID резервируется заранее, чтобы память чата не сменилась
+        if not self.current_chat_id and not self.pending_chat_id: self.pending_chat_id = self.chat_manager.new_chat_id()
+        return f"chat_{self.current_chat_id or self.pending_chat_id}"
+
+    def _connect_worker(self, worker):
+        worker.finished.connect(self.handle_ai_reply); worker.error.connect(self.handle_ai_error); worker.action_update.connect(self.statusBar().showMessage)
+        worker.token_update.connect(self._on_stream_token); worker.stream_reset.connect(self._on_stream_reset)
+
     def handle_ai_reply(self, reply):
         self.set_input_state(enabled=True)
         try:
             gui_command = json.loads(reply)
             if isinstance(gui_command, dict) and "gui_tool" in gui_command:
-                tool_name = gui_command["gui_tool"]; params = gui_command.get("params", {})
+                self._clear_stream_bubble(); tool_name = gui_command["gui_tool"]; params = gui_command.get("params", {})
                 if tool_name == "display_image": 
                     self.add_message_to_chat(params.get("caption", ""), "assistant", image_url=params.get("url"))
                     self.current_messages.append({"role": "assistant", "content": reply})
@@ -361,17 +408,18 @@ class MainWindow(QtWidgets.QMainWindow):
                     self.add_message_to_chat(params.get("text", ""), "assistant")
                     self.current_messages.append({"role": "assistant", "content": reply})
                 else: self.add_message_to_chat(f"Неизвестная GUI команда: {tool_name}", "error")
-                self.chat_manager.save_chat(self.current_chat_id, self.current_messages); return
+                self.chat_manager.save_chat(self.current_chat_id or self.pending_chat_id, self.current_messages); return
         except (json.JSONDecodeError, TypeError): pass
-        self.add_message_to_chat(reply, 'assistant'); self.current_messages.append({"role": "assistant", "content": reply}); logging.info("Ответ ИИ получен.")
-        new_id, new_title = self.chat_manager.save_chat(self.current_chat_id, self.current_messages)
+        if not self._finish_stream_bubble(reply): self.add_message_to_chat(reply, 'assistant')
+        self.current_messages.append({"role": "assistant", "content": reply}); logging.info("Ответ ИИ получен.")
+        new_id, new_title = self.chat_manager.save_chat(self.current_chat_id or self.pending_chat_id, self.current_messages)
         if not self.current_chat_id:
             self.current_chat_id = new_id; self.populate_chat_list()
             for i in range(self.chat_list_widget.count()):
                 item = self.chat_list_widget.item(i)
                 if item.data(QtCore.Qt.UserRole) == self.current_chat_id: item.setText(new_title); self.chat_list_widget.setCurrentItem(item); break
 
-    def handle_ai_error(self, err_msg): self.set_input_state(enabled=True); self.add_message_to_chat(f"Ошибка: {err_msg}", "error"); logging.error(f"Ошибка при вызове ИИ: {err_msg}")
+    def handle_ai_error(self, err_msg): self._clear_stream_bubble(); self.set_input_state(enabled=True); self.add_message_to_chat(f"Ошибка: {err_msg}", "error"); logging.error(f"Ошибка при вызове ИИ: {err_msg}")
 
     def populate_chat_list(self):
         self.chat_list_widget.clear(); chats = self.chat_manager.get_chats()
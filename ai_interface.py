@@ -3,78 +3,615 @@
 import os
 import json
 import requests
-import copy
+import time
 import logging
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from openai import OpenAI
 from PyQt5 import QtCore
 
+from mcp_registry import MCP_REGISTRY
+from mcp_transport import get_transport
+from context_budget import ContextBudgeter, estimate_tokens
+from mcp_schema_registry import get_schema_registry
+from sub_agents import SubAgentPool, delegate_tasks_schema
+from mcp_tool_cache import get_tool_cache, CachePolicy, llm_function
 
-def _sanitize_log_data(data):
-    """Рекурсивно очищает данные для логирования, заменяя base64 на заменитель."""
-    if not isinstance(data, (dict, list)):
-        return data
 
-    # Создаем глубокую копию, чтобы не изменять оригинальные данные
-    log_data = copy.deepcopy(data)
+# Строки длиннее этого (символов) обрезаются в логах вызовов MCP
+LOG_MAX_STRING = int(os.getenv("AGENT_LOG_MAX_STRING", "500"))
 
-    if isinstance(log_data, list):
-        return [_sanitize_log_data(item) for item in log_data]
 
-    # Обрабатываем словари
-    for key, value in log_data.items():
-        if isinstance(value, str) and value.startswith('data:image'):
-            log_data[key] = f"<base64_image_data len={len(value)}>"
-        elif isinstance(value, (dict, list)):
-            log_data[key] = _sanitize_log_data(value)
-            
-    return log_data
+def _format_log_value(value, parts: list):
+    """
+    Дописывает в parts JSON-подобное представление value, обходя исходную структуру без копирования:
+    base64-картинки заменяются заменителем, длинные строки обрезаются.
+    """
+    if isinstance(value, str):
+        if value.startswith('data:image'):
+            value = f"<base64_image_data len={len(value)}>"
+        elif len(value) > LOG_MAX_STRING:
+            value = f"{value[:LOG_MAX_STRING]}...<обрезано, всего {len(value)} символов>"
+        parts.append(json.dumps(value, ensure_ascii=False))
+    elif isinstance(value, dict):
+        parts.append("{")
+        for number, (key, item) in enumerate(value.items()):
+            if number:
+                parts.append(", ")
+            parts.append(json.dumps(str(key), ensure_ascii=False))
+            parts.append(": ")
+            _format_log_value(item, parts)
+        parts.append("}")
+    elif isinstance(value, (list, tuple)):
+        parts.append("[")
+        for number, item in enumerate(value):
+            if number:
+                parts.append(", ")
+            _format_log_value(item, parts)
+        parts.append("]")
+    else:
+        try:
+            parts.append(json.dumps(value))
+        except (TypeError, ValueError):
+            parts.append(json.dumps(repr(value), ensure_ascii=False))
+
 
-class MCPServer:
+class LogPayload:
     """
-    Представляет собой клиент для одного MCP-сервера.
+    Ленивое представление params/result для логов. Передается аргументом logging,
+    поэтому форматируется только если сообщение действительно будет записано.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        parts = []
+        _format_log_value(self.data, parts)
+        return "".join(parts)
+
+
+# Описание локального инструмента show_image_in_chat (общее для синхронного и асинхронного агента)
+SHOW_IMAGE_IN_CHAT_SCHEMA = {
+    "name": "show_image_in_chat",
+    "description": "Показывает пользователю изображение прямо в окне чата. Используй эту функцию, когда пользователь просит что-то показать, или когда визуальное представление информации будет полезно. Всегда предоставляй прямой URL изображения.",
+    "parameters": {
+        "type": "object", 
+        "properties": {
+            "image_url": {
+                "type": "string", 
+                "description": "Прямая ссылка (URL) на изображение (например, с окончанием .jpg, .png, .webp)."
+            },
+            "caption": {
+                "type": "string",
+                "description": "Краткое описание того, что изображено на картинке."
+            }
+        }, 
+        "required": ["image_url", "caption"]
+    }
+}
+
+
+def make_image_command(params: dict) -> str:
+    """
+    Не выполняет логику сама, а форматирует специальную команду для GUI,
+    которая будет перехвачена и обработана в UI.py.
+    """
+    url = params.get("image_url")
+    caption = params.get("caption", "Изображение от ИИ")
+
+    # Формируем специальный JSON-ответ, который распознает GUI
+    gui_command = {
+        "gui_tool": "display_image",
+        "params": {
+            "url": url,
+            "caption": caption
+        }
+    }
+    logging.info(f"Агент сгенерировал команду для GUI: {gui_command}")
+    # Возвращаем эту строку. UI.py ее поймает.
+    return json.dumps(gui_command)
+
+
+def is_gui_command(result) -> bool:
+    """
+    Проверяет, не является ли результат вызова инструмента финальной командой для GUI.
+    `show_image_in_chat` возвращает именно такую команду в виде JSON-строки.
+    """
+    if not isinstance(result, str):
+        return False
+    try:
+        parsed_result = json.loads(result)
+    except (json.JSONDecodeError, TypeError):
+        return False # Это обычный строковый результат, а не JSON-команда.
+    return isinstance(parsed_result, dict) and "gui_tool" in parsed_result
+
+
+# Локальные инструменты, результат которых - команда для GUI, завершающая ход агента
+GUI_TOOLS = {"show_image_in_chat"}
+
+
+def split_at_gui_tools(tool_calls) -> list:
     """
-    def __init__(self, name: str, url: str, headers=None):
+    Делит вызовы хода на группы, каждая из которых заканчивается вызовом GUI-инструмента (последняя - чем угодно).
+    Группы выполняются по очереди: если GUI-инструмент вернул команду, ход завершается и вызовы после него
+    не выполняются вовсе - как при прежнем последовательном цикле.
+    """
+    groups, current = [], []
+    for tool_call in tool_calls:
+        current.append(tool_call)
+        if tool_call.function.name in GUI_TOOLS:
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+    return groups
+
+
+def plan_tool_calls(tool_calls, function_to_server_map: dict, local_tools, batch: bool) -> list:
+    """
+    Разбивает вызовы хода на независимые задачи: список (имя сервера или None, [индексы вызовов]).
+    При включенном пакетном режиме вызовы одного MCP-сервера попадают в одну задачу.
+    """
+    tasks, batches = [], {}
+    for index, tool_call in enumerate(tool_calls):
+        func_name = tool_call.function.name
+        server_name = function_to_server_map.get(func_name)
+        if batch and server_name and func_name not in local_tools:
+            if server_name not in batches:
+                batches[server_name] = []
+                tasks.append((server_name, batches[server_name]))
+            batches[server_name].append(index)
+        else:
+            tasks.append((None, [index]))
+    return tasks
+
+
+class ToolCallAssembler:
+    """Собирает потоковый ответ модели: текст и фрагменты tool_calls, приходящие по индексу."""
+
+    def __init__(self):
+        self.content_parts = []
+        self.calls = {}
+
+    def add_content(self, text: str):
+        self.content_parts.append(text)
+
+    def add_tool_call_deltas(self, deltas):
+        for tc_delta in deltas or []:
+            index = tc_delta.index if tc_delta.index is not None else 0
+            entry = self.calls.setdefault(index, {"id": None, "name": "", "arguments": ""})
+            if tc_delta.id:
+                entry["id"] = tc_delta.id
+            if tc_delta.function:
+                entry["name"] += tc_delta.function.name or ""
+                entry["arguments"] += tc_delta.function.arguments or ""
+
+    def build(self):
+        """Возвращает (текст, список tool_calls, сообщение ассистента для истории)."""
+        content = "".join(self.content_parts) or None
+        tool_calls = [
+            SimpleNamespace(id=entry["id"] or f"call_{index}", type="function",
+                            function=SimpleNamespace(name=entry["name"], arguments=entry["arguments"] or "{}"))
+            for index, entry in sorted(self.calls.items())
+        ]
+        message = {"role": "assistant"}
+        if content is not None:
+            message["content"] = content
+        if tool_calls:
+            message["tool_calls"] = [
+                {"id": tc.id, "type": "function", "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                for tc in tool_calls
+            ]
+        return content, tool_calls, message
+
+class MCPClientBase:
+    """
+    Общая часть синхронного (MCPServer) и асинхронного (AsyncMCPServer) клиентов MCP-сервера:
+    фиксированные параметры, сборка JSON-RPC запросов и пакетов, учет кэша и разбор ответов.
+    Подклассы только отправляют запросы (_post) и решают, где выполнять обращения к кэшу.
+    """
+    def __init__(self, name: str, headers=None, fixed_params=None):
         self.name = name
-        self.url = url.rstrip("/") + "/mcp"
         self.headers = headers or {}
+        # Параметры, которые агент подставляет в каждый вызов поверх аргументов модели
+        # (например, пространство имен памяти - модель не может его подменить)
+        self.fixed_params = fixed_params or {}
+        # Методы, которые безопасно повторить при обрыве/таймауте (см. MCP_REGISTRY)
+        self.idempotent_methods = set(MCP_REGISTRY.get(name, {}).get("idempotent_methods", []))
         self.id_counter = 1
-
-    def call(self, method: str, params: dict):
-        """Выполняет вызов метода на удаленном MCP-сервере."""
-        payload = {
-            "jsonrpc": "2.0",
-            "id": self.id_counter,
-            "method": method,
-            "params": params
-        }
-        self.id_counter += 1
-        
-        # ИСПРАВЛЕНО: Используем очищенные данные для логирования
-        log_params = _sanitize_log_data(params)
-        logging.info(f"AGENT_CALL -> {self.name}: method={method}, params={json.dumps(log_params)}")
-        
-        resp = requests.post(self.url, json=payload, headers=self.headers)
-        resp.raise_for_status()
-        data = resp.json()
+        # Вызовы одного сервера могут идти из нескольких потоков (параллельные инструменты)
+        self._id_lock = threading.Lock()
+        # Кэш результатов методов только для чтения (правила берутся из схемы сервера)
+        self.cache = get_tool_cache()
+        self.cache_policy = CachePolicy([])
+
+    def _next_id(self) -> int:
+        with self._id_lock:
+            request_id = self.id_counter
+            self.id_counter += 1
+        return request_id
+
+    def _raise_error(self, data: dict):
+        raise RuntimeError(f"MCP {self.name} error: {data['error']['message']} (code: {data['error']['code']})")
+
+    def _with_fixed(self, params, fixed_params=None):
+        fixed = {**self.fixed_params, **fixed_params} if fixed_params else self.fixed_params
+        return {**(params or {}), **fixed} if fixed else params
+
+    def _lookup_cached(self, calls: list) -> dict:
+        """
+        Результаты вызовов (method, params), которые можно отдать из кэша: {позиция: результат}.
+        Чтение после записи в том же пакете из кэша не отдается - запись еще не выполнена.
+        """
+        cached = {}
+        if self.cache is None:
+            return cached
+        for position, (method, params) in enumerate(calls):
+            if self.cache_policy.ttl(method) is None:
+                break
+            hit, result = self.cache.lookup(self.name, self.cache_policy, method, params)
+            if hit:
+                logging.info("AGENT_CALL <- %s (кэш): method=%s, params=%s", self.name, method, LogPayload(params))
+                cached[position] = result
+        return cached
+
+    def _build_requests(self, calls: list, cached: dict) -> list:
+        """JSON-RPC запросы для вызовов, не найденных в кэше; позиция вызова - в служебном ключе запроса."""
+        requests = []
+        for position, (method, params) in enumerate(calls):
+            if position in cached:
+                continue
+            requests.append({"jsonrpc": "2.0", "id": self._next_id(), "method": method, "params": params})
+            # Параметры и результат форматируются для лога лениво и без копирования (см. LogPayload)
+            logging.info("AGENT_CALL -> %s%s: method=%s, params=%s", self.name, " (пакет)" if len(calls) > 1 else "",
+                         method, LogPayload(params))
+        return requests
+
+    def _payload(self, requests: list, batch: bool):
+        """Тело HTTP-запроса: один объект JSON-RPC или пакет, и можно ли его повторить."""
+        payload = requests if batch else requests[0]
+        return payload, all(request["method"] in self.idempotent_methods for request in requests)
+
+    def _record(self, requests: list, data):
+        """
+        Учитывает ответ сервера в кэше: data - ответ на один запрос, на весь пакет или None, если ответа нет
+        (запись могла успеть выполниться на сервере - кэш сбрасывается, как при ошибке).
+        """
+        if self.cache is None:
+            return
+        responses = {item.get("id"): item for item in data if isinstance(item, dict)} if isinstance(data, list) else None
+        for request in requests:
+            response = data if responses is None else responses.get(request["id"])
+            self.cache.record(self.name, self.cache_policy, request["method"], request["params"], response)
+
+    def _result(self, data: dict):
+        """Результат одиночного вызова или RuntimeError с ошибкой сервера."""
         if "error" in data:
-            raise RuntimeError(f"MCP {self.name} error: {data['error']['message']} (code: {data['error']['code']})")
-        
-        # ИСПРАВЛЕНО: Логируем и результат тоже, предварительно очистив
-        log_result = _sanitize_log_data(data.get('result'))
-        logging.info(f"AGENT_CALL <- {self.name}: result={json.dumps(log_result)}")
-        
+            self._raise_error(data)
+        logging.info("AGENT_CALL <- %s: result=%s", self.name, LogPayload(data.get('result')))
         return data.get("result")
 
-class AIWithMCPInterface(QtCore.QObject):
+    def _batch_results(self, count: int, requests: list, cached: dict, data) -> list:
+        """
+        Результаты пакета в порядке вызовов; для неудачных вызовов - экземпляр RuntimeError.
+        Ошибка на уровне всего пакета (например, сервер не поддерживает batch) выбрасывается.
+        """
+        if isinstance(data, dict):
+            if "error" in data:
+                self._raise_error(data)
+            raise RuntimeError(f"MCP {self.name}: ожидался ответ на пакет запросов.")
+        responses = {item.get("id"): item for item in data if isinstance(item, dict)}
+        results = [cached.get(position) for position in range(count)]
+        positions = [position for position in range(count) if position not in cached]
+        for position, request in zip(positions, requests):
+            item = responses.get(request["id"])
+            if item is None:
+                results[position] = RuntimeError(f"MCP {self.name}: нет ответа на вызов {request['method']}.")
+            elif "error" in item:
+                try:
+                    self._raise_error(item)
+                except RuntimeError as e:
+                    results[position] = e
+            else:
+                logging.info("AGENT_CALL <- %s (пакет): result=%s", self.name, LogPayload(item.get('result')))
+                results[position] = item.get("result")
+        return results
+
+
+class MCPServer(MCPClientBase):
+    """
+    Представляет собой клиент для одного MCP-сервера.
+    """
+    def __init__(self, name: str, url: str, headers=None, fixed_params=None):
+        super().__init__(name, headers, fixed_params)
+        self.url = url.rstrip("/") + "/mcp"
+        # Одна пуловая keep-alive сессия на сервер (общая для всех агентов процесса)
+        self.transport = get_transport(url)
+
+    def _post(self, payload, idempotent: bool):
+        """Отправляет JSON-RPC payload (объект или пакет) и возвращает разобранный ответ."""
+        resp = self.transport.post_json("/mcp", payload, headers=self.headers, idempotent=idempotent)
+        try:
+            return resp.json()
+        except ValueError:
+            # Сервер ответил не JSON-RPC (например, HTML-страницей ошибки)
+            resp.raise_for_status()
+            raise RuntimeError(f"MCP {self.name}: некорректный ответ сервера.")
+
+    def _send(self, requests: list, batch: bool):
+        payload, idempotent = self._payload(requests, batch)
+        try:
+            data = self._post(payload, idempotent=idempotent)
+        except BaseException:
+            self._record(requests, None)
+            raise
+        self._record(requests, data)
+        # Сбор статистики сам по себе не бесплатный - только если DEBUG включен
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"AGENT_CALL {self.name}: транспорт {self.transport.stats()}")
+            if self.cache is not None:
+                logging.debug(f"AGENT_CALL {self.name}: кэш {self.cache.stats()}")
+        return data
+
+    def call(self, method: str, params: dict, fixed_params: dict = None):
+        """
+        Выполняет вызов метода на удаленном MCP-сервере.
+        :param fixed_params: Параметры этого вызова поверх аргументов модели (например, пространство памяти сессии).
+        """
+        calls = [(method, self._with_fixed(params, fixed_params))]
+        cached = self._lookup_cached(calls)
+        if cached:
+            return cached[0]
+        requests = self._build_requests(calls, cached)
+        return self._result(self._send(requests, batch=False))
+
+    def call_batch(self, calls: list, fixed_params: dict = None) -> list:
+        """
+        Выполняет несколько вызовов одним JSON-RPC пакетом (один HTTP-запрос).
+        :param calls: Список пар (method, params).
+        :param fixed_params: Как в call - добавляются к параметрам каждого вызова.
+        :return: Список результатов в том же порядке; для неудачных вызовов - экземпляр RuntimeError.
+        """
+        calls = [(method, self._with_fixed(params, fixed_params)) for method, params in calls]
+        cached = self._lookup_cached(calls)
+        requests = self._build_requests(calls, cached)
+        if not requests:
+            return [cached[position] for position in range(len(calls))]
+        return self._batch_results(len(calls), requests, cached, self._send(requests, batch=True))
+
+MAX_AGENT_TURNS = 10 # Ограничение, чтобы избежать бесконечных циклов
+
+
+class AgentCore:
+    """
+    Общая логика синхронного (AIWithMCPInterface) и асинхронного (AsyncAIWithMCPInterface) агента без ввода-вывода:
+    настройки модели и промпта, схемы MCP, параметры пространства памяти, разбор вызовов инструментов
+    и сам цикл ReAct (_agent_turns). Подклассы выполняют только запросы к LLM и вызовы инструментов.
+    """
+
+    def _load_model(self):
+        load_dotenv(override=True)
+        self.model = os.getenv("SELECTED_MODEL", "openai/gpt-4o")
+
+    def _load_prompt(self, prompt_path):
+        """Загружает системный промпт из файла."""
+        try:
+            with open(prompt_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            logging.error(f"Критическая ошибка: Файл промпта не найден по пути: {prompt_path}")
+            # Возвращаем простой промпт по умолчанию, чтобы избежать падения
+            return "Ты — полезный ассистент."
+
+    def _register_allowed_mcps(self, filter_list: list = None):
+        """
+        Регистрирует только те MCP, которые разрешены фильтром (клиент сервера создает _add_server подкласса).
+        Схемы функций берутся из общего реестра: из кэша сразу (с фоновой перепроверкой),
+        а отсутствующие в кэше загружаются со всех серверов одновременно.
+        """
+        # Если фильтр не задан, разрешаем все MCP.
+        if filter_list is None:
+            filter_list = self.ALL_MCP_SERVERS.keys()
+
+        allowed = {name: url for name, url in self.ALL_MCP_SERVERS.items() if name in filter_list}
+        logging.info(f"Агент регистрирует MCP: {list(allowed)}...")
+        schemas = self._schema_registry.get_schemas(allowed)
+
+        for name, url in allowed.items():
+            if name not in schemas:
+                logging.error(f"Ошибка при регистрации MCP '{name}' для агента: схема функций недоступна.")
+                continue
+            # Сервер может сам ограничить параллелизм (например, один браузер Selenium)
+            self._add_server(name, url, MCP_REGISTRY.get(name, {}).get("max_parallel_calls", self.max_calls_per_server))
+        self._schemas = {name: functions for name, functions in schemas.items() if name in self.mcp_servers}
+        self._rebuild_functions()
+        # Схема сервера может измениться после фоновой перепроверки - подхватываем ее без перезапуска
+        self._schema_registry.subscribe(self._on_schema_changed)
+
+    def _rebuild_functions(self):
+        """Пересобирает список функций и карту функция -> сервер из текущих схем."""
+        functions = []
+        function_to_server_map = {}
+        for name, mcp_functions in self._schemas.items():
+            # Служебные ключи кэширования нужны только клиенту сервера, модели они не отправляются
+            functions.extend(llm_function(func) for func in mcp_functions)
+            self.mcp_servers[name].cache_policy = CachePolicy(mcp_functions)
+            for func in mcp_functions:
+                function_to_server_map[func['name']] = name
+        # Присваивания атомарны: call_ai в другом потоке видит либо старый, либо новый набор
+        self._function_to_server_map = function_to_server_map
+        self.functions = functions
+
+    def _on_schema_changed(self, name: str, functions: list):
+        if name in self.mcp_servers:
+            self._schemas = {**self._schemas, name: functions}
+            self._rebuild_functions()
+
+    def _fixed_params(self, server_name: str, namespace: str = None) -> dict:
+        """Параметры, которые агент сам добавляет к вызовам сервера: пространство имен памяти для "namespaced" серверов."""
+        if namespace and MCP_REGISTRY.get(server_name, {}).get("namespaced"):
+            return {"namespace": namespace}
+        return {}
+
+    @staticmethod
+    def _parse_arguments(tool_call):
+        """Аргументы вызова инструмента: (словарь, None) или (None, текст ошибки для модели)."""
+        try:
+            return json.loads(tool_call.function.arguments), None
+        except json.JSONDecodeError:
+            return None, f"Ошибка: неверный JSON в аргументах для функции {tool_call.function.name}."
+
+    def _tool_not_found(self, func_name: str) -> str:
+        return f"Критическая ошибка: инструмент '{func_name}' не найден в доступных для этого агента."
+
+    @staticmethod
+    def _log_tool_time(tool_call, started: float):
+        elapsed = time.perf_counter() - started
+        logging.info(f"Инструмент {tool_call.function.name} (id={tool_call.id}) выполнен за {elapsed * 1000:.0f} мс.")
+        return elapsed
+
+    def _batch_calls(self, tool_calls: list):
+        """Разбор пакета вызовов одного сервера: (исходы с ошибками разбора, [(method, params)], их позиции)."""
+        outcomes = [None] * len(tool_calls)
+        calls, positions = [], []
+        for position, tool_call in enumerate(tool_calls):
+            func_args, error = self._parse_arguments(tool_call)
+            if error:
+                outcomes[position] = (error, 0.0)
+            else:
+                calls.append((tool_call.function.name, func_args))
+                positions.append(position)
+        return outcomes, calls, positions
+
+    @staticmethod
+    def _batch_outcomes(server_name: str, outcomes: list, positions: list, results: list, started: float) -> list:
+        """Дополняет исходы пакета результатами сервера: список (результат, время) в порядке вызовов."""
+        elapsed = time.perf_counter() - started
+        logging.info(f"Пакет из {len(results)} вызовов к MCP '{server_name}' выполнен за {elapsed * 1000:.0f} мс.")
+        for position, result in zip(positions, results):
+            # Ошибка MCP прерывает ход так же, как и при одиночном вызове
+            if isinstance(result, Exception):
+                raise result
+            outcomes[position] = (result, elapsed)
+        return outcomes
+
+    def _plan_tasks(self, tool_calls) -> list:
+        """Независимые задачи хода: (имя сервера или None, вызовы, их индексы в tool_calls)."""
+        return [(server_name, [tool_calls[i] for i in indexes], indexes) for server_name, indexes in plan_tool_calls(
+            tool_calls, self._function_to_server_map, self.local_tools, self.batch_tool_calls
+        )]
+
+    @staticmethod
+    def _collect_outcomes(tool_calls, tasks: list, task_outcomes: list, started: float) -> list:
+        """Результаты задач хода в исходном порядке tool_calls, независимо от порядка завершения."""
+        outcomes = [None] * len(tool_calls)
+        for (_, _, indexes), task_result in zip(tasks, task_outcomes):
+            for index, outcome in zip(indexes, task_result):
+                outcomes[index] = outcome
+
+        if len(tool_calls) > 1:
+            wall_time = time.perf_counter() - started
+            # Вызовы одного пакета делят общее время, поэтому считаем каждую задачу один раз
+            sequential_time = sum(max(elapsed for _, elapsed in task_result) for task_result in task_outcomes)
+            logging.info(
+                f"Ход: {len(tool_calls)} вызовов в {len(tasks)} запросах, сумма {sequential_time * 1000:.0f} мс, "
+                f"фактически {wall_time * 1000:.0f} мс (экономия {max(sequential_time - wall_time, 0) * 1000:.0f} мс)."
+            )
+        return [result for result, _ in outcomes]
+
+    def _agent_turns(self, history: list, run_budget, on_action, on_stream_reset):
+        """
+        Цикл ReAct без ввода-вывода - генератор. Отдает запросы ("complete", сообщения, инструменты) и
+        ("tools", вызовы одной группы), через send получает ответ модели (текст, tool_calls, сообщение)
+        или результаты вызовов, а итоговый ответ возвращает в StopIteration.value.
+        """
+        self._load_model()
+        messages = [{"role": "system", "content": self.system_prompt}] + history
+
+        # Агент видит только разрешенные ему инструменты
+        available_tools = self.functions + self.local_tools_schema
+        tools = [{"type": "function", "function": f} for f in available_tools]
+
+        # Бюджет контекста: в запрос уходит сжатая копия истории, сама история не меняется
+        budgeter = ContextBudgeter(self.model)
+
+        for i in range(MAX_AGENT_TURNS):
+            logging.info(f"Агент (итерация {i+1}). История: {len(messages)} сообщений.")
+            if run_budget is not None and run_budget.exceeded():
+                reason = run_budget.exceeded()
+                logging.warning(f"Агент остановлен: {reason}.")
+                return f"Работа остановлена: {reason}."
+            request_messages, report = budgeter.compact(messages)
+            if report["tokens_saved"] > 0:
+                logging.info(
+                    f"Контекст сжат: ~{report['tokens_before']} -> ~{report['tokens_after']} токенов "
+                    f"(сэкономлено ~{report['tokens_saved']}, отброшено сообщений: {report['dropped_messages']}, бюджет {report['budget']})."
+                )
+
+            # Вызов LLM
+            content, tool_calls, message = yield "complete", request_messages, tools
+            if run_budget is not None:
+                run_budget.add_tokens(report["tokens_after"] + estimate_tokens(message))
+
+            # Если нет вызова инструментов, а есть текст - это финальный ответ
+            if not tool_calls and content:
+                logging.info("Агент завершил работу и предоставил финальный текстовый ответ.")
+                on_action("") # Очищаем статус
+                return content
+
+            # Добавляем ответ модели в историю
+            messages.append(message)
+
+            # Проверяем, есть ли что выполнять
+            if not tool_calls:
+                logging.warning("Агент завершил работу без ответа или вызова инструмента.")
+                break
+
+            # Текст, показанный до вызова инструментов, не является ответом - убираем его из UI
+            if content and self.streaming:
+                on_stream_reset()
+
+            # Обрабатываем вызовы инструментов (независимые вызовы одного хода - параллельно);
+            # вызовы после GUI-инструмента не выполняются, если он завершил ход (см. split_at_gui_tools)
+            for group in split_at_gui_tools(tool_calls):
+                # Бюджет мог истечь (или запуск отменен) за время ответа модели - новые вызовы уже не начинаем
+                if run_budget is not None and run_budget.exceeded():
+                    reason = run_budget.exceeded()
+                    logging.warning(f"Агент остановлен перед вызовом инструментов: {reason}.")
+                    return f"Работа остановлена: {reason}."
+                outcomes = yield "tools", group
+                for tool_call, result in zip(group, outcomes):
+                    if is_gui_command(result):
+                        # Если это команда для GUI - это и есть финальный ответ.
+                        # Немедленно возвращаем его, не продолжая цикл.
+                        logging.info("Агент сгенерировал финальную команду для GUI. Завершение работы.")
+                        on_action("") # Очищаем статус
+                        return result # Возвращаем JSON-строку как есть
+
+                    messages.append({"role": "tool", "tool_call_id": tool_call.id, "name": tool_call.function.name, "content": json.dumps(result, ensure_ascii=False)})
+
+        logging.warning("Достигнут лимит итераций, или агент не смог дать финальный ответ.")
+        return "К сожалению, я не смог завершить задачу. Попробуйте переформулировать запрос."
+
+
+class AIWithMCPInterface(QtCore.QObject, AgentCore):
     """
     Универсальный "движок" для ИИ-агентов. Может быть настроен как Оркестратор
     или как узкоспециализированный суб-агент с помощью разных промптов и наборов инструментов.
     """
     action_started = QtCore.pyqtSignal(str)
+    # Потоковый режим: фрагменты текста ответа по мере генерации и сброс,
+    # когда уже показанный текст оказался лишь преамбулой к вызову инструментов.
+    token_received = QtCore.pyqtSignal(str)
+    stream_reset = QtCore.pyqtSignal()
 
     # ### ИЗМЕНЕНО: Конструктор теперь принимает путь к промпту и фильтры ###
-    def __init__(self, client: OpenAI, prompt_path: str, all_mcp_servers: dict, allowed_mcp_filter: list = None):
+    def __init__(self, client: OpenAI, prompt_path: str, all_mcp_servers: dict, allowed_mcp_filter: list = None,
+                 sub_agent_names: list = None, memory_namespace: str = None):
         """
         Инициализирует агента.
         :param client: Клиент OpenAI.
@@ -83,6 +620,10 @@ class AIWithMCPInterface(QtCore.QObject):
         :param allowed_mcp_filter: Список ключей MCP (например, ['rpg', 'files']), которые
                                    разрешено использовать ЭТОМУ конкретному агенту.
                                    Если None, разрешены все.
+        :param sub_agent_names: Суб-агенты из SUB_AGENT_REGISTRY, которым агент может
+                                делегировать задачи (инструмент delegate_tasks). Если None - никаким.
+        :param memory_namespace: Пространство имен семантической памяти агента по умолчанию (профиль);
+                                 пространство конкретного чата передается в call_ai. Если None - общее пространство сервера.
         """
         super().__init__()
         load_dotenv()
@@ -97,6 +638,23 @@ class AIWithMCPInterface(QtCore.QObject):
         self.mcp_servers = {}
         self.functions = []
         self._function_to_server_map = {}
+        self._schemas = {}
+        self._schema_registry = get_schema_registry()
+
+        # Потоковая генерация ответа (текст уходит в UI по мере генерации)
+        self.streaming = os.getenv("AGENT_STREAMING", "1") == "1"
+
+        # Параллельное выполнение независимых вызовов инструментов одного хода.
+        # Общий пул ограничивает число потоков, семафоры - нагрузку на каждый MCP.
+        self.parallel_tool_calls = os.getenv("AGENT_PARALLEL_TOOL_CALLS", "1") == "1"
+        # Вызовы одного хода к одному и тому же MCP объединяются в один JSON-RPC пакет
+        self.batch_tool_calls = os.getenv("AGENT_BATCH_TOOL_CALLS", "1") == "1"
+        self.max_calls_per_server = int(os.getenv("AGENT_MAX_CALLS_PER_SERVER", "2"))
+        self._server_slots = {}
+        self._tool_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("AGENT_MAX_TOOL_WORKERS", "8")),
+            thread_name_prefix="agent-tool"
+        )
         
         # ### НОВОЕ: Локальные инструменты, определенные в коде, а не через MCP ###
         # Оркестратор будет использовать это для вызова суб-агентов.
@@ -104,45 +662,22 @@ class AIWithMCPInterface(QtCore.QObject):
             "show_image_in_chat": self.show_image_in_chat
             # ... другие инструменты :
         }
-        self.local_tools_schema = [
-            {
-                "name": "show_image_in_chat",
-                "description": "Показывает пользователю изображение прямо в окне чата. Используй эту функцию, когда пользователь просит что-то показать, или когда визуальное представление информации будет полезно. Всегда предоставляй прямой URL изображения.",
-                "parameters": {
-                    "type": "object", 
-                    "properties": {
-                        "image_url": {
-                            "type": "string", 
-                            "description": "Прямая ссылка (URL) на изображение (например, с окончанием .jpg, .png, .webp)."
-                        },
-                        "caption": {
-                            "type": "string",
-                            "description": "Краткое описание того, что изображено на картинке."
-                        }
-                    }, 
-                    "required": ["image_url", "caption"]
-                }
-            }
-        ]
+        self.local_tools_schema = [SHOW_IMAGE_IN_CHAT_SCHEMA]
+
+        # Делегирование: суб-агенты создаются при первом поручении и переиспользуются
+        self.sub_agents = None
+        if sub_agent_names:
+            self.sub_agents = SubAgentPool(self._create_sub_agent, sub_agent_names)
+            self.local_tools["delegate_tasks"] = self.delegate_tasks
+            self.local_tools_schema.append(delegate_tasks_schema(sub_agent_names))
         
+        # Своя память у чата или профиля агента: пространство имен подставляется в вызовы сервера памяти
+        self.memory_namespace = memory_namespace
+
         # Регистрируем разрешенные MCP
         self._register_allowed_mcps(allowed_mcp_filter)
 
 
-    def _load_model(self):
-        load_dotenv(override=True)
-        self.model = os.getenv("SELECTED_MODEL", "openai/gpt-4o")
-
-    def _load_prompt(self, prompt_path):
-        """Загружает системный промпт из файла."""
-        try:
-            with open(prompt_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            logging.error(f"Критическая ошибка: Файл промпта не найден по пути: {prompt_path}")
-            # Возвращаем простой промпт по умолчанию, чтобы избежать падения
-            return "Ты — полезный ассистент."
-        
     def find_and_show_image(self, params: dict) -> str:
         """
         Инструмент-обертка, который ищет картинку в вебе и вызывает другой инструмент для ее отображения.
@@ -185,135 +720,129 @@ class AIWithMCPInterface(QtCore.QObject):
             logging.error(f"Ошибка в инструменте find_and_show_image: {e}")
             return f"Произошла ошибка во время поиска изображения: {e}"
 
-    def _register_allowed_mcps(self, filter_list: list = None):
+    def _add_server(self, name: str, url: str, slots: int):
+        self.mcp_servers[name] = MCPServer(name, url)
+        self._server_slots[name] = threading.BoundedSemaphore(slots)
+
+    def show_image_in_chat(self, params: dict, memory_namespace: str = None) -> str:
+        """Формирует GUI-команду показа изображения (см. make_image_command)."""
+        return make_image_command(params)
+
+    def _create_sub_agent(self, name: str, spec: dict):
+        """Создает суб-агента: свой промпт и фильтр MCP, статус пересылается в статус оркестратора."""
+        agent = AIWithMCPInterface(self.client, spec["prompt"], self.ALL_MCP_SERVERS, spec["mcp_filter"],
+                                   memory_namespace=spec.get("memory_namespace", self.memory_namespace))
+        # Ответ суб-агента читает оркестратор, а не пользователь - потоковый вывод не нужен
+        agent.streaming = False
+        agent.action_started.connect(lambda text: self.action_started.emit(f"[{name}] {text}") if text else None)
+        return agent
+
+    def delegate_tasks(self, params: dict, memory_namespace: str = None) -> list:
+        """Выполняет независимые подзадачи суб-агентов одновременно (см. SubAgentPool.run)."""
+        return self.sub_agents.run(params.get("tasks"), memory_namespace)
+
+    def _execute_tool_call(self, tool_call, namespace: str = None):
+        """Выполняет один вызов инструмента. Возвращает (результат, время выполнения в секундах)."""
+        func_name = tool_call.function.name
+        started = time.perf_counter()
+        func_args, error = self._parse_arguments(tool_call)
+        if error:
+            return error, 0.0
+
+        # Выбираем, какой инструмент вызвать: локальный или удаленный MCP
+        if func_name in self.local_tools:
+            self.action_started.emit(f"Выполняю задачу: {func_name}...")
+            # Локальные инструменты получают пространство памяти сессии (его передает дальше delegate_tasks)
+            result = self.local_tools[func_name](func_args, namespace)
+        elif func_name in self._function_to_server_map:
+            self.action_started.emit(f"Вызываю MCP: {func_name}...")
+            server_name = self._function_to_server_map[func_name]
+            with self._server_slots[server_name]:
+                result = self.mcp_servers[server_name].call(func_name, func_args, self._fixed_params(server_name, namespace))
+        else:
+            result = self._tool_not_found(func_name)
+        return result, self._log_tool_time(tool_call, started)
+
+    def _execute_batch(self, server_name: str, tool_calls: list, namespace: str = None) -> list:
         """
-        Регистрирует только те MCP, которые разрешены фильтром.
+        Выполняет несколько вызовов одного MCP-сервера одним пакетом.
+        Возвращает список (результат, время) в порядке tool_calls.
         """
-        # Если фильтр не задан, разрешаем все MCP.
-        if filter_list is None:
-            filter_list = self.ALL_MCP_SERVERS.keys()
-
-        for name, url in self.ALL_MCP_SERVERS.items():
-            if name in filter_list:
-                try:
-                    logging.info(f"Агент регистрирует MCP '{name}'...")
-                    functions_url = url.rstrip("/") + "/functions"
-                    resp = requests.get(functions_url, timeout=5)
-                    resp.raise_for_status()
-                    
-                    mcp_functions = resp.json()
-                    
-                    self.mcp_servers[name] = MCPServer(name, url)
-                    self.functions.extend(mcp_functions)
-                    for func in mcp_functions:
-                        self._function_to_server_map[func['name']] = name
-                except Exception as e:
-                    logging.error(f"Ошибка при регистрации MCP '{name}' для агента: {e}")
-
-    
-   
-
-    def show_image_in_chat(self, params: dict) -> str:
+        started = time.perf_counter()
+        outcomes, calls, positions = self._batch_calls(tool_calls)
+        if not calls:
+            return outcomes
+        self.action_started.emit(f"Вызываю MCP: {', '.join(name for name, _ in calls)}...")
+        with self._server_slots[server_name]:
+            results = self.mcp_servers[server_name].call_batch(calls, self._fixed_params(server_name, namespace))
+        return self._batch_outcomes(server_name, outcomes, positions, results, started)
+
+    def _run_task(self, server_name, tool_calls, namespace: str = None) -> list:
+        if server_name is None or len(tool_calls) == 1:
+            return [self._execute_tool_call(tool_call, namespace) for tool_call in tool_calls]
+        return self._execute_batch(server_name, tool_calls, namespace)
+
+    def _run_tool_calls(self, tool_calls, namespace: str = None) -> list:
         """
-        Этот метод не выполняет логику сам, а форматирует специальную команду для GUI,
-        которая будет перехвачена и обработана в UI.py.
+        Выполняет все вызовы инструментов одного хода модели.
+        Результаты возвращаются в исходном порядке tool_calls, независимо от порядка завершения.
         """
-        url = params.get("image_url")
-        caption = params.get("caption", "Изображение от ИИ")
-
-        # Формируем специальный JSON-ответ, который распознает GUI
-        gui_command = {
-            "gui_tool": "display_image",
-            "params": {
-                "url": url,
-                "caption": caption
-            }
-        }
-        logging.info(f"Агент сгенерировал команду для GUI: {gui_command}")
-        # Возвращаем эту строку. UI.py ее поймает.
-        return json.dumps(gui_command)
-
-    def call_ai(self, history: list, **kwargs) -> str:
-        """Основной цикл работы агента."""
-        self._load_model()
-        messages = [{"role": "system", "content": self.system_prompt}] + history
-        
-        # Агент видит только разрешенные ему инструменты
-        available_tools = self.functions + self.local_tools_schema
-        
-        MAX_AGENT_TURNS = 10 # Ограничение, чтобы избежать бесконечных циклов
-        for i in range(MAX_AGENT_TURNS):
-            logging.info(f"Агент (итерация {i+1}). История: {len(messages)} сообщений.")
-            
-            # Вызов LLM
+        started = time.perf_counter()
+        tasks = self._plan_tasks(tool_calls)
+        if self.parallel_tool_calls and len(tasks) > 1:
+            futures = [self._tool_executor.submit(self._run_task, server_name, calls, namespace) for server_name, calls, _ in tasks]
+            task_outcomes = [future.result() for future in futures]
+        else:
+            task_outcomes = [self._run_task(server_name, calls, namespace) for server_name, calls, _ in tasks]
+        return self._collect_outcomes(tool_calls, tasks, task_outcomes, started)
+
+    def _complete(self, messages: list, tools: list, **kwargs):
+        """
+        Один запрос к LLM. Возвращает (текст, список tool_calls, сообщение для истории).
+        В потоковом режиме текст отправляется в UI через token_received по мере генерации,
+        а фрагменты вызовов инструментов собираются по их индексу.
+        """
+        if not self.streaming:
             response = self.client.chat.completions.create(
-                model=self.model, 
-                messages=messages, 
-                tools=[{"type": "function", "function": f} for f in available_tools], 
-                tool_choice="auto", 
-                **kwargs
+                model=self.model, messages=messages, tools=tools, tool_choice="auto", **kwargs
             )
             message_obj = response.choices[0].message
-            
-            # Если нет вызова инструментов, а есть текст - это финальный ответ
-            if not message_obj.tool_calls and message_obj.content:
-                logging.info("Агент завершил работу и предоставил финальный текстовый ответ.")
-                self.action_started.emit("") # Очищаем статус
-                return message_obj.content
-
-            # Добавляем ответ модели в историю
-            messages.append(json.loads(message_obj.model_dump_json(exclude_none=True)))
-            
-            # Проверяем, есть ли что выполнять
-            if not message_obj.tool_calls:
-                logging.warning("Агент завершил работу без ответа или вызова инструмента.")
-                break
-
-            # Обрабатываем вызовы инструментов
-            for tool_call in message_obj.tool_calls:
-                func_name = tool_call.function.name
-                try:
-                    func_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError:
-                    result = f"Ошибка: неверный JSON в аргументах для функции {func_name}."
-                    messages.append({"role": "tool", "tool_call_id": tool_call.id, "name": func_name, "content": result})
-                    continue
-
-                tool_call_id = tool_call.id
-                result = None
-
-                # Выбираем, какой инструмент вызвать: локальный или удаленный MCP
-                if func_name in self.local_tools:
-                    self.action_started.emit(f"Выполняю задачу: {func_name}...")
-                    result = self.local_tools[func_name](func_args)
-                elif func_name in self._function_to_server_map:
-                    self.action_started.emit(f"Вызываю MCP: {func_name}...")
-                    server_name = self._function_to_server_map[func_name]
-                    result = self.mcp_servers[server_name].call(func_name, func_args)
+            return message_obj.content, message_obj.tool_calls or [], json.loads(message_obj.model_dump_json(exclude_none=True))
+
+        started = time.perf_counter()
+        stream = self.client.chat.completions.create(
+            model=self.model, messages=messages, tools=tools, tool_choice="auto", stream=True, **kwargs
+        )
+        assembler = ToolCallAssembler()
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if not assembler.content_parts:
+                    logging.info(f"Первый токен ответа через {(time.perf_counter() - started) * 1000:.0f} мс.")
+                assembler.add_content(delta.content)
+                self.token_received.emit(delta.content)
+            assembler.add_tool_call_deltas(delta.tool_calls)
+        logging.info(f"Ответ модели получен потоком за {(time.perf_counter() - started) * 1000:.0f} мс.")
+        return assembler.build()
+
+    def call_ai(self, history: list, run_budget=None, memory_namespace: str = None, **kwargs) -> str:
+        """
+        Основной цикл работы агента (логика хода - в AgentCore._agent_turns, здесь только запросы к LLM и инструментам).
+        :param run_budget: Необязательный RunBudget (бюджет токенов и времени, см. sub_agents.py).
+        :param memory_namespace: Пространство имен памяти этого запроса (например, чата); по умолчанию - агента.
+            Передается в вызов, а не хранится в агенте, чтобы запрос одного чата не писал в память другого.
+        """
+        namespace = memory_namespace or self.memory_namespace
+        turns = self._agent_turns(history, run_budget, self.action_started.emit, self.stream_reset.emit)
+        try:
+            request = next(turns)
+            while True:
+                if request[0] == "complete":
+                    reply = self._complete(request[1], request[2], **kwargs)
                 else:
-                    result = f"Критическая ошибка: инструмент '{func_name}' не найден в доступных для этого агента."
-
-                # ### НАЧАЛО ИСПРАВЛЕНИЯ ###
-                # Проверяем, не является ли результат вызова инструмента финальной командой для GUI.
-                # `show_image_in_chat` возвращает именно такую команду в виде JSON-строки.
-                is_gui_command = False
-                if isinstance(result, str):
-                    try:
-                        parsed_result = json.loads(result)
-                        if isinstance(parsed_result, dict) and "gui_tool" in parsed_result:
-                            is_gui_command = True
-                    except (json.JSONDecodeError, TypeError):
-                        pass # Это обычный строковый результат, а не JSON-команда.
-
-                if is_gui_command:
-                    # Если это команда для GUI - это и есть финальный ответ.
-                    # Немедленно возвращаем его, не продолжая цикл.
-                    logging.info("Агент сгенерировал финальную команду для GUI. Завершение работы.")
-                    self.action_started.emit("") # Очищаем статус
-                    return result # Возвращаем JSON-строку как есть
-                # ### КОНЕЦ ИСПРАВЛЕНИЯ ###
-
-                messages.append({"role": "tool", "tool_call_id": tool_call_id, "name": func_name, "content": json.dumps(result, ensure_ascii=False)})
-
-        logging.warning("Достигнут лимит итераций, или агент не смог дать финальный ответ.")
-        return "К сожалению, я не смог завершить задачу. Попробуйте переформулировать запрос."
\ No newline at end of file
+                    reply = self._run_tool_calls(request[1], namespace)
+                request = turns.send(reply)
+        except StopIteration as stop:
+            return stop.value
@@ -0,0 +1,396 @@
+# ai_interface_async.py
+"""
+Асинхронное ядро агента на asyncio.
+
+AsyncAIWithMCPInterface использует ту же логику, что и AIWithMCPInterface (AgentCore и MCPClientBase:
+цикл ReAct, пакеты и параллельные вызовы инструментов, бюджет контекста, кэш), но запросы к LLM и MCP
+выполняет корутинами на AsyncOpenAI и httpx.AsyncClient.
+Один экземпляр агента обслуживает любое число одновременных сессий: состояние сессии живет
+только в аргументах call_ai, а статус и токены передаются через колбэки конкретного вызова.
+
+AsyncAgentBridge связывает агента с Qt: один цикл asyncio работает в фоновом потоке,
+а каждая сессия получает объект AsyncAgentTask с теми же сигналами, что и AIWorker.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from PyQt5 import QtCore
+
+from ai_interface import (
+    SHOW_IMAGE_IN_CHAT_SCHEMA, make_image_command, ToolCallAssembler, MCPClientBase, AgentCore,
+)
+from mcp_schema_registry import get_schema_registry
+from mcp_transport import RETRY_STATUS_CODES
+from sub_agents import SubAgentPool, delegate_tasks_schema
+
+
+class AsyncMCPServer(MCPClientBase):
+    """
+    Асинхронный клиент одного MCP-сервера. Соединения пула httpx переиспользуются (keep-alive),
+    таймауты и повторы настраиваются теми же переменными, что и у MCPTransport.
+    """
+    def __init__(self, name: str, url: str, headers=None, fixed_params=None):
+        super().__init__(name, headers, fixed_params)
+        self.base_url = url.rstrip("/")
+        self.timeout = httpx.Timeout(
+            float(os.getenv("MCP_READ_TIMEOUT", "120")),
+            connect=float(os.getenv("MCP_CONNECT_TIMEOUT", "3")),
+        )
+        self.max_retries = int(os.getenv("MCP_MAX_RETRIES", "2"))
+        self.backoff = float(os.getenv("MCP_RETRY_BACKOFF", "0.3"))
+        self.pool_size = int(os.getenv("MCP_POOL_SIZE", "8"))
+        # Клиент httpx привязан к циклу событий, поэтому создается при первом вызове
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        return self._client
+
+    async def _post(self, payload, idempotent: bool):
+        """
+        Отправляет JSON-RPC payload и возвращает разобранный ответ. Запрос, который не дошел
+        до сервера, повторяется всегда; таймаут чтения, обрыв и 502/503/504 - только для идемпотентных.
+        """
+        client = self._get_client()
+        attempt = 0
+        while True:
+            try:
+                resp = await client.post("/mcp", json=payload, headers=self.headers)
+                if not (idempotent and resp.status_code in RETRY_STATUS_CODES and attempt < self.max_retries):
+                    break
+                logging.warning(f"MCP {self.base_url}: ответ {resp.status_code}, повтор запроса.")
+            except (httpx.ConnectTimeout, httpx.ConnectError):
+                if attempt >= self.max_retries:
+                    raise
+            except (httpx.ReadTimeout, httpx.RemoteProtocolError, httpx.ReadError):
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+
+        try:
+            return resp.json()
+        except ValueError:
+            # Сервер ответил не JSON-RPC (например, HTML-страницей ошибки)
+            resp.raise_for_status()
+            raise RuntimeError(f"MCP {self.name}: некорректный ответ сервера.")
+
+    async def _cache_io(self, func, *args):
+        """
+        Обращения к кэшу выполняются вне цикла событий: это SQLite с commit на каждую запись
+        под блокировкой, общей с синхронными агентами, - иначе они останавливали бы все сессии.
+        """
+        if self.cache is None:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def _send(self, requests: list, batch: bool):
+        payload, idempotent = self._payload(requests, batch)
+        try:
+            data = await self._post(payload, idempotent=idempotent)
+        except BaseException:
+            await self._cache_io(self._record, requests, None)
+            raise
+        await self._cache_io(self._record, requests, data)
+        return data
+
+    async def call(self, method: str, params: dict, fixed_params: dict = None):
+        """Выполняет вызов метода на удаленном MCP-сервере (fixed_params - см. MCPServer.call)."""
+        calls = [(method, self._with_fixed(params, fixed_params))]
+        cached = await self._cache_io(self._lookup_cached, calls)
+        if cached:
+            return cached[0]
+        requests = self._build_requests(calls, cached)
+        return self._result(await self._send(requests, batch=False))
+
+    async def call_batch(self, calls: list, fixed_params: dict = None) -> list:
+        """
+        Выполняет несколько вызовов одним JSON-RPC пакетом.
+        :param calls: Список пар (method, params).
+        :return: Список результатов в том же порядке; для неудачных вызовов - экземпляр RuntimeError.
+        """
+        calls = [(method, self._with_fixed(params, fixed_params)) for method, params in calls]
+        cached = await self._cache_io(self._lookup_cached, calls)
+        requests = self._build_requests(calls, cached)
+        if not requests:
+            return [cached[position] for position in range(len(calls))]
+        return self._batch_results(len(calls), requests, cached, await self._send(requests, batch=True))
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncAIWithMCPInterface(AgentCore):
+    """
+    Асинхронный "движок" агента. Настраивается так же, как AIWithMCPInterface
+    (промпт и фильтр MCP), но все вызовы LLM и MCP выполняются корутинами.
+    """
+
+    def __init__(self, client: AsyncOpenAI, prompt_path: str, all_mcp_servers: dict, allowed_mcp_filter: list = None,
+                 sub_agent_names: list = None, memory_namespace: str = None):
+        """
+        Инициализирует агента.
+        :param client: Асинхронный клиент OpenAI.
+        :param prompt_path: Путь к текстовому файлу с системным промптом.
+        :param all_mcp_servers: Словарь ВСЕХ доступных MCP-серверов в системе.
+        :param allowed_mcp_filter: Список ключей MCP, разрешенных этому агенту. Если None, разрешены все.
+        :param sub_agent_names: Суб-агенты, которым агент может делегировать задачи. Если None - никаким.
+        :param memory_namespace: Пространство имен семантической памяти агента по умолчанию; пространство сессии
+            (например, чата) передается в call_ai. Если None - общее пространство сервера.
+        """
+        load_dotenv()
+        self.client = client
+        self._load_model()
+        self.system_prompt = self._load_prompt(prompt_path)
+        self.ALL_MCP_SERVERS = all_mcp_servers
+
+        self.mcp_servers = {}
+        self.functions = []
+        self._function_to_server_map = {}
+        self._schemas = {}
+        self._schema_registry = get_schema_registry()
+
+        self.streaming = os.getenv("AGENT_STREAMING", "1") == "1"
+        self.parallel_tool_calls = os.getenv("AGENT_PARALLEL_TOOL_CALLS", "1") == "1"
+        self.batch_tool_calls = os.getenv("AGENT_BATCH_TOOL_CALLS", "1") == "1"
+        self.max_calls_per_server = int(os.getenv("AGENT_MAX_CALLS_PER_SERVER", "2"))
+        # Лимиты на сервер общие для всех сессий агента; семафоры asyncio создаются в цикле событий
+        self._server_limits = {}
+        self._server_slots = {}
+
+        self.local_tools = {
+            "show_image_in_chat": self.show_image_in_chat
+        }
+        self.local_tools_schema = [SHOW_IMAGE_IN_CHAT_SCHEMA]
+
+        self.sub_agents = None
+        if sub_agent_names:
+            self.sub_agents = SubAgentPool(self._create_sub_agent, sub_agent_names)
+            self.local_tools["delegate_tasks"] = self.delegate_tasks
+            self.local_tools_schema.append(delegate_tasks_schema(sub_agent_names))
+
+        self.memory_namespace = memory_namespace
+        self._register_allowed_mcps(allowed_mcp_filter)
+
+    def _add_server(self, name: str, url: str, slots: int):
+        self.mcp_servers[name] = AsyncMCPServer(name, url)
+        self._server_limits[name] = slots
+
+    def _slot(self, server_name: str) -> asyncio.Semaphore:
+        slot = self._server_slots.get(server_name)
+        if slot is None:
+            slot = asyncio.Semaphore(self._server_limits[server_name])
+            self._server_slots[server_name] = slot
+        return slot
+
+    def show_image_in_chat(self, params: dict, on_action=None, memory_namespace: str = None) -> str:
+        """Формирует GUI-команду показа изображения (см. make_image_command)."""
+        return make_image_command(params)
+
+    def _create_sub_agent(self, name: str, spec: dict):
+        agent = AsyncAIWithMCPInterface(self.client, spec["prompt"], self.ALL_MCP_SERVERS, spec["mcp_filter"],
+                                        memory_namespace=spec.get("memory_namespace", self.memory_namespace))
+        agent.streaming = False
+        return agent
+
+    async def delegate_tasks(self, params: dict, on_action=None, memory_namespace: str = None) -> list:
+        """Выполняет независимые подзадачи суб-агентов одновременно (см. SubAgentPool.arun)."""
+        return await self.sub_agents.arun(params.get("tasks"), on_action, memory_namespace)
+
+    async def _execute_tool_call(self, tool_call, on_action, namespace: str = None):
+        """Выполняет один вызов инструмента. Возвращает (результат, время выполнения в секундах)."""
+        func_name = tool_call.function.name
+        started = time.perf_counter()
+        func_args, error = self._parse_arguments(tool_call)
+        if error:
+            return error, 0.0
+
+        if func_name in self.local_tools:
+            on_action(f"Выполняю задачу: {func_name}...")
+            # Локальные инструменты асинхронного агента получают колбэк статуса и пространство памяти своей сессии
+            result = self.local_tools[func_name](func_args, on_action, namespace)
+            if asyncio.iscoroutine(result):
+                result = await result
+        elif func_name in self._function_to_server_map:
+            on_action(f"Вызываю MCP: {func_name}...")
+            server_name = self._function_to_server_map[func_name]
+            async with self._slot(server_name):
+                result = await self.mcp_servers[server_name].call(func_name, func_args, self._fixed_params(server_name, namespace))
+        else:
+            result = self._tool_not_found(func_name)
+        return result, self._log_tool_time(tool_call, started)
+
+    async def _execute_batch(self, server_name: str, tool_calls: list, on_action, namespace: str = None) -> list:
+        """Выполняет несколько вызовов одного MCP-сервера одним пакетом."""
+        started = time.perf_counter()
+        outcomes, calls, positions = self._batch_calls(tool_calls)
+        if not calls:
+            return outcomes
+        on_action(f"Вызываю MCP: {', '.join(name for name, _ in calls)}...")
+        async with self._slot(server_name):
+            results = await self.mcp_servers[server_name].call_batch(calls, self._fixed_params(server_name, namespace))
+        return self._batch_outcomes(server_name, outcomes, positions, results, started)
+
+    async def _run_task(self, server_name, tool_calls, on_action, namespace: str = None) -> list:
+        if server_name is None or len(tool_calls) == 1:
+            return [await self._execute_tool_call(tool_call, on_action, namespace) for tool_call in tool_calls]
+        return await self._execute_batch(server_name, tool_calls, on_action, namespace)
+
+    async def _run_tool_calls(self, tool_calls, on_action, namespace: str = None) -> list:
+        """Выполняет вызовы одного хода; результаты - в исходном порядке tool_calls."""
+        started = time.perf_counter()
+        tasks = self._plan_tasks(tool_calls)
+        if self.parallel_tool_calls and len(tasks) > 1:
+            task_outcomes = await asyncio.gather(*(self._run_task(server_name, calls, on_action, namespace) for server_name, calls, _ in tasks))
+        else:
+            task_outcomes = [await self._run_task(server_name, calls, on_action, namespace) for server_name, calls, _ in tasks]
+        return self._collect_outcomes(tool_calls, tasks, task_outcomes, started)
+
+    async def _complete(self, messages: list, tools: list, on_token, **kwargs):
+        """Один запрос к LLM. Возвращает (текст, список tool_calls, сообщение для истории)."""
+        if not self.streaming:
+            response = await self.client.chat.completions.create(
+                model=self.model, messages=messages, tools=tools, tool_choice="auto", **kwargs
+            )
+            message_obj = response.choices[0].message
+            return message_obj.content, message_obj.tool_calls or [], json.loads(message_obj.model_dump_json(exclude_none=True))
+
+        started = time.perf_counter()
+        stream = await self.client.chat.completions.create(
+            model=self.model, messages=messages, tools=tools, tool_choice="auto", stream=True, **kwargs
+        )
+        assembler = ToolCallAssembler()
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if not assembler.content_parts:
+                    logging.info(f"Первый токен ответа через {(time.perf_counter() - started) * 1000:.0f} мс.")
+                assembler.add_content(delta.content)
+                on_token(delta.content)
+            assembler.add_tool_call_deltas(delta.tool_calls)
+        logging.info(f"Ответ модели получен потоком за {(time.perf_counter() - started) * 1000:.0f} мс.")
+        return assembler.build()
+
+    async def call_ai(self, history: list, on_action=None, on_token=None, on_stream_reset=None, run_budget=None,
+                      memory_namespace: str = None, **kwargs) -> str:
+        """
+        Основной цикл работы агента для одной сессии.
+        :param on_action: Колбэк статуса (строка), аналог сигнала action_started.
+        :param on_token: Колбэк фрагмента текста ответа в потоковом режиме.
+        :param on_stream_reset: Колбэк сброса показанного текста, ставшего преамбулой к инструментам.
+        :param run_budget: Необязательный RunBudget (бюджет токенов и времени, см. sub_agents.py).
+        :param memory_namespace: Пространство имен памяти сессии; по умолчанию - агента.
+        """
+        namespace = memory_namespace or self.memory_namespace
+        on_action = on_action or (lambda text: None)
+        on_token = on_token or (lambda text: None)
+        on_stream_reset = on_stream_reset or (lambda: None)
+
+        # Логика хода общая с синхронным агентом (AgentCore._agent_turns), здесь - только ожидание запросов
+        turns = self._agent_turns(history, run_budget, on_action, on_stream_reset)
+        try:
+            request = next(turns)
+            while True:
+                if request[0] == "complete":
+                    reply = await self._complete(request[1], request[2], on_token, **kwargs)
+                else:
+                    reply = await self._run_tool_calls(request[1], on_action, namespace)
+                request = turns.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    async def aclose(self):
+        """Закрывает HTTP-клиенты MCP-серверов (и суб-агентов) и отписывается от реестра схем."""
+        self._schema_registry.unsubscribe(self._on_schema_changed)
+        if self.sub_agents is not None:
+            await asyncio.gather(*(agent.aclose() for agent in self.sub_agents.agents()))
+        await asyncio.gather(*(server.aclose() for server in self.mcp_servers.values()))
+
+
+class AsyncAgentTask(QtCore.QObject):
+    """Сессия агента, запущенная через AsyncAgentBridge. Сигналы совпадают с AIWorker."""
+    finished = QtCore.pyqtSignal(str)
+    error = QtCore.pyqtSignal(str)
+    action_update = QtCore.pyqtSignal(str)
+    token_update = QtCore.pyqtSignal(str)
+    stream_reset = QtCore.pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.future = None
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+
+class AsyncAgentBridge(QtCore.QObject):
+    """
+    Мост между Qt и asyncio: один цикл событий в фоновом потоке на весь процесс.
+    Сигналы задач испускаются из потока цикла и доставляются в GUI через очередь Qt.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="agent-asyncio", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, agent: AsyncAIWithMCPInterface, history: list, **kwargs) -> AsyncAgentTask:
+        """Запускает call_ai агента в цикле событий и возвращает объект задачи с сигналами."""
+        task = AsyncAgentTask()
+
+        async def run():
+            try:
+                reply = await agent.call_ai(
+                    history,
+                    on_action=task.action_update.emit,
+                    on_token=task.token_update.emit,
+                    on_stream_reset=task.stream_reset.emit,
+                    **kwargs
+                )
+                task.finished.emit(reply)
+            except asyncio.CancelledError:
+                task.error.emit("Запрос отменен.")
+                raise
+            except Exception as e:
+                logging.error(f"Критическая ошибка: {e}", exc_info=True)
+                task.error.emit(str(e))
+
+        task.future = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        return task
+
+    def run(self, coro):
+        """Выполняет корутину в цикле моста и блокирующе ждет результат (для инициализации и завершения)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def shutdown(self, agents=()):
+        """Закрывает клиентов агентов и останавливает цикл событий."""
+        for agent in agents:
+            try:
+                self.run(agent.aclose())
+            except Exception as e:
+                logging.warning(f"Ошибка при закрытии асинхронного агента: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
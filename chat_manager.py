@@ -14,6 +14,10 @@ class ChatManager:
         """Генерирует уникальный ID на основе текущего времени."""
         return str(int(time.time() * 1000))
 
+    def new_chat_id(self):
+        """ID для еще не сохраненного чата (передается в save_chat при первом сохранении)."""
+        return self._generate_id()
+
     def get_chats(self):
         """Сканирует директорию и возвращает список чатов (id, title), отсортированных по дате."""
         chats = []
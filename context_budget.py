@@ -0,0 +1,188 @@
+# context_budget.py
+"""
+Бюджет контекстного окна для цикла агента.
+
+call_ai на каждой итерации отправляет модели системный промпт, всю историю чата и все
+результаты инструментов. ContextBudgeter готовит из этой истории компактную копию для запроса:
+последние обмены остаются дословно, в более старых обрезаются большие результаты инструментов
+и удаляются base64-картинки, а если бюджет все равно превышен - отбрасываются самые старые обмены
+(но не текущий вопрос пользователя: вместо этого сильнее обрезаются результаты инструментов текущего хода).
+Исходный список сообщений не изменяется.
+"""
+
+import os
+
+# Размер контекстного окна (в токенах) по префиксу имени модели, без провайдера ("openai/gpt-4o" -> "gpt-4o").
+# Более длинные префиксы проверяются раньше.
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4.1": 1_000_000,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+    "o1": 200_000,
+    "o3": 200_000,
+    "o4": 200_000,
+    "claude": 200_000,
+    "gemini": 1_000_000,
+    "llama": 128_000,
+    "mistral": 32_000,
+    "deepseek": 64_000,
+    "qwen": 32_000,
+}
+DEFAULT_CONTEXT_TOKENS = 32_000
+
+# Доля окна, отдаваемая под историю; остальное - схемы инструментов и ответ модели
+HISTORY_SHARE = 0.6
+# Грубая оценка: символов на токен (для смеси русского и английского текста с JSON)
+CHARS_PER_TOKEN = 3
+# Оценка стоимости одного изображения в токенах
+IMAGE_TOKENS = 1000
+# Короче этого результаты инструментов не обрезаются даже при нехватке бюджета
+MIN_TOOL_RESULT_CHARS = 200
+
+
+def context_window(model: str) -> int:
+    """Размер контекстного окна модели по таблице MODEL_CONTEXT_TOKENS."""
+    name = model.split("/")[-1].lower()
+    for prefix in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if name.startswith(prefix):
+            return MODEL_CONTEXT_TOKENS[prefix]
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def estimate_tokens(message: dict) -> int:
+    """Приблизительное число токенов в сообщении (картинки считаются фиксированной стоимостью)."""
+    chars = 0
+    images = 0
+    content = message.get("content")
+    if isinstance(content, str):
+        chars += len(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text", ""))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        chars += len(function.get("name", "")) + len(function.get("arguments", ""))
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS + 4
+
+
+def _truncate_text(text: str, limit: int) -> str:
+    """Оставляет начало и конец длинного текста, середину заменяет пометкой."""
+    if len(text) <= limit:
+        return text
+    head = limit * 2 // 3
+    tail = limit - head
+    return f"{text[:head]}\n...[обрезано {len(text) - limit} символов из истории]...\n{text[-tail:]}"
+
+
+class ContextBudgeter:
+    """Готовит компактную копию истории сообщений под бюджет токенов модели."""
+
+    def __init__(self, model: str):
+        self.model = model
+        budget = os.getenv("AGENT_CONTEXT_BUDGET")
+        self.budget = int(budget) if budget else int(context_window(model) * HISTORY_SHARE)
+        # Сколько последних обменов (реплика пользователя или ход ассистента с результатами инструментов)
+        # отправляется дословно
+        self.keep_recent = int(os.getenv("AGENT_CONTEXT_KEEP_RECENT", "4"))
+        # Максимальная длина старого результата инструмента, символов
+        self.tool_result_chars = int(os.getenv("AGENT_CONTEXT_TOOL_RESULT_CHARS", "1500"))
+
+    def _exchanges(self, messages: list) -> list:
+        """
+        Делит историю (без системного промпта) на обмены: списки индексов, которые можно
+        сжимать или отбрасывать только целиком (ход ассистента вместе с ответами инструментов).
+        """
+        exchanges = []
+        for index, message in enumerate(messages):
+            if message.get("role") == "tool" and exchanges:
+                exchanges[-1].append(index)
+            else:
+                exchanges.append([index])
+        return exchanges
+
+    def _compact_message(self, message: dict, tool_result_chars: int = None) -> dict:
+        """Сжатая копия старого сообщения: без base64-картинок и с обрезанным результатом инструмента."""
+        content = message.get("content")
+        limit = tool_result_chars or self.tool_result_chars
+        if message.get("role") == "tool" and isinstance(content, str) and len(content) > limit:
+            return {**message, "content": _truncate_text(content, limit)}
+        if isinstance(content, list) and any(
+            part.get("type") == "image_url" and part.get("image_url", {}).get("url", "").startswith("data:")
+            for part in content
+        ):
+            parts = []
+            for part in content:
+                if part.get("type") == "image_url" and part.get("image_url", {}).get("url", "").startswith("data:"):
+                    parts.append({"type": "text", "text": "[изображение из ранней части диалога удалено]"})
+                else:
+                    parts.append(part)
+            return {**message, "content": parts}
+        return message
+
+    def compact(self, messages: list):
+        """
+        Возвращает (сообщения для запроса, отчет). Отчет: токены до/после и сколько сэкономлено.
+        Первый системный промпт сохраняется всегда.
+        """
+        system = messages[:1] if messages and messages[0].get("role") == "system" else []
+        body = messages[len(system):]
+        tokens_before = sum(estimate_tokens(m) for m in messages)
+
+        exchanges = self._exchanges(body)
+        recent_from = max(len(exchanges) - self.keep_recent, 0)
+
+        # 1. Старые обмены сжимаются, последние остаются дословно
+        compacted = []
+        for number, exchange in enumerate(exchanges):
+            if number < recent_from:
+                compacted.append([self._compact_message(body[i]) for i in exchange])
+            else:
+                compacted.append([body[i] for i in exchange])
+
+        # 2. Если бюджет все еще превышен - отбрасываем самые старые обмены. Текущий вопрос пользователя
+        # (последняя его реплика) и все, что после него, не отбрасываются никогда
+        system_tokens = sum(estimate_tokens(m) for m in system)
+        sizes = [sum(estimate_tokens(m) for m in exchange) for exchange in compacted]
+        total = system_tokens + sum(sizes)
+        user_exchanges = [number for number, exchange in enumerate(compacted) if exchange[0].get("role") == "user"]
+        droppable = min(recent_from, user_exchanges[-1]) if user_exchanges else recent_from
+        dropped = 0
+        while total > self.budget and dropped < droppable:
+            total -= sizes[dropped]
+            dropped += 1
+        # Разговор не может начинаться с ответа инструмента или хода ассистента без реплики пользователя
+        while 0 < dropped < len(compacted) - 1 and compacted[dropped][0].get("role") != "user":
+            total -= sizes[dropped]
+            dropped += 1
+
+        # 3. Крайний случай: оставшиеся обмены (например, длинный текущий ход) сами не помещаются - обрезаем
+        # их результаты инструментов, кроме результатов последнего хода, с которыми модель работает сейчас
+        kept = compacted[dropped:]
+        if total > self.budget:
+            older = [(exchange, position) for exchange in kept[:-1]
+                     for position, message in enumerate(exchange) if message.get("role") == "tool"]
+            for exchange, position in older:
+                exchange[position] = self._compact_message(exchange[position])
+            total = system_tokens + sum(estimate_tokens(m) for exchange in kept for m in exchange)
+            if total > self.budget and older:
+                # Все еще не помещается - делим оставшееся место поровну между этими результатами
+                chars = sum(len(exchange[position].get("content") or "") for exchange, position in older)
+                limit = max((chars - (total - self.budget) * CHARS_PER_TOKEN) // len(older), MIN_TOOL_RESULT_CHARS)
+                for exchange, position in older:
+                    exchange[position] = self._compact_message(exchange[position], limit)
+
+        result = system + [message for exchange in kept for message in exchange]
+        tokens_after = sum(estimate_tokens(m) for m in result)
+        report = {
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": tokens_before - tokens_after,
+            "dropped_messages": len(body) - (len(result) - len(system)),
+            "budget": self.budget,
+        }
+        return result, report
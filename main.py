@@ -4,38 +4,36 @@ import os
 import sys
 import requests
 import logging
-import time
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from PyQt5 import QtWidgets
 
 from UI import MainWindow
 from ai_interface import AIWithMCPInterface
+from ai_interface_async import AsyncAIWithMCPInterface, AsyncAgentBridge
 from mcp_registry import MCP_REGISTRY
+from mcp_schema_registry import get_schema_registry
+from sub_agents import available_sub_agents
 
 def wait_for_mcp_servers(servers_to_check, timeout=30):
     """
     Ожидает, пока все MCP-серверы из списка не станут доступны.
-    Пингует их эндпоинт /functions.
+    Все серверы опрашиваются одновременно через реестр схем: ответ /functions
+    сразу попадает в кэш, и агенту не нужно запрашивать его повторно.
+    Если схемы всех серверов уже есть в кэше, ожидание не блокирует запуск GUI:
+    проверка готовности и актуальности схем идет в фоне.
     """
-    print("[MAIN] Ожидаем готовности MCP-серверов...")
-    start_time = time.time()
-    
-    ready_servers = set()
+    registry = get_schema_registry()
+    if registry.has_all(servers_to_check):
+        print("[MAIN] Схемы всех MCP найдены в кэше, проверка серверов продолжится в фоне.")
+        registry.revalidate_in_background(servers_to_check, timeout)
+        return
 
-    while len(ready_servers) < len(servers_to_check) and time.time() - start_time < timeout:
-        for name, url in servers_to_check.items():
-            if name in ready_servers:
-                continue
-            try:
-                resp = requests.get(f"{url}/functions", timeout=1)
-                if resp.status_code == 200:
-                    print(f"  ✓ MCP '{name}' готов.")
-                    ready_servers.add(name)
-            except requests.exceptions.RequestException:
-                pass
-        time.sleep(0.5)
+    print("[MAIN] Ожидаем готовности MCP-серверов...")
+    ready_servers = registry.fetch_all(servers_to_check, timeout)
+    for name in ready_servers:
+        print(f"  ✓ MCP '{name}' готов.")
 
     if len(ready_servers) < len(servers_to_check):
         unready = set(servers_to_check.keys()) - ready_servers
@@ -100,20 +98,47 @@ def main():
     # Создаем список MCP, которые Оркестратор может использовать НАПРЯМУЮ.
     # Он не должен видеть 'rpg', чтобы быть вынужденным его делегировать.
     print(f"[MAIN] Оркестратору разрешены следующие MCP: {active_mcp_keys }")
+    # Суб-агенты, для которых запущены все нужные им MCP, доступны через delegate_tasks
+    sub_agent_names = available_sub_agents(active_mcp_keys)
+    print(f"[MAIN] Суб-агенты для делегирования: {sub_agent_names}")
 
-    ai_iface = AIWithMCPInterface(
-        client=client,
-        prompt_path="prompts/orchestrator_prompt.txt",
-        all_mcp_servers=servers_to_check,
-        allowed_mcp_filter=active_mcp_keys  # <-- ПРИМЕНЯЕМ ФИЛЬТР
-    )
-    print("[MAIN] Оркестратор готов.")
+    # MEMORY_NAMESPACE: пространство имен семантической памяти оркестратора и суб-агентов;
+    # "chat" - своя память у каждого чата (пространство выбирает окно чата перед отправкой запроса)
+    memory_namespace = os.getenv("MEMORY_NAMESPACE") or None
+    if memory_namespace == "chat":
+        memory_namespace = None
+
+    # AGENT_ASYNC=1: асинхронное ядро - все сессии в одном цикле asyncio вместо потока на запрос
+    use_async = os.getenv("AGENT_ASYNC", "0") == "1"
+    if use_async:
+        ai_iface = AsyncAIWithMCPInterface(
+            client=AsyncOpenAI(api_key=API_KEY, base_url=API_BASE),
+            prompt_path="prompts/orchestrator_prompt.txt",
+            all_mcp_servers=servers_to_check,
+            allowed_mcp_filter=active_mcp_keys,
+            sub_agent_names=sub_agent_names,
+            memory_namespace=memory_namespace
+        )
+    else:
+        ai_iface = AIWithMCPInterface(
+            client=client,
+            prompt_path="prompts/orchestrator_prompt.txt",
+            all_mcp_servers=servers_to_check,
+            allowed_mcp_filter=active_mcp_keys,  # <-- ПРИМЕНЯЕМ ФИЛЬТР
+            sub_agent_names=sub_agent_names,
+            memory_namespace=memory_namespace
+        )
+    print(f"[MAIN] Оркестратор готов{' (асинхронное ядро)' if use_async else ''}.")
     
     # --- ЗАПУСК GUI ---
     app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow(ai_iface=ai_iface, models=models)
+    ai_bridge = AsyncAgentBridge() if use_async else None
+    window = MainWindow(ai_iface=ai_iface, models=models, ai_bridge=ai_bridge)
     window.show()
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    if ai_bridge is not None:
+        ai_bridge.shutdown([ai_iface])
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -6,6 +6,8 @@ import pyperclip # Наша новая библиотека
 from flask import Flask, request, jsonify
 from waitress import serve
 
+from mcp_jsonrpc import handle_payload, functions_response
+
 app = Flask(__name__)
 
 # --- Описания функций для ИИ ---
@@ -35,8 +37,6 @@ CLIPBOARD_FUNCTIONS = [
 class JsonRpcError(Exception):
     def __init__(self, code, message): self.code, self.message = code, message
 
-def make_error_response(id_, code, message): return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-def make_success_response(id_, result): return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
 
 # --- Реализация методов ---
 def get_clipboard_content(params):
@@ -67,18 +67,14 @@ METHODS = {
 
 # --- Эндпоинты Flask (стандартные) ---
 @app.route("/functions")
-def get_functions_route(): return jsonify(CLIPBOARD_FUNCTIONS)
+def get_functions_route(): return functions_response(CLIPBOARD_FUNCTIONS)
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    try:
-        req = request.get_json(force=True)
-        result = METHODS[req['method']](req.get('params', {}))
-        return make_success_response(req['id'], result)
-    except Exception as e:
-        code = e.code if isinstance(e, JsonRpcError) else -32603
-        msg = e.message if isinstance(e, JsonRpcError) else str(e)
-        return make_error_response(req.get('id'), code, msg), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
+
 
 if __name__ == "__main__":
     port = int(os.getenv("MCP_CLIPBOARD_PORT", 8004))
@@ -1,19 +1,77 @@
 # mcp_files.py
 import os
+import re
 import json
+import mmap
+import time
+import bisect
+import fnmatch
+import itertools
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from waitress import serve
 
+from mcp_jsonrpc import handle_payload, functions_response
+
 # ИЗМЕНЕНО: Убираем threading. Вместо него используем простые глобальные переменные.
 _BASE_DIR = None
 _BASE_DIR_INITIALIZED = False
 
+# Чтение по частям: сколько байт read_file возвращает за вызов по умолчанию и не больше какого предела.
+# Файлы от MCP_FILES_MMAP_THRESHOLD байт не читаются в память целиком, а отображаются через mmap.
+READ_DEFAULT_BYTES = 32 * 1024
+READ_MAX_BYTES = int(os.getenv("MCP_FILES_READ_MAX_BYTES", 1024 * 1024))
+MMAP_THRESHOLD = int(os.getenv("MCP_FILES_MMAP_THRESHOLD", 1024 * 1024))
+# По скольким первым байтам файл проверяется на двоичность
+BINARY_SNIFF_BYTES = 8192
+# Поиск по содержимому: совпадений на страницу по умолчанию / предел, строк контекста, длина строки в ответе.
+# Файлы читаются кусками по SEARCH_CHUNK_BYTES, поэтому память не зависит от размера файла.
+SEARCH_DEFAULT_RESULTS = 50
+SEARCH_MAX_RESULTS = 500
+SEARCH_MAX_CONTEXT = 5
+SEARCH_LINE_CHARS = 300
+SEARCH_CHUNK_BYTES = 4 * 1024 * 1024
+SEARCH_SKIP_DIRS = {".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", "venv"}
+SEARCH_WORKERS = int(os.getenv("MCP_FILES_SEARCH_WORKERS", "8"))
+# Потоки пула создаются по мере надобности; чтение файлов отпускает GIL, поэтому файлы сканируются параллельно
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="files-search")
+# Постоянный индекс рабочей папки в SQLite: пути, размеры, mtime, хэши содержимого и обратный индекс слов (FTS5).
+# Свежесть поддерживается опросом mtime раз в MCP_FILES_INDEX_INTERVAL секунд и сразу после write_file/delete_file.
+# Слова файлов больше MCP_FILES_INDEX_MAX_FILE_BYTES не индексируются. Отключается через MCP_FILES_INDEX=0.
+INDEX_FILE = "mcp_files_index.db"
+INDEX_MAX_FILE_BYTES = int(os.getenv("MCP_FILES_INDEX_MAX_FILE_BYTES", 2 * 1024 * 1024))
+INDEX_BATCH = 200
+TOKEN_RE = re.compile(r"\w+")
+FIND_DEFAULT_RESULTS = 200
+FIND_MAX_RESULTS = 2000
+# Рекурсивный список: глубина по умолчанию / предел, записей на страницу по умолчанию / предел
+LIST_DEFAULT_DEPTH = 2
+LIST_MAX_DEPTH = 20
+LIST_DEFAULT_ENTRIES = 200
+LIST_MAX_ENTRIES = 2000
+LIST_COLUMNS = ["path", "type", "size", "mtime"]
+# Временные файлы атомарной записи и загрузок частями (.<имя>.mcp-<случайное>.tmp/.upload) лежат рядом с целевым,
+# чтобы os.replace не пересекал файловые системы; list_dir, list_tree, поиск и индекс их не показывают
+TEMP_FILE_MARKER = ".mcp-"
+TEMP_FILE_RE = re.compile(r"^\..+\.mcp-[a-z0-9_]+\.(tmp|upload)$")
+_FILE_INDEX = None
+_FILE_INDEX_LOCK = threading.Lock()
+
 app = Flask(__name__)
 # --- Описания функций и класс ошибки (без изменений) ---
 FILE_FUNCTIONS = [
     {
         "name": "list_dir",
-        "description": "Список файлов и папок в директории. Всегда используй эту функцию, чтобы проверить наличие файлов, прежде чем пытаться их прочитать.",
+        "cache": {"ttl": 30},
+        "description": "Список имен файлов и папок в директории. Всегда используй эту функцию (или list_tree для подпапок, типов и размеров), чтобы проверить наличие файлов, прежде чем пытаться их прочитать.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -22,27 +80,178 @@ FILE_FUNCTIONS = [
             "required": ["path"]
         }
     },
+    {
+        "name": "list_tree",
+        "cache": {"ttl": 30},
+        "description": (
+            "Дерево папки за один вызов: файлы и подпапки до заданной глубины с типом, размером и временем изменения. "
+            "Записи - массивы в порядке columns; папка идет перед своим содержимым. Содержимое служебных папок (.git, node_modules, ...) "
+            "не раскрывается. Если записей больше, чем поместилось, передай next_cursor в cursor."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Папка относительно рабочей папки (по умолчанию '.')."},
+                "depth": {"type": "integer", "description": f"Глубина: 1 - только содержимое папки (по умолчанию {LIST_DEFAULT_DEPTH}, не больше {LIST_MAX_DEPTH})."},
+                "glob": {"type": "string", "description": "Показывать только файлы с подходящим именем, например '*.py' (папки тогда не выводятся)."},
+                "sort": {"type": "string", "enum": ["name", "size", "mtime"], "description": "Порядок внутри папки: name (папки сначала, по умолчанию), size или mtime (большие/новые сначала)."},
+                "max_results": {"type": "integer", "description": f"Записей на страницу (по умолчанию {LIST_DEFAULT_ENTRIES}, не больше {LIST_MAX_ENTRIES})."},
+                "cursor": {"type": "string", "description": "next_cursor из предыдущего ответа для продолжения."}
+            }
+        }
+    },
     {
         "name": "read_file",
-        "description": "Прочитать текстовый файл. Убедись, что файл существует, с помощью list_dir, прежде чем вызывать эту функцию.",
+        "cache": {"ttl": 30},
+        "description": (
+            "Прочитать текстовый файл целиком или по частям. Ответ содержит size (размер файла в байтах), content и, если файл прочитан "
+            "не до конца, next_offset / next_line для следующего вызова. Большие файлы читай по частям: head/tail для начала и конца, "
+            "start_line+line_count для строк, offset+length для байтов. Убедись, что файл существует, с помощью list_dir."
+        ),
         "parameters": {
             "type": "object",
-            "properties": {"path": {"type": "string", "description": "Полный путь к файлу относительно рабочей папки."}},
+            "properties": {
+                "path": {"type": "string", "description": "Полный путь к файлу относительно рабочей папки."},
+                "offset": {"type": "integer", "description": "С какого байта читать (по умолчанию 0)."},
+                "length": {"type": "integer", "description": "Сколько байт прочитать, начиная с offset."},
+                "start_line": {"type": "integer", "description": "С какой строки читать (нумерация с 1)."},
+                "line_count": {"type": "integer", "description": "Сколько строк прочитать, начиная с start_line."},
+                "head": {"type": "integer", "description": "Прочитать первые N строк."},
+                "tail": {"type": "integer", "description": "Прочитать последние N строк."},
+                "max_bytes": {"type": "integer", "description": f"Предел размера ответа в байтах (по умолчанию {READ_DEFAULT_BYTES})."}
+            },
             "required": ["path"]
         }
     },
+    {
+        "name": "search_files",
+        "cache": {"ttl": 30},
+        "description": (
+            "Найти текст во всех файлах рабочей папки (или подпапки) за один вызов, как grep: возвращает файл, номер строки, "
+            "строку и, по желанию, строки контекста. Двоичные файлы пропускаются. Если совпадений больше, чем поместилось, "
+            "ответ содержит next_cursor - передай его в cursor для следующей страницы."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "Искомый текст или регулярное выражение (при regex=true)."},
+                "regex": {"type": "boolean", "description": "Считать query регулярным выражением Python. По умолчанию false."},
+                "case_sensitive": {"type": "boolean", "description": "Учитывать регистр. По умолчанию false."},
+                "path": {"type": "string", "description": "Папка поиска относительно рабочей папки (по умолчанию '.')."},
+                "glob": {"type": "string", "description": "Только файлы с подходящим именем, например '*.py' или 'logs/*.log'."},
+                "context": {"type": "integer", "description": f"Сколько строк до и после совпадения показать (0-{SEARCH_MAX_CONTEXT}, по умолчанию 0)."},
+                "max_results": {"type": "integer", "description": f"Совпадений на страницу (по умолчанию {SEARCH_DEFAULT_RESULTS}, не больше {SEARCH_MAX_RESULTS})."},
+                "max_bytes": {"type": "integer", "description": f"Предел размера страницы в байтах (по умолчанию {READ_DEFAULT_BYTES})."},
+                "cursor": {"type": "string", "description": "next_cursor из предыдущего ответа для продолжения."}
+            },
+            "required": ["query"]
+        }
+    },
+    {
+        "name": "find_files",
+        "cache": {"ttl": 30},
+        "description": (
+            "Быстро найти файлы по индексу рабочей папки, не обходя диск: рекурсивный список всех файлов папки, поиск по имени "
+            "и по словам в содержимом. Возвращает path, size и mtime. Для поиска фразы с номерами строк используй search_files."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Папка относительно рабочей папки (по умолчанию '.' - вся папка)."},
+                "name": {"type": "string", "description": "Часть имени файла или шаблон, например 'config' или '*.py'."},
+                "words": {"type": "string", "description": "Слова, которые все должны встречаться в файле, например 'retry timeout'."},
+                "max_results": {"type": "integer", "description": f"Файлов на страницу (по умолчанию {FIND_DEFAULT_RESULTS}, не больше {FIND_MAX_RESULTS})."},
+                "cursor": {"type": "string", "description": "next_cursor из предыдущего ответа для продолжения."}
+            }
+        }
+    },
     {
         "name": "write_file",
-        "description": "Записать КОРОТКИЙ текст в файл. Если файл существует, он будет перезаписан. Если нет - создан. Не используй эту функцию для сохранения больших объемов данных.",
+        "description": (
+            "Записать текст в файл целиком (файл создается или перезаписывается; запись атомарная - при сбое старое содержимое "
+            "сохраняется). Для дописывания используй append_file, для правки части файла - edit_file, "
+            "для очень большого содержимого - start_upload/upload_chunk/finish_upload."
+        ),
         "parameters": {
             "type": "object",
             "properties": {
                 "path": {"type": "string", "description": "Путь к файлу."},
-                "content": {"type": "string", "description": "Краткое текстовое содержимое для записи."}
+                "content": {"type": "string", "description": "Текстовое содержимое для записи."}
             },
             "required": ["path", "content"]
         }
     },
+    {
+        "name": "append_file",
+        "description": "Дописать текст в конец файла (файл создается, если его нет). Позволяет строить большой файл по частям, не пересылая написанное.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Путь к файлу."},
+                "content": {"type": "string", "description": "Текст, который нужно дописать."}
+            },
+            "required": ["path", "content"]
+        }
+    },
+    {
+        "name": "edit_file",
+        "description": (
+            "Изменить часть файла, не переписывая его целиком. Замена текста: old_text -> new_text (old_text должен встречаться "
+            "ровно один раз, иначе укажи replace_all=true). Замена по позиции: offset (байт, как в read_file), length байт "
+            "заменяются на new_text (length=0 - вставка). Запись атомарная."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Путь к файлу."},
+                "old_text": {"type": "string", "description": "Заменяемый фрагмент текста."},
+                "new_text": {"type": "string", "description": "Новый текст (пустая строка - удалить фрагмент)."},
+                "replace_all": {"type": "boolean", "description": "Заменить все вхождения old_text. По умолчанию false."},
+                "offset": {"type": "integer", "description": "Байтовая позиция начала замены (вместо old_text)."},
+                "length": {"type": "integer", "description": "Сколько байт заменить начиная с offset (по умолчанию 0)."}
+            },
+            "required": ["path", "new_text"]
+        }
+    },
+    {
+        "name": "start_upload",
+        "invalidates": [],
+        "description": (
+            "Начать загрузку большого файла частями: возвращает upload_id. Затем вызывай upload_chunk с частями по порядку "
+            "и finish_upload - файл появится целиком и атомарно только после finish_upload."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {"path": {"type": "string", "description": "Путь к итоговому файлу."}},
+            "required": ["path"]
+        }
+    },
+    {
+        "name": "upload_chunk",
+        "invalidates": [],
+        "description": "Добавить очередную часть в загрузку upload_id. Ответ содержит received - сколько байт уже получено.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "upload_id": {"type": "string", "description": "Идентификатор из start_upload."},
+                "content": {"type": "string", "description": "Очередная часть текста."},
+                "offset": {"type": "integer", "description": "Необязательно: ожидаемое число уже полученных байт (received); защищает от повтора или пропуска части."}
+            },
+            "required": ["upload_id", "content"]
+        }
+    },
+    {
+        "name": "finish_upload",
+        "description": "Завершить загрузку: собранный файл атомарно заменяет path. С cancel=true загрузка отменяется, файл не меняется.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "upload_id": {"type": "string", "description": "Идентификатор из start_upload."},
+                "cancel": {"type": "boolean", "description": "Отменить загрузку. По умолчанию false."}
+            },
+            "required": ["upload_id"]
+        }
+    },
     {
         "name": "delete_file",
         "description": "Удалить файл из рабочей папки.",
@@ -93,12 +302,6 @@ def _get_safe_path(path: str) -> str:
         raise JsonRpcError(-32001, f"Access denied: Path is outside of the allowed workspace.")
     return requested_path
 
-# ... Функции make_error_response и make_success_response без изменений ...
-def make_error_response(id_, code, message):
-    return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-
-def make_success_response(id_, result):
-    return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
 
 
 # --- Реализация методов (без изменений в логике, но теперь они вызывают _get_safe_path) ---
@@ -108,35 +311,956 @@ def list_dir(params):
     if not os.path.isdir(safe_path):
         raise JsonRpcError(-32602, f"Path is not a valid directory: {path_param}")
     try:
-        items = os.listdir(safe_path)
+        items = [name for name in os.listdir(safe_path) if not TEMP_FILE_RE.match(name)]
         return items
     except Exception as e:
         raise JsonRpcError(-32000, f"Error listing directory: {str(e)}")
 
+def _tree_entries(directory: str, depth: int, glob, sort: str):
+    """
+    Обход дерева через os.scandir в глубину: (относительный путь, тип, размер, mtime) - папка перед своим содержимым.
+    Внутри папки записи упорядочены по sort; ссылки не раскрываются, служебные папки выводятся, но не обходятся.
+    """
+    base_dir = get_base_dir()
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    items = []
+    for entry in entries:
+        if TEMP_FILE_RE.match(entry.name):
+            continue
+        try:
+            if entry.is_symlink():
+                kind, stat = "link", entry.stat(follow_symlinks=False)
+            elif entry.is_dir():
+                kind, stat = "dir", entry.stat()
+            else:
+                kind, stat = "file", entry.stat()
+        except OSError:
+            continue
+        items.append((entry, kind, stat.st_size, stat.st_mtime_ns))
+    if sort == "size":
+        items.sort(key=lambda item: (-item[2], item[0].name))
+    elif sort == "mtime":
+        items.sort(key=lambda item: (-item[3], item[0].name))
+    else:
+        items.sort(key=lambda item: (item[1] != "dir", item[0].name.lower(), item[0].name))
+    for entry, kind, size, mtime_ns in items:
+        rel_path = os.path.relpath(entry.path, base_dir).replace(os.sep, "/")
+        if not glob or (kind != "dir" and fnmatch.fnmatch(rel_path if "/" in glob else entry.name, glob)):
+            yield rel_path, kind, None if kind == "dir" else size, int(mtime_ns // 1_000_000_000)
+        if kind == "dir" and depth > 1 and entry.name not in SEARCH_SKIP_DIRS:
+            yield from _tree_entries(entry.path, depth - 1, glob, sort)
+
+
+def list_tree(params):
+    """
+    Рекурсивный список папки с типами, размерами и временем изменения. Записи отдаются компактными массивами
+    (порядок полей - columns); next_cursor - номер следующей записи обхода.
+    """
+    path_param = params.get("path") or "."
+    safe_path = _get_safe_path(path_param)
+    if not os.path.isdir(safe_path):
+        raise JsonRpcError(-32602, f"Path is not a valid directory: {path_param}")
+    depth = min(_int_param(params, "depth", 1) or LIST_DEFAULT_DEPTH, LIST_MAX_DEPTH)
+    limit = min(_int_param(params, "max_results", 1) or LIST_DEFAULT_ENTRIES, LIST_MAX_ENTRIES)
+    sort = params.get("sort") or "name"
+    if sort not in ("name", "size", "mtime"):
+        raise JsonRpcError(-32602, f"Unknown sort: {sort}. Use name, size or mtime.")
+    start = 0
+    if params.get("cursor"):
+        if not str(params["cursor"]).isdigit():
+            raise JsonRpcError(-32602, "Invalid cursor.")
+        start = int(params["cursor"])
+    try:
+        walker = _tree_entries(safe_path, depth, params.get("glob"), sort)
+        page = list(itertools.islice(walker, start, start + limit + 1))
+    except Exception as e:
+        raise JsonRpcError(-32000, f"Error listing directory: {str(e)}")
+    response = {"path": path_param, "columns": LIST_COLUMNS, "entries": [list(entry) for entry in page[:limit]]}
+    if len(page) > limit:
+        response["next_cursor"] = str(start + limit)
+    return response
+
+def _int_param(params, name: str, minimum: int = 0):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise JsonRpcError(-32602, f"Param '{name}' must be an integer.")
+    if value < minimum:
+        raise JsonRpcError(-32602, f"Param '{name}' must be >= {minimum}.")
+    return value
+
+
+@contextmanager
+def _file_data(path: str, size: int):
+    """
+    Содержимое файла как bytes-подобный объект (срезы, find, rfind): небольшие файлы читаются целиком,
+    большие отображаются через mmap - в память попадают только прочитанные страницы.
+    """
+    with open(path, "rb") as f:
+        if size < MMAP_THRESHOLD:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _char_start(data, pos: int, size: int) -> int:
+    """Сдвигает позицию вперед на начало символа UTF-8 (не больше чем на 3 байта продолжения)."""
+    for _ in range(3):
+        if pos >= size or (data[pos] & 0xC0) != 0x80:
+            break
+        pos += 1
+    return pos
+
+
+def _char_end(data, pos: int, size: int) -> int:
+    """Сдвигает конец среза назад, чтобы не разрезать символ UTF-8."""
+    for _ in range(3):
+        if pos <= 0 or pos >= size or (data[pos] & 0xC0) != 0x80:
+            break
+        pos -= 1
+    return pos
+
+
+def _read_bytes(data, size: int, offset: int, length, max_bytes: int) -> dict:
+    start = _char_start(data, min(offset, size), size)
+    end = size if length is None else min(size, start + length)
+    truncated = end - start > max_bytes
+    if truncated:
+        end = start + max_bytes
+        # Предпочитаем обрезать по концу строки, если он есть во второй половине куска
+        newline = data.rfind(b"\n", start, end)
+        if newline >= start + max_bytes // 2:
+            end = newline + 1
+    if end > start:
+        end = _char_end(data, end, size)
+        # Предел меньше символа на позиции start: отдаем символ целиком, иначе чтение по next_offset не сдвинется
+        if end == start:
+            end = _char_start(data, start + 1, size)
+    result = {"offset": start, "length": end - start, "content": data[start:end]}
+    if truncated:
+        result["truncated"] = True
+    return result
+
+
+def _line_offset(data, size: int, line: int):
+    """Байтовое смещение начала строки line (с 1) или None, если в файле меньше строк."""
+    pos = 0
+    for _ in range(line - 1):
+        newline = data.find(b"\n", pos)
+        if newline == -1 or newline + 1 >= size:
+            return None
+        pos = newline + 1
+    return pos
+
+
+def _read_lines(data, size: int, start_line: int, line_count, max_bytes: int) -> dict:
+    start = _line_offset(data, size, start_line)
+    if start is None:
+        return {"offset": size, "length": 0, "content": b"", "start_line": start_line, "end_line": start_line - 1}
+    pos, lines, line_cut = start, 0, False
+    while pos < size and (line_count is None or lines < line_count):
+        newline = data.find(b"\n", pos)
+        line_end = size if newline == -1 else newline + 1
+        if line_end - start > max_bytes:
+            if lines == 0:
+                # Одна строка длиннее предела - отдаем ее начало
+                pos, line_cut = _char_end(data, start + max_bytes, size), True
+            break
+        pos, lines = line_end, lines + 1
+    result = {"offset": start, "length": pos - start, "content": data[start:pos], "start_line": start_line}
+    if line_cut:
+        result.update({"end_line": start_line, "line_truncated": True, "next_line": start_line + 1})
+    else:
+        result["end_line"] = start_line + lines - 1
+        if pos < size:
+            result["next_line"] = start_line + lines
+    return result
+
+
+def _read_tail(data, size: int, count: int, max_bytes: int) -> dict:
+    # Завершающий перевод строки не начинает новую (пустую) строку
+    begin, boundary = size, size - 1 if size and data[size - 1] == 0x0A else size
+    for _ in range(count):
+        newline = data.rfind(b"\n", 0, boundary)
+        if newline == -1:
+            begin = 0
+            break
+        begin, boundary = newline + 1, newline
+    result = {}
+    if size - begin > max_bytes:
+        begin = size - max_bytes
+        newline = data.find(b"\n", begin, begin + max_bytes // 2)
+        if newline != -1:
+            begin = newline + 1
+        result["truncated"] = True
+    begin = _char_start(data, begin, size)
+    result.update({"offset": begin, "length": size - begin, "content": data[begin:size]})
+    return result
+
+
 def read_file(params):
-    safe_path = _get_safe_path(params.get("path"))
+    """
+    Читает файл целиком или частью: байты (offset/length), строки (start_line/line_count, head) или конец (tail).
+    Ответ не больше max_bytes; next_offset/next_line указывают, откуда продолжить, так что большой файл
+    читается страницами с постоянным расходом памяти сервера и токенов.
+    """
+    path_param = params.get("path")
+    safe_path = _get_safe_path(path_param)
     if not os.path.isfile(safe_path):
-        raise JsonRpcError(-32602, f"File not found: {params.get('path')}")
+        raise JsonRpcError(-32602, f"File not found: {path_param}")
+    offset, length = _int_param(params, "offset"), _int_param(params, "length")
+    start_line, line_count = _int_param(params, "start_line", 1), _int_param(params, "line_count")
+    head, tail = _int_param(params, "head"), _int_param(params, "tail")
+    max_bytes = min(_int_param(params, "max_bytes", 1) or READ_DEFAULT_BYTES, READ_MAX_BYTES)
+    modes = [name for name, used in (("bytes", offset is not None or length is not None),
+                                     ("lines", start_line is not None or line_count is not None),
+                                     ("head", head is not None), ("tail", tail is not None)) if used]
+    if len(modes) > 1:
+        raise JsonRpcError(-32602, f"Use only one read mode at a time, got: {', '.join(modes)}.")
     try:
-        with open(safe_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        return content
+        size = os.path.getsize(safe_path)
+        with _file_data(safe_path, size) as data:
+            if b"\0" in data[:BINARY_SNIFF_BYTES]:
+                raise JsonRpcError(-32602, f"File appears to be binary: {path_param}")
+            if tail is not None:
+                result = _read_tail(data, size, tail, max_bytes)
+            elif head is not None:
+                result = _read_lines(data, size, 1, head, max_bytes)
+            elif start_line is not None or line_count is not None:
+                result = _read_lines(data, size, start_line or 1, line_count, max_bytes)
+            else:
+                result = _read_bytes(data, size, offset or 0, length, max_bytes)
+    except JsonRpcError:
+        raise
     except Exception as e:
         raise JsonRpcError(-32000, f"Error reading file: {str(e)}")
+    end = result["offset"] + result["length"]
+    result["content"] = result["content"].decode("utf-8", errors="replace")
+    result.update({"path": path_param, "size": size, "eof": end >= size})
+    if end < size:
+        result["next_offset"] = end
+    return result
+
+def _walk_files(root: str, glob: str = None):
+    """
+    Файлы под root без служебных папок: (относительный путь от рабочей папки через '/', полный путь, размер, mtime_ns).
+    Размер и время берутся из os.scandir без отдельного stat на файл.
+    """
+    base_dir = get_base_dir()
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SEARCH_SKIP_DIRS:
+                        stack.append(entry.path)
+                    continue
+                if not entry.is_file() or TEMP_FILE_RE.match(entry.name):
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            rel_path = os.path.relpath(entry.path, base_dir).replace(os.sep, "/")
+            if glob and not fnmatch.fnmatch(rel_path if "/" in glob else entry.name, glob):
+                continue
+            yield rel_path, entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def _clip_line(line: str, column: int) -> str:
+    """Длинная строка (минифицированный код, журнал) сокращается до окна вокруг совпадения."""
+    if len(line) <= SEARCH_LINE_CHARS:
+        return line
+    start = max(0, min(column - SEARCH_LINE_CHARS // 3, len(line) - SEARCH_LINE_CHARS))
+    return ("..." if start else "") + line[start:start + SEARCH_LINE_CHARS] + ("..." if start + SEARCH_LINE_CHARS < len(line) else "")
+
+
+def _scan_file(full_path: str, rel_path: str, pattern, context: int, max_matches: int, after_line: int):
+    """
+    Ищет совпадения в одном файле кусками по SEARCH_CHUNK_BYTES (куски выровнены по концу строки).
+    Кусок без совпадений пропускается одним вызовом regex; строки контекста на границе кусков
+    берутся из хвоста предыдущего куска и начала следующего. Возвращает None для двоичного файла.
+    """
+    matches, pending = [], []
+    carry = deque(maxlen=context)
+    line_base = 1
+    with open(full_path, "rb") as f:
+        if b"\0" in f.read(BINARY_SNIFF_BYTES):
+            return None
+        f.seek(0)
+        while True:
+            block = f.read(SEARCH_CHUNK_BYTES)
+            if not block:
+                break
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            text = block.decode("utf-8", errors="replace")
+            lines = text.split("\n")
+            if text.endswith("\n"):
+                lines.pop()
+            # Досылаем строки контекста "после" совпадениям из предыдущего куска
+            for item in pending:
+                item["after"].extend(lines[:context - len(item["after"])])
+            pending = [item for item in pending if len(item["after"]) < context]
+            if len(matches) >= max_matches:
+                if not pending:
+                    break
+            elif pattern.search(text):
+                position, line_index, last_index = 0, 0, -1
+                for match in pattern.finditer(text):
+                    line_index += text.count("\n", position, match.start())
+                    position = match.start()
+                    line_number = line_base + line_index
+                    if line_index == last_index or line_number <= after_line:
+                        continue
+                    last_index = line_index
+                    line = lines[line_index]
+                    item = {"path": rel_path, "line": line_number,
+                            "text": _clip_line(line, match.start() - (text.rfind("\n", 0, match.start()) + 1))}
+                    if context:
+                        before = lines[max(0, line_index - context):line_index]
+                        if len(before) < context and carry:
+                            before = list(carry)[-(context - len(before)):] + before
+                        item["before"] = [_clip_line(text_line, 0) for text_line in before]
+                        item["after"] = [_clip_line(text_line, 0) for text_line in lines[line_index + 1:line_index + 1 + context]]
+                        if len(item["after"]) < context:
+                            pending.append(item)
+                    matches.append(item)
+                    if len(matches) >= max_matches:
+                        break
+            carry.extend(lines[-context:] if context else ())
+            line_base += len(lines)
+    return matches
+
+
+def search_files(params):
+    """
+    Поиск по содержимому файлов рабочей папки (литерал или regex). Файлы сканируются параллельно пачками,
+    результаты собираются в порядке обхода; страница ограничена max_results и размером ответа,
+    а next_cursor ("строка:путь" последнего отданного совпадения) продолжает поиск с места остановки.
+    """
+    query = params.get("query")
+    if not isinstance(query, str) or not query:
+        raise JsonRpcError(-32602, "Missing required param: query")
+    flags = re.MULTILINE if params.get("case_sensitive") else re.MULTILINE | re.IGNORECASE
+    try:
+        pattern = re.compile(query if params.get("regex") else re.escape(query), flags)
+    except re.error as e:
+        raise JsonRpcError(-32602, f"Invalid regular expression: {e}")
+    context = min(_int_param(params, "context") or 0, SEARCH_MAX_CONTEXT)
+    limit = min(_int_param(params, "max_results", 1) or SEARCH_DEFAULT_RESULTS, SEARCH_MAX_RESULTS)
+    max_bytes = min(_int_param(params, "max_bytes", 1) or READ_DEFAULT_BYTES, READ_MAX_BYTES)
+    path_param = params.get("path") or "."
+    root = _get_safe_path(path_param)
+    if not os.path.isdir(root):
+        raise JsonRpcError(-32602, f"Path is not a valid directory: {path_param}")
+    cursor_line, cursor_path = 0, None
+    if params.get("cursor"):
+        line, _, cursor_path = str(params["cursor"]).partition(":")
+        if not line.isdigit() or not cursor_path:
+            raise JsonRpcError(-32602, "Invalid cursor.")
+        cursor_line = int(line)
+
+    # Порядок по относительному пути, чтобы курсор продолжал с того же места (или со следующего файла, если его удалили)
+    # Литеральный запрос сначала сверяется с индексом слов: не изменившиеся с индексации файлы без нужных слов не читаются
+    skippable = {}
+    index = _file_index()
+    if index is not None and index.has_words and not params.get("regex"):
+        words = _literal_words_query(query)
+        if words:
+            try:
+                skippable = index.skippable(words)
+            except sqlite3.Error:
+                skippable = {}
+    files = list(_walk_files(root, params.get("glob")))
+    skipped = len(files)
+    files = sorted(entry for entry in files if skippable.get(entry[0]) != entry[2:])
+    skipped -= len(files)
+    if cursor_path is not None:
+        files = files[bisect.bisect_left([entry[0] for entry in files], cursor_path):]
+
+    deadline = time.monotonic() + float(os.getenv("MCP_FILES_SEARCH_TIMEOUT", "20"))
+    results, used_bytes = [], 0
+    scanned = binary = 0
+    truncated = timed_out = False
+    batch_start = 0
+    while batch_start < len(files) and not truncated:
+        if time.monotonic() > deadline:
+            timed_out = truncated = True
+            break
+        batch = files[batch_start:batch_start + SEARCH_WORKERS * 2]
+        remaining = limit - len(results) + 1
+
+        def scan(entry):
+            rel_path, full_path = entry[:2]
+            after_line = cursor_line if rel_path == cursor_path else 0
+            try:
+                return _scan_file(full_path, rel_path, pattern, context, remaining, after_line)
+            except OSError:
+                return []
+
+        for file_matches in _search_executor.map(scan, batch):
+            scanned += 1
+            if file_matches is None:
+                binary += 1
+                continue
+            for item in file_matches:
+                size = len(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+                if len(results) >= limit or (results and used_bytes + size > max_bytes):
+                    truncated = True
+                    break
+                results.append(item)
+                used_bytes += size
+            if truncated:
+                break
+        batch_start += len(batch)
+
+    response = {"matches": results, "files_scanned": scanned}
+    if binary:
+        response["binary_files_skipped"] = binary
+    if skipped:
+        response["files_skipped_by_index"] = skipped
+    if truncated and results:
+        response["next_cursor"] = f"{results[-1]['line']}:{results[-1]['path']}"
+    elif truncated:
+        response["next_cursor"] = f"0:{files[batch_start][0]}" if batch_start < len(files) else None
+    if timed_out:
+        response["timed_out"] = True
+    return response
+
+# --- Постоянный индекс рабочей папки ---
+
+def _file_words(text: str) -> str:
+    """Уникальные слова файла (2-64 символа, в нижнем регистре) одной строкой для FTS5."""
+    words = {word for word in TOKEN_RE.findall(text.lower()) if 2 <= len(word) <= 64}
+    return " ".join(sorted(words))
+
+
+def _describe_file(full_path: str):
+    """
+    (хэш содержимого, вид, слова) файла. Вид: text, binary или large - файл больше INDEX_MAX_FILE_BYTES,
+    слова которого не индексируются. Хэш считается по всему файлу кусками.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(full_path, "rb") as f:
+        data = f.read(INDEX_MAX_FILE_BYTES + 1)
+        digest.update(data)
+        for block in iter(lambda: f.read(SEARCH_CHUNK_BYTES), b""):
+            digest.update(block)
+    if b"\0" in data[:BINARY_SNIFF_BYTES]:
+        return digest.hexdigest(), "binary", ""
+    if len(data) > INDEX_MAX_FILE_BYTES:
+        return digest.hexdigest(), "large", ""
+    return digest.hexdigest(), "text", _file_words(data.decode("utf-8", errors="replace"))
+
+
+def _words_query(text: str):
+    """Запрос FTS5 "все слова": составные слова вроде retry_count или XK-42 становятся фразой."""
+    terms = []
+    for token in text.split():
+        words = TOKEN_RE.findall(token.lower())
+        if words:
+            terms.append('"' + " ".join(words) + '"')
+    return " AND ".join(dict.fromkeys(terms)) or None
+
+
+def _literal_words_query(query: str):
+    """
+    Запрос FTS5 по словам литерального запроса search_files, которые обязаны быть в файле целиком:
+    слово, окруженное в запросе не-буквенными символами, ищется точно, последнее слово (ограниченное только слева) -
+    как префикс. Крайние слова без границы могут оказаться частью более длинного слова в файле и не проверяются.
+    """
+    query = query.lower()
+    terms = []
+    for match in TOKEN_RE.finditer(query):
+        word = match.group()
+        if match.start() == 0 or not 2 <= len(word) <= 64:
+            continue
+        terms.append(f'"{word}"' if match.end() < len(query) else f'"{word}"*')
+    return " AND ".join(dict.fromkeys(terms)) or None
+
+
+class FileIndex:
+    """
+    Индекс файлов рабочей папки в SQLite. Таблица files хранит путь, размер, mtime_ns и хэш каждого файла,
+    files_fts - слова текстовых файлов (rowid = files.id). refresh сверяет индекс с диском по размеру и mtime
+    и перечитывает только изменившиеся файлы; файл с прежним хэшем (touch, копирование) не переиндексируется.
+    """
+
+    def __init__(self, db_path: str, base_dir: str):
+        self.base_dir = base_dir
+        self.ready = threading.Event()
+        self.scanned_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # Пути, записанные update_path после снимка индекса текущим обходом
+        self._updated = set()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS file_index_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, name TEXT NOT NULL, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, kind TEXT NOT NULL)"
+        )
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(words, tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.has_words = True
+        except sqlite3.OperationalError as e:
+            print(f"[!] FTS5 недоступен, поиск по словам в индексе файлов отключен: {e}")
+            self.has_words = False
+        # Индекс другой рабочей папки бесполезен - начинаем заново
+        row = self._conn.execute("SELECT value FROM file_index_meta WHERE key = 'base_dir'").fetchone()
+        if row is None or row[0] != base_dir:
+            self._conn.execute("DELETE FROM files")
+            if self.has_words:
+                self._conn.execute("DELETE FROM files_fts")
+            self._conn.execute("INSERT OR REPLACE INTO file_index_meta (key, value) VALUES ('base_dir', ?)", (base_dir,))
+        self._conn.commit()
+
+    def _store(self, rel_path: str, size: int, mtime_ns: int, file_hash: str, kind: str, words: str):
+        row = self._conn.execute("SELECT id, hash FROM files WHERE path = ?", (rel_path,)).fetchone()
+        if row is not None:
+            self._conn.execute(
+                "UPDATE files SET size = ?, mtime_ns = ?, hash = ?, kind = ? WHERE id = ?",
+                (size, mtime_ns, file_hash, kind, row[0])
+            )
+            if row[1] == file_hash:
+                return
+            file_id = row[0]
+            if self.has_words:
+                self._conn.execute("DELETE FROM files_fts WHERE rowid = ?", (file_id,))
+        else:
+            file_id = self._conn.execute(
+                "INSERT INTO files (path, name, size, mtime_ns, hash, kind) VALUES (?, ?, ?, ?, ?, ?)",
+                (rel_path, rel_path.rsplit("/", 1)[-1], size, mtime_ns, file_hash, kind)
+            ).lastrowid
+        if self.has_words and words:
+            self._conn.execute("INSERT INTO files_fts (rowid, words) VALUES (?, ?)", (file_id, words))
+
+    def _remove(self, rel_path: str):
+        row = self._conn.execute("SELECT id FROM files WHERE path = ?", (rel_path,)).fetchone()
+        if row is None:
+            return
+        self._conn.execute("DELETE FROM files WHERE id = ?", row)
+        if self.has_words:
+            self._conn.execute("DELETE FROM files_fts WHERE rowid = ?", row)
+
+    def refresh(self) -> dict:
+        """
+        Сверяет индекс с диском: новые и измененные файлы индексируются пачками по INDEX_BATCH
+        (файлы читаются вне блокировки, поэтому запросы к индексу не ждут чтения), исчезнувшие удаляются.
+        Пути, обновленные через update_path после снимка индекса, обход не трогает - их запись свежее.
+        """
+        with self._refresh_lock:
+            with self._lock:
+                self._updated.clear()
+                known = {path: (size, mtime_ns) for path, size, mtime_ns in self._conn.execute("SELECT path, size, mtime_ns FROM files")}
+            changed = []
+            for rel_path, full_path, size, mtime_ns in _walk_files(self.base_dir):
+                if known.pop(rel_path, None) != (size, mtime_ns):
+                    changed.append((rel_path, full_path, size, mtime_ns))
+            for start in range(0, len(changed), INDEX_BATCH):
+                rows = []
+                for rel_path, full_path, size, mtime_ns in changed[start:start + INDEX_BATCH]:
+                    try:
+                        rows.append((rel_path, size, mtime_ns, *_describe_file(full_path)))
+                    except OSError:
+                        continue
+                with self._lock:
+                    for row in rows:
+                        if row[0] not in self._updated:
+                            self._store(*row)
+                    self._conn.commit()
+            with self._lock:
+                for rel_path in known:
+                    if rel_path not in self._updated:
+                        self._remove(rel_path)
+                self._conn.commit()
+            self.scanned_at = time.time()
+            self.ready.set()
+            return {"updated": len(changed), "removed": len(known)}
+
+    def update_path(self, full_path: str):
+        """
+        Обновляет запись одного файла сразу после записи или удаления, не дожидаясь опроса. Идущий в фоне
+        обход не блокирует вызов: файл читается без блокировок, а запись в базу занимает только _lock.
+        """
+        rel_path = os.path.relpath(full_path, self.base_dir).replace(os.sep, "/")
+        if SEARCH_SKIP_DIRS.intersection(rel_path.split("/")[:-1]) or TEMP_FILE_RE.match(os.path.basename(rel_path)):
+            return
+        try:
+            stat = os.stat(full_path)
+            row = (rel_path, stat.st_size, stat.st_mtime_ns, *_describe_file(full_path)) if os.path.isfile(full_path) else None
+        except FileNotFoundError:
+            row = None
+        with self._lock:
+            try:
+                current = os.stat(full_path)
+                current = (current.st_size, current.st_mtime_ns) if os.path.isfile(full_path) else None
+            except FileNotFoundError:
+                current = None
+            # Файл успел измениться еще раз, пока читался: свежую запись сделает следующий update_path или опрос
+            if current != (row[1:3] if row is not None else None):
+                return
+            if row is None:
+                self._remove(rel_path)
+            else:
+                self._store(*row)
+            self._conn.commit()
+            self._updated.add(rel_path)
+
+    def find(self, prefix: str, name: str, words: str, limit: int, after: str = None) -> list:
+        """
+        Файлы под prefix ("" - вся папка) в порядке пути после after: [(путь, размер, mtime_ns)], не больше limit.
+        name - часть имени или glob-шаблон (без учета регистра), words - запрос FTS5 по словам содержимого.
+        """
+        where, args = [], []
+        if prefix:
+            # Все пути, начинающиеся с "prefix/": '0' - следующий за '/' символ
+            where.append("path >= ? AND path < ?")
+            args += [prefix + "/", prefix + "0"]
+        if after:
+            where.append("path > ?")
+            args.append(after)
+        if words:
+            where.append("id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)")
+            args.append(words)
+        sql = "SELECT path, name, size, mtime_ns FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY path"
+        if name and any(char in name for char in "*?["):
+            name_re = re.compile(fnmatch.translate(name), re.IGNORECASE)
+            matches_name = lambda path, file_name: name_re.match(path if "/" in name else file_name)
+        elif name:
+            matches_name = lambda path, file_name: name.lower() in file_name.lower()
+        else:
+            matches_name = None
+        found = []
+        with self._lock:
+            for path, file_name, size, mtime_ns in self._conn.execute(sql, args):
+                if matches_name is None or matches_name(path, file_name):
+                    found.append((path, size, mtime_ns))
+                    if len(found) >= limit:
+                        break
+        return found
+
+    def skippable(self, words: str) -> dict:
+        """
+        {путь: (размер, mtime_ns)} текстовых файлов, в которых по индексу нет слов запроса. Файл можно не читать,
+        только если на диске у него те же размер и mtime - иначе индекс еще не успел его обновить.
+        """
+        with self._lock:
+            return {
+                path: (size, mtime_ns) for path, size, mtime_ns in self._conn.execute(
+                    "SELECT path, size, mtime_ns FROM files WHERE kind = 'text' AND "
+                    "id NOT IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)", (words,)
+                )
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            files = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return {"files": files, "ready": self.ready.is_set(), "scanned_at": self.scanned_at}
+
+
+def _poll_file_index(index: FileIndex, interval: float):
+    while True:
+        try:
+            started = time.monotonic()
+            changes = index.refresh()
+            if changes["updated"] or changes["removed"]:
+                print(f"[*] Индекс файлов обновлен за {time.monotonic() - started:.1f} с: "
+                      f"изменено {changes['updated']}, удалено {changes['removed']}.")
+        except Exception as e:
+            print(f"[!] Ошибка обновления индекса файлов: {e}")
+        time.sleep(interval)
+
+
+def _file_index():
+    """Общий индекс рабочей папки или None, если он выключен (MCP_FILES_INDEX=0). Первый вызов запускает фоновый опрос."""
+    global _FILE_INDEX
+    if os.getenv("MCP_FILES_INDEX", "1") != "1":
+        return None
+    with _FILE_INDEX_LOCK:
+        if _FILE_INDEX is None:
+            _FILE_INDEX = FileIndex(os.getenv("MCP_FILES_INDEX_FILE", INDEX_FILE), get_base_dir())
+            interval = float(os.getenv("MCP_FILES_INDEX_INTERVAL", "30"))
+            threading.Thread(target=_poll_file_index, args=(_FILE_INDEX, interval), name="files-index", daemon=True).start()
+        return _FILE_INDEX
+
+
+def _index_changed(full_path: str):
+    index = _file_index()
+    if index is None:
+        return
+    try:
+        index.update_path(full_path)
+    except Exception as e:
+        print(f"[!] Ошибка обновления индекса для {full_path}: {e}")
+
+
+def find_files(params):
+    """
+    Поиск файлов по индексу без обхода диска: рекурсивный список папки, фильтр по имени и словам содержимого.
+    Пока первый обход после запуска не закончен, ответ может быть неполным (index_ready=false).
+    """
+    index = _file_index()
+    if index is None:
+        raise JsonRpcError(-32000, "File index is disabled (MCP_FILES_INDEX=0). Use search_files instead.")
+    path_param = params.get("path") or "."
+    root = _get_safe_path(path_param)
+    if not os.path.isdir(root):
+        raise JsonRpcError(-32602, f"Path is not a valid directory: {path_param}")
+    prefix = os.path.relpath(root, get_base_dir()).replace(os.sep, "/")
+    words = None
+    if params.get("words"):
+        if not index.has_words:
+            raise JsonRpcError(-32000, "Word search is unavailable: SQLite is built without FTS5.")
+        words = _words_query(str(params["words"]))
+        if words is None:
+            raise JsonRpcError(-32602, "Param 'words' must contain at least one word.")
+    limit = min(_int_param(params, "max_results", 1) or FIND_DEFAULT_RESULTS, FIND_MAX_RESULTS)
+    index.ready.wait(float(os.getenv("MCP_FILES_INDEX_WAIT", "5")))
+    try:
+        found = index.find("" if prefix == "." else prefix, params.get("name"), words, limit + 1, params.get("cursor"))
+    except sqlite3.Error as e:
+        raise JsonRpcError(-32000, f"Error querying file index: {str(e)}")
+    response = {
+        "files": [{"path": path, "size": size, "mtime": int(mtime_ns // 1_000_000_000)} for path, size, mtime_ns in found[:limit]],
+        "index_ready": index.ready.is_set(),
+    }
+    if len(found) > limit:
+        response["next_cursor"] = found[limit - 1][0]
+    return response
+
+
+# --- Запись ---
+
+def _text_param(params, name: str) -> str:
+    value = params.get(name)
+    if not isinstance(value, str):
+        raise JsonRpcError(-32602, f"Missing required param: {name}")
+    return value
+
+
+@contextmanager
+def _atomic_output(safe_path: str):
+    """
+    Файл для нового содержимого safe_path: запись идет во временный файл рядом с целевым, который после
+    успешного завершения блока подменяет целевой через os.replace (права прежнего файла сохраняются).
+    При ошибке временный файл удаляется, а старое содержимое остается нетронутым.
+    """
+    directory = os.path.dirname(safe_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(safe_path)}{TEMP_FILE_MARKER}", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        _replace_with(temp_path, safe_path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def _replace_with(temp_path: str, safe_path: str):
+    # mkstemp создает файл с правами 0600: новый файл получает обычные права с учетом umask, как при open()
+    if os.path.isfile(safe_path):
+        shutil.copymode(safe_path, temp_path)
+    else:
+        os.chmod(temp_path, 0o666 & ~_UMASK)
+    os.replace(temp_path, safe_path)
+
+
+def _copy_bytes(src, dst, count: int):
+    while count > 0:
+        block = src.read(min(count, SEARCH_CHUNK_BYTES))
+        if not block:
+            break
+        dst.write(block)
+        count -= len(block)
+
 
 def write_file(params):
-    content = params.get("content")
-    if content is None:
-        raise JsonRpcError(-32602, "Missing required param: content")
+    content = _text_param(params, "content")
     safe_path = _get_safe_path(params.get("path"))
     try:
-        os.makedirs(os.path.dirname(safe_path), exist_ok=True)
-        with open(safe_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        with _atomic_output(safe_path) as f:
+            f.write(content.encode("utf-8"))
+        _index_changed(safe_path)
         return {"status": "ok", "path": params.get("path")}
     except Exception as e:
         raise JsonRpcError(-32000, f"Error writing file: {str(e)}")
 
+def append_file(params):
+    """
+    Дописывает текст в конец файла. Индекс файлов обновится при следующем опросе: пересчитывать хэш
+    большого файла после каждой дописанной части слишком дорого, а search_files сверяет размер и mtime сам.
+    """
+    content = _text_param(params, "content")
+    safe_path = _get_safe_path(params.get("path"))
+    try:
+        os.makedirs(os.path.dirname(safe_path), exist_ok=True)
+        with open(safe_path, "ab") as f:
+            f.write(content.encode("utf-8"))
+            size = f.tell()
+        return {"status": "ok", "path": params.get("path"), "size": size}
+    except Exception as e:
+        raise JsonRpcError(-32000, f"Error appending to file: {str(e)}")
+
+def edit_file(params):
+    """
+    Правка части файла: замена фрагмента old_text (ровно одного вхождения или всех при replace_all)
+    или байтового диапазона offset/length на new_text. Новое содержимое собирается во временном файле
+    (при замене по позиции - потоковым копированием, без чтения файла в память) и атомарно подменяет старое.
+    """
+    path_param = params.get("path")
+    safe_path = _get_safe_path(path_param)
+    if not os.path.isfile(safe_path):
+        raise JsonRpcError(-32602, f"File not found: {path_param}")
+    new_bytes = _text_param(params, "new_text").encode("utf-8")
+    old_text = params.get("old_text")
+    offset, length = _int_param(params, "offset"), _int_param(params, "length") or 0
+    if (old_text is None) == (offset is None):
+        raise JsonRpcError(-32602, "Specify either old_text or offset.")
+    if old_text is not None and (not isinstance(old_text, str) or not old_text):
+        raise JsonRpcError(-32602, "Param 'old_text' must be a non-empty string.")
+    try:
+        # Исходный файл закрывается до os.replace (на Windows открытый файл нельзя подменить)
+        with _atomic_output(safe_path) as dst:
+            with open(safe_path, "rb") as src:
+                if b"\0" in src.read(BINARY_SNIFF_BYTES):
+                    raise JsonRpcError(-32602, f"File appears to be binary: {path_param}")
+                src.seek(0)
+                if offset is not None:
+                    size = os.fstat(src.fileno()).st_size
+                    if offset + length > size:
+                        raise JsonRpcError(-32602, f"Range {offset}+{length} is outside of the file (size {size}).")
+                    for position in (offset, offset + length):
+                        src.seek(position)
+                        byte = src.read(1)
+                        if byte and 0x80 <= byte[0] < 0xC0:
+                            raise JsonRpcError(-32602, f"Offset {position} falls inside a UTF-8 character.")
+                    src.seek(0)
+                    _copy_bytes(src, dst, offset)
+                    dst.write(new_bytes)
+                    src.seek(offset + length)
+                    shutil.copyfileobj(src, dst, SEARCH_CHUNK_BYTES)
+                    replacements = 1
+                else:
+                    data = src.read()
+                    old_bytes = old_text.encode("utf-8")
+                    replacements = data.count(old_bytes)
+                    if not replacements:
+                        raise JsonRpcError(-32602, f"old_text not found in {path_param}.")
+                    if replacements > 1 and not params.get("replace_all"):
+                        raise JsonRpcError(
+                            -32602, f"old_text occurs {replacements} times in {path_param}; add surrounding text to make it unique or set replace_all."
+                        )
+                    dst.write(data.replace(old_bytes, new_bytes))
+            size = dst.tell()
+        _index_changed(safe_path)
+        return {"status": "ok", "path": path_param, "size": size, "replacements": replacements}
+    except JsonRpcError:
+        raise
+    except Exception as e:
+        raise JsonRpcError(-32000, f"Error editing file: {str(e)}")
+
+
+# Загрузки частями: {upload_id: {"path", "safe_path", "temp_path", "received", "updated_at"}}.
+# Части дописываются во временный файл рядом с целевым; finish_upload подменяет целевой файл атомарно.
+_UPLOADS = {}
+_UPLOADS_LOCK = threading.Lock()
+# umask процесса читается один раз при загрузке модуля (os.umask меняет его глобально)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _expire_uploads():
+    """Удаляет брошенные загрузки старше MCP_FILES_UPLOAD_TTL секунд (вызывается под _UPLOADS_LOCK)."""
+    deadline = time.time() - float(os.getenv("MCP_FILES_UPLOAD_TTL", "3600"))
+    for upload_id in [key for key, upload in _UPLOADS.items() if upload["updated_at"] < deadline]:
+        with suppress(OSError):
+            os.remove(_UPLOADS.pop(upload_id)["temp_path"])
+
+
+def _get_upload(params) -> dict:
+    upload = _UPLOADS.get(str(params.get("upload_id")))
+    if upload is None:
+        raise JsonRpcError(-32602, f"Unknown or expired upload_id: {params.get('upload_id')}")
+    return upload
+
+
+def start_upload(params):
+    path_param = params.get("path")
+    safe_path = _get_safe_path(path_param)
+    if os.path.isdir(safe_path):
+        raise JsonRpcError(-32602, f"Path is a directory: {path_param}")
+    try:
+        directory = os.path.dirname(safe_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(safe_path)}{TEMP_FILE_MARKER}", suffix=".upload")
+        os.close(fd)
+    except Exception as e:
+        raise JsonRpcError(-32000, f"Error starting upload: {str(e)}")
+    upload_id = uuid.uuid4().hex
+    with _UPLOADS_LOCK:
+        _expire_uploads()
+        _UPLOADS[upload_id] = {"path": path_param, "safe_path": safe_path, "temp_path": temp_path,
+                               "received": 0, "updated_at": time.time()}
+    return {"upload_id": upload_id, "path": path_param}
+
+def upload_chunk(params):
+    content = _text_param(params, "content")
+    expected = _int_param(params, "offset")
+    with _UPLOADS_LOCK:
+        upload = _get_upload(params)
+        if expected is not None and expected != upload["received"]:
+            raise JsonRpcError(-32602, f"Upload offset mismatch: expected {upload['received']}, got {expected}.")
+        try:
+            with open(upload["temp_path"], "ab") as f:
+                f.write(content.encode("utf-8"))
+                upload["received"] = f.tell()
+        except Exception as e:
+            raise JsonRpcError(-32000, f"Error writing upload chunk: {str(e)}")
+        upload["updated_at"] = time.time()
+        return {"upload_id": params.get("upload_id"), "received": upload["received"]}
+
+def finish_upload(params):
+    with _UPLOADS_LOCK:
+        upload = _get_upload(params)
+        del _UPLOADS[str(params.get("upload_id"))]
+    if params.get("cancel"):
+        with suppress(OSError):
+            os.remove(upload["temp_path"])
+        return {"status": "cancelled", "path": upload["path"]}
+    try:
+        with open(upload["temp_path"], "rb+") as f:
+            os.fsync(f.fileno())
+        _replace_with(upload["temp_path"], upload["safe_path"])
+    except Exception as e:
+        with suppress(OSError):
+            os.remove(upload["temp_path"])
+        raise JsonRpcError(-32000, f"Error finishing upload: {str(e)}")
+    _index_changed(upload["safe_path"])
+    return {"status": "ok", "path": upload["path"], "size": upload["received"]}
+
 def delete_file(params):
     safe_path = _get_safe_path(params.get("path"))
     if not os.path.exists(safe_path):
@@ -145,6 +1269,7 @@ def delete_file(params):
         raise JsonRpcError(-32602, f"Path is not a file: {params.get('path')}")
     try:
         os.remove(safe_path)
+        _index_changed(safe_path)
         return {"status": "ok"}
     except Exception as e:
         raise JsonRpcError(-32000, f"Error deleting file: {str(e)}")
@@ -152,8 +1277,16 @@ def delete_file(params):
 
 METHODS = {
     "list_dir": list_dir,
+    "list_tree": list_tree,
     "read_file": read_file,
+    "search_files": search_files,
+    "find_files": find_files,
     "write_file": write_file,
+    "append_file": append_file,
+    "edit_file": edit_file,
+    "start_upload": start_upload,
+    "upload_chunk": upload_chunk,
+    "finish_upload": finish_upload,
     "delete_file": delete_file,
 }
 
@@ -164,32 +1297,19 @@ print("[*] Регистрируем endpoint /functions")
 @app.route("/functions", methods=["GET"])
 def get_functions():
     print("[*] Вызван /functions")
-    return jsonify(FILE_FUNCTIONS)
+    return functions_response(FILE_FUNCTIONS)
 
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    # Эта функция без изменений
-    try:
-        req = request.get_json(force=True)
-        id_ = req.get("id")
-        method = req.get("method")
-        params = req.get("params", {})
-
-        if req.get("jsonrpc") != "2.0" or id_ is None or not method:
-            raise JsonRpcError(-32600, "Invalid JSON-RPC request format")
-        if method not in METHODS:
-            raise JsonRpcError(-32601, f"Method not found: {method}")
-
-        result = METHODS[method](params)
-        return make_success_response(id_, result)
-    except JsonRpcError as je:
-        return make_error_response(req.get("id", None), je.code, je.message), 400
-    except Exception as e:
-        return make_error_response(req.get("id", None), -32603, f"Internal error: {str(e)}"), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
 
 
 if __name__ == "__main__":
     port = int(os.getenv("MCP_FILES_PORT", 8001))
     print(f"[*] MCP_Files запускается на порту: {port} через Waitress. Инициализация отложена.")
+    # Первый обход индекса файлов начинается сразу, чтобы find_files был готов к первым запросам
+    threading.Thread(target=_file_index, name="files-index-start", daemon=True).start()
     serve(app, host="0.0.0.0", port=port)
\ No newline at end of file
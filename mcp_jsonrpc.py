@@ -0,0 +1,79 @@
+# mcp_jsonrpc.py
+"""
+Общая обработка JSON-RPC 2.0 для эндпоинта /mcp всех MCP-серверов.
+Поддерживает как одиночный запрос, так и пакет (batch) - массив запросов в одном POST.
+Здесь же - ответ эндпоинта /functions с версией схемы, по которой клиенты кэшируют описания.
+"""
+
+import json
+import hashlib
+
+from flask import request, jsonify
+
+
+def _error(id_, code, message):
+    return {"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}}
+
+
+def _success(id_, result):
+    return {"jsonrpc": "2.0", "id": id_, "result": result}
+
+
+def execute_request(req, methods: dict, error_cls) -> dict:
+    """Выполняет один JSON-RPC запрос и возвращает объект ответа (никогда не бросает исключений)."""
+    if not isinstance(req, dict):
+        return _error(None, -32600, "Invalid JSON-RPC request format")
+    id_ = req.get("id")
+    try:
+        method = req.get("method")
+        params = req.get("params", {})
+        if req.get("jsonrpc") != "2.0" or id_ is None or not method:
+            raise error_cls(-32600, "Invalid JSON-RPC request format")
+        if method not in methods:
+            raise error_cls(-32601, f"Method not found: {method}")
+        return _success(id_, methods[method](params))
+    except error_cls as je:
+        return _error(id_, je.code, str(je.message))
+    except Exception as e:
+        return _error(id_, -32603, f"Internal error: {str(e)}")
+
+
+def handle_payload(payload, methods: dict, error_cls):
+    """
+    Обрабатывает тело POST /mcp. Возвращает (тело ответа, HTTP-статус).
+    Запросы пакета выполняются последовательно и в исходном порядке: многие серверы
+    (браузер, буфер обмена) не рассчитаны на одновременные вызовы.
+    """
+    if payload is None:
+        return _error(None, -32700, "Parse error"), 400
+
+    if isinstance(payload, list):
+        if not payload:
+            return _error(None, -32600, "Invalid JSON-RPC request: empty batch"), 400
+        return [execute_request(req, methods, error_cls) for req in payload], 200
+
+    response = execute_request(payload, methods, error_cls)
+    if "error" in response:
+        # Ошибки протокола/параметров - 400, внутренние ошибки сервера - 500
+        return response, 500 if response["error"]["code"] == -32603 else 400
+    return response, 200
+
+
+def schema_version(functions: list) -> str:
+    """Хэш описаний функций: меняется при любом изменении схемы сервера."""
+    raw = json.dumps(functions, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+def functions_response(functions: list):
+    """
+    Ответ GET /functions. Версия схемы отдается в ETag и X-MCP-Schema-Version;
+    если клиент прислал ту же версию в If-None-Match - отвечаем 304 без тела.
+    """
+    version = schema_version(functions)
+    if request.if_none_match.contains(version):
+        return "", 304, {"ETag": f'"{version}"', "X-MCP-Schema-Version": version}
+    response = jsonify(functions)
+    response.set_etag(version)
+    response.headers["X-MCP-Schema-Version"] = version
+    return response
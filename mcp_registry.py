@@ -2,6 +2,12 @@
 """
 Единый источник истины (Single Source of Truth) для всех MCP-модулей.
 Чтобы добавить новый MCP в систему, достаточно добавить запись в этот словарь.
+Необязательный ключ "max_parallel_calls" ограничивает число одновременных вызовов
+к серверу от одного агента (по умолчанию - AGENT_MAX_CALLS_PER_SERVER).
+Необязательный ключ "idempotent_methods" - методы только для чтения, которые
+транспорт может безопасно повторить при обрыве соединения или таймауте.
+Необязательный ключ "namespaced" - сервер делит данные по пространствам имен:
+агент подставляет в каждый вызов параметр namespace (см. MEMORY_NAMESPACE).
 """
 
 MCP_REGISTRY = {
@@ -10,13 +16,15 @@ MCP_REGISTRY = {
         "script": "mcp_files.py", 
         "port_env": "MCP_FILES_PORT", 
         "default_port": "8001",
-        "description": "Предоставляет ИИ возможность работать с файлами и папками в изолированной 'песочнице' (рабочей папке).\n\n- list_dir: Посмотреть содержимое папки.\n- read_file: Прочитать текстовый файл.\n- write_file: Записать или создать файл.\n- delete_file: Удалить файл."
+        "idempotent_methods": ["list_dir", "list_tree", "read_file", "search_files", "find_files"],
+        "description": "Предоставляет ИИ возможность работать с файлами и папками в изолированной 'песочнице' (рабочей папке).\n\n- list_dir: Посмотреть содержимое папки.\n- list_tree: Дерево папки с типами, размерами и временем изменения (с глубиной, фильтром и постраничной выдачей).\n- read_file: Прочитать текстовый файл целиком или по частям (байты, строки, начало/конец).\n- search_files: Найти строку или регулярное выражение в файлах папки (с контекстом и постраничной выдачей).\n- find_files: Мгновенно найти файлы по индексу: список всех файлов папки, поиск по имени и по словам в содержимом.\n- write_file: Записать или создать файл (атомарно).\n- append_file: Дописать текст в конец файла.\n- edit_file: Заменить фрагмент текста или байтовый диапазон файла.\n- start_upload / upload_chunk / finish_upload: Загрузить большой файл частями.\n- delete_file: Удалить файл."
     },
     "web": {
         "name": "Web (Selenium)", 
         "script": "mcp_web.py", 
         "port_env": "MCP_WEB_PORT", 
         "default_port": "8002",
+        "max_parallel_calls": 1, # Один экземпляр браузера - вызовы только последовательно
         "description": "Позволяет ИИ взаимодействовать с веб-страницами через браузер.\n\n- navigate_to_url: Открыть сайт.\n- get_page_content: 'Осмотреться' на странице, получить текст и список кнопок/ссылок.\n- click_element: Нажать на элемент.\n- type_in_element: Ввести текст в поле."
     },
     "shell": {
@@ -24,6 +32,7 @@ MCP_REGISTRY = {
         "script": "mcp_shell.py", 
         "port_env": "MCP_SHELL_PORT", 
         "default_port": "8003",
+        "idempotent_methods": ["get_current_time"],
         "description": "Дает ИИ доступ к ограниченному набору безопасных команд в терминале.\n\n- execute_shell_command: Выполнить команду из белого списка (например, git status, pip list).\n- get_current_time: Узнать текущее время."
     },
     "clipboard": {
@@ -31,6 +40,8 @@ MCP_REGISTRY = {
         "script": "mcp_clipboard.py", 
         "port_env": "MCP_CLIPBOARD_PORT", 
         "default_port": "8004",
+        "max_parallel_calls": 1, # Системный буфер обмена - общий ресурс
+        "idempotent_methods": ["get_clipboard_content"],
         "description": "Позволяет ИИ читать и записывать текст в системный буфер обмена.\n\n- get_clipboard_content: Получить текст из буфера.\n- set_clipboard_content: Поместить текст в буфер."
     },
     "telegram": {
@@ -38,6 +49,7 @@ MCP_REGISTRY = {
         "script": "mcp_telegram.py", 
         "port_env": "MCP_TELEGRAM_PORT", 
         "default_port": "8005",
+        "idempotent_methods": ["list_telegram_dialogs", "read_last_messages", "get_chat_participants"],
         "description": "Интеграция с Telegram для чтения и отправки сообщений.\n\n- list_telegram_dialogs: Получить список чатов и их ID.\n- send_telegram_message: Отправить сообщение.\n- read_last_messages: Прочитать историю чата."
     },
     "semantic_memory": {
@@ -45,7 +57,9 @@ MCP_REGISTRY = {
         "script": "mcp_semantic_memory.py", 
         "port_env": "MCP_SEMANTIC_MEMORY_PORT", 
         "default_port": "8007",
-        "description": "Продвинутая память для ИИ, сочетающая семантический поиск (по смыслу) и граф знаний (связи между сущностями).\n\n- remember: Сохранить факт.\n- recall: Вспомнить похожие факты.\n- create_entity: Создать объект в графе (человек, проект).\n- link_entities: Связать два объекта."
+        "idempotent_methods": ["recall", "find_entity_by_label", "get_entity_details", "get_neighborhood"],
+        "namespaced": True,
+        "description": "Продвинутая память для ИИ, сочетающая семантический поиск (по смыслу) и граф знаний (связи между сущностями).\n\n- remember: Сохранить факт.\n- remember_batch: Сохранить сразу несколько фактов.\n- recall: Вспомнить факты по смыслу и точным словам (с фильтрами по времени и источнику).\n- create_entity: Создать объект в графе (человек, проект).\n- link_entities: Связать два объекта.\n- get_neighborhood: Окрестность объекта в графе на несколько связей."
     },
     
 }
\ No newline at end of file
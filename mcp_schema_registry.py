@@ -0,0 +1,162 @@
+# mcp_schema_registry.py
+"""
+Реестр схем функций MCP-серверов (ответов GET /functions).
+
+Все серверы опрашиваются одновременно, а схемы кэшируются на диске вместе с версией,
+которую сервер отдает в ETag / X-MCP-Schema-Version. При следующем запуске агент сразу
+получает схемы из кэша, а проверка актуальности идет в фоне запросом с If-None-Match:
+неизмененная схема возвращается ответом 304 без тела.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mcp_transport import get_transport
+
+SCHEMA_CACHE_FILE = "mcp_schema_cache.json"
+
+
+class SchemaRegistry:
+    def __init__(self, cache_file: str = SCHEMA_CACHE_FILE):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        # {имя MCP: {"url": ..., "version": ..., "functions": [...]}}
+        self._cache = self._load_cache()
+        self._listeners = []
+        # Серверы, схемы которых уже перепроверены в этом процессе
+        self._revalidated = set()
+
+    def _load_cache(self) -> dict:
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f"Кэш схем MCP поврежден и будет пересоздан: {e}")
+            return {}
+
+    def _save_cache(self):
+        with self._lock:
+            data = json.dumps(self._cache, ensure_ascii=False, indent=2)
+        tmp_path = self.cache_file + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_file)
+
+    def cached(self, name: str, url: str):
+        """Схема из кэша или None, если ее нет или сервер переехал на другой адрес."""
+        with self._lock:
+            entry = self._cache.get(name)
+        if entry and entry.get("url") == url:
+            return entry["functions"]
+        return None
+
+    def has_all(self, servers: dict) -> bool:
+        return all(self.cached(name, url) is not None for name, url in servers.items())
+
+    def subscribe(self, callback):
+        """callback(name, functions) вызывается из фонового потока, когда схема сервера изменилась."""
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _fetch_one(self, name: str, url: str, deadline: float) -> bool:
+        """
+        Опрашивает /functions сервера до успеха или до deadline.
+        Возвращает True, если схема получена (или подтверждена ответом 304).
+        """
+        with self._lock:
+            entry = self._cache.get(name)
+        known_version = entry.get("version") if entry and entry.get("url") == url else None
+        headers = {"If-None-Match": f'"{known_version}"'} if known_version else {}
+        transport = get_transport(url)
+
+        while True:
+            try:
+                resp = transport.get("/functions", timeout=(1, 5), headers=headers)
+                if resp.status_code == 304:
+                    return True
+                if resp.status_code == 200:
+                    functions = resp.json()
+                    version = resp.headers.get("X-MCP-Schema-Version")
+                    with self._lock:
+                        self._cache[name] = {"url": url, "version": version, "functions": functions}
+                    if version != known_version:
+                        logging.info(f"Схема MCP '{name}' обновлена (версия {version}).")
+                        for listener in list(self._listeners):
+                            listener(name, functions)
+                    return True
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+
+    def fetch_all(self, servers: dict, timeout: float = 30) -> set:
+        """
+        Одновременно получает схемы всех серверов (ожидая их запуска не дольше timeout).
+        Возвращает множество имен серверов, которые ответили.
+        """
+        if not servers:
+            return set()
+        deadline = time.time() + timeout
+        with ThreadPoolExecutor(max_workers=len(servers), thread_name_prefix="mcp-schema") as pool:
+            futures = {name: pool.submit(self._fetch_one, name, url, deadline) for name, url in servers.items()}
+            ready = {name for name, future in futures.items() if future.result()}
+        with self._lock:
+            self._revalidated.update(ready)
+        self._save_cache()
+        return ready
+
+    def revalidate_in_background(self, servers: dict, timeout: float = 30):
+        """Проверяет актуальность кэшированных схем в фоновом потоке (каждый сервер - один раз за процесс)."""
+        with self._lock:
+            servers = {name: url for name, url in servers.items() if name not in self._revalidated}
+            self._revalidated.update(servers)
+        if not servers:
+            return None
+
+        def run():
+            ready = self.fetch_all(servers, timeout)
+            missing = set(servers) - ready
+            if missing:
+                logging.warning(f"MCP-серверы не ответили при фоновой проверке схем: {sorted(missing)}")
+        thread = threading.Thread(target=run, name="mcp-schema-revalidate", daemon=True)
+        thread.start()
+        return thread
+
+    def get_schemas(self, servers: dict, timeout: float = 5) -> dict:
+        """
+        Схемы для указанных серверов: {имя: functions}. Кэшированные возвращаются сразу
+        (и перепроверяются в фоне), отсутствующие в кэше загружаются одновременно.
+        Серверы, схему которых получить не удалось, в результат не попадают.
+        """
+        cached = {name: url for name, url in servers.items() if self.cached(name, url) is not None}
+        missing = {name: url for name, url in servers.items() if name not in cached}
+        if missing:
+            self.fetch_all(missing, timeout)
+        if cached:
+            self.revalidate_in_background(cached)
+        return {name: self.cached(name, url) for name, url in servers.items() if self.cached(name, url) is not None}
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_schema_registry() -> SchemaRegistry:
+    """Общий на процесс реестр схем (его используют оркестратор и все суб-агенты)."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SchemaRegistry(os.getenv("MCP_SCHEMA_CACHE_FILE", SCHEMA_CACHE_FILE))
+        return _registry
@@ -1,6 +1,8 @@
 # mcp_semantic_memory.py
 
 import os
+import sys
+import time
 import sqlite3
 import numpy as np
 import faiss
@@ -8,80 +10,960 @@ from sentence_transformers import SentenceTransformer
 from flask import Flask, request, jsonify
 from waitress import serve
 import threading
+import atexit
 import json
-import networkx as nx
-from networkx.readwrite import json_graph
+import hashlib
+import unicodedata
+import re
+import difflib
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from mcp_jsonrpc import handle_payload, functions_response
+from semantic_memory_index import (
+    build_index, choose_kind, index_kind, configure_search, extract_vectors, evaluate, find_duplicate_clusters,
+    read_index_file, write_index_file, search_filtered, benchmark_storage, index_settings, MappedIndex, INDEX_KINDS
+)
 
 # --- Конфигурация ---
 DB_FILE = "semantic_memory.db"
 FAISS_INDEX_FILE = "semantic_memory.index"
 GRAPH_FILE = "knowledge_graph.json"
 MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+# При MEMORY_INDEX_MMAP=1: сколько новых записей держать в памяти, прежде чем переписать файл индекса
+MMAP_DELTA_LIMIT = 5000
+# Ограничения запросов к графу знаний: результаты по умолчанию / предел, глубина окрестности
+GRAPH_DEFAULT_LIMIT = 20
+GRAPH_MAX_LIMIT = 200
+GRAPH_MAX_DEPTH = 3
+GRAPH_MAX_RELATIONS = 1000
+# Минимальная похожесть (0..1) для нечеткого поиска сущности по имени
+GRAPH_FUZZY_MIN_SCORE = 0.5
+# Гибридный recall: кандидатов от каждого поиска, константа k слияния рангов (RRF), предел top_k
+RECALL_CANDIDATES = 30
+RECALL_RRF_K = 60
+RECALL_MAX_TOP_K = 50
+# До скольких записей после фильтров векторное расстояние считается точно по векторам из базы
+RECALL_EXACT_FILTER_LIMIT = 20000
+# Пространства имен: память каждого чата/профиля агента - свои записи, свой граф и свой файл индекса.
+# Пространство 'default' хранится в semantic_memory.index (как до появления пространств).
+DEFAULT_NAMESPACE = "default"
+NAMESPACE_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
 
 # --- Глобальные переменные для ленивой инициализации ---
-app_globals = {"model": None, "index": None, "conn": None, "graph": None}
+app_globals = {"model": None, "indexes": {}, "conn": None, "batcher": None, "embedding_cache": None, "fts": False}
 initialization_lock = threading.Lock()
+# Поэтапный запуск: база и граф доступны сразу, модель и векторный индекс загружаются в фоне
+db_init_lock = threading.Lock()
+vector_ready = threading.Event()
+load_state = {"stage": "not_started", "step": 0, "steps": 4, "started_at": None, "finished_at": None, "error": None}
+# FAISS-индекс не потокобезопасен при одновременных записи и поиске, а waitress обслуживает запросы в нескольких потоках
+index_lock = threading.RLock()
+# Индексы пространств имен загружаются при первом обращении; неактивные выгружаются (см. unload_idle_namespaces)
+shard_state = {"last_used": {}, "locks": {}}
+# Пространства, индекс которых сейчас перестраивается (смена вида индекса при росте памяти, консолидация)
+rebuild_state = {"running": set()}
+# Консолидация памяти: удаление почти одинаковых записей; последний отчет - по каждому пространству
+consolidation_state = {"running": False, "last_reports": {}, "thread": None}
+# Транзакции на общем соединении с базой не должны перемешиваться между потоками
+db_write_lock = threading.RLock()
 
 app = Flask(__name__)
 
 # --- Инициализация ---
-def ensure_memory_loaded():
+def open_db():
+    """Открывает базу памяти и создает/дополняет таблицы."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS memory_chunks (id INTEGER PRIMARY KEY, text_content TEXT NOT NULL, embedding BLOB)")
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(memory_chunks)")}
+    if "embedding" not in columns:
+        conn.execute("ALTER TABLE memory_chunks ADD COLUMN embedding BLOB")
+    # Метаданные для фильтров recall: время записи (unix) и источник; у старых записей - NULL
+    if "created_at" not in columns:
+        conn.execute("ALTER TABLE memory_chunks ADD COLUMN created_at REAL")
+    if "source" not in columns:
+        conn.execute("ALTER TABLE memory_chunks ADD COLUMN source TEXT")
+    # Пространство имен записи; записи, сделанные до появления пространств, попадают в 'default'
+    if "namespace" not in columns:
+        conn.execute(f"ALTER TABLE memory_chunks ADD COLUMN namespace TEXT NOT NULL DEFAULT '{DEFAULT_NAMESPACE}'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_chunks_created_at ON memory_chunks (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_chunks_source ON memory_chunks (source)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_chunks_namespace ON memory_chunks (namespace, id)")
+    # Записи, замененные более новыми почти одинаковыми при консолидации (для аудита и восстановления)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS memory_superseded (id INTEGER PRIMARY KEY, kept_id INTEGER NOT NULL, "
+        "text_content TEXT NOT NULL, created_at REAL, source TEXT, superseded_at REAL NOT NULL)"
+    )
+    if "namespace" not in {row['name'] for row in conn.execute("PRAGMA table_info(memory_superseded)")}:
+        conn.execute(f"ALTER TABLE memory_superseded ADD COLUMN namespace TEXT NOT NULL DEFAULT '{DEFAULT_NAMESPACE}'")
+    app_globals["fts"] = open_fts(conn)
+    # Граф знаний: узлы и направленные ребра (не больше одного ребра на пару узлов, как в DiGraph), у каждого пространства имен свой
+    migrate_graph_namespaces(conn)
+    create_graph_tables(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_graph_edges_target ON graph_edges (namespace, target)")
+    # Индекс имен: приведенное к одному регистру имя (точный и префиксный поиск) и триграммы (нечеткий поиск)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_graph_nodes_label_folded ON graph_nodes (namespace, label_folded)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_graph_label_grams_node ON graph_label_grams (namespace, node_id)")
+    conn.commit()
+    index_graph_labels(conn)
+    return conn
+
+
+def create_graph_tables(conn):
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS graph_nodes (namespace TEXT NOT NULL DEFAULT '{DEFAULT_NAMESPACE}', id TEXT NOT NULL, "
+        "label TEXT, type TEXT, attrs TEXT, label_folded TEXT, PRIMARY KEY (namespace, id))"
+    )
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS graph_edges (namespace TEXT NOT NULL DEFAULT '{DEFAULT_NAMESPACE}', source TEXT NOT NULL, "
+        "target TEXT NOT NULL, label TEXT, attrs TEXT, PRIMARY KEY (namespace, source, target))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS graph_label_grams (namespace TEXT NOT NULL, gram TEXT NOT NULL, node_id TEXT NOT NULL, "
+        "PRIMARY KEY (namespace, gram, node_id)) WITHOUT ROWID"
+    )
+
+
+def migrate_graph_namespaces(conn):
+    """
+    Таблицы графа без колонки namespace пересоздаются с ключами по пространству имен;
+    прежние узлы и связи попадают в 'default', индекс имен строится заново (index_graph_labels).
+    """
+    node_columns = {row['name'] for row in conn.execute("PRAGMA table_info(graph_nodes)")}
+    if not node_columns or "namespace" in node_columns:
+        return
+    tables = ("graph_nodes", "graph_edges", "graph_label_grams")
+    conn.commit()
+    with db_write_lock, conn:
+        # Явная транзакция: иначе sqlite3 выполняет DDL вне транзакции и сбой оставил бы граф наполовину перенесенным
+        conn.execute("BEGIN")
+        for table in tables:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        create_graph_tables(conn)
+        conn.execute("INSERT INTO graph_nodes (id, label, type, attrs) SELECT id, label, type, attrs FROM graph_nodes_legacy")
+        conn.execute("INSERT INTO graph_edges (source, target, label, attrs) SELECT source, target, label, attrs FROM graph_edges_legacy")
+        for table in tables:
+            conn.execute(f"DROP TABLE {table}_legacy")
+    print(f"[MCP_Memory] Граф знаний перенесен в пространство имен '{DEFAULT_NAMESPACE}'.")
+
+
+def open_fts(conn) -> bool:
+    """
+    Полнотекстовый индекс FTS5 (BM25) по memory_chunks.text_content, синхронизируемый триггерами.
+    Возвращает False, если SQLite собран без FTS5 - тогда recall работает только по векторам.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memory_fts'").fetchone()
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5("
+            "text_content, content='memory_chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError as e:
+        print(f"[MCP_Memory] FTS5 недоступен, лексический поиск отключен: {e}")
+        return False
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS memory_fts_insert AFTER INSERT ON memory_chunks BEGIN "
+        "INSERT INTO memory_fts (rowid, text_content) VALUES (new.id, new.text_content); END"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS memory_fts_delete AFTER DELETE ON memory_chunks BEGIN "
+        "INSERT INTO memory_fts (memory_fts, rowid, text_content) VALUES ('delete', old.id, old.text_content); END"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS memory_fts_update AFTER UPDATE OF text_content ON memory_chunks BEGIN "
+        "INSERT INTO memory_fts (memory_fts, rowid, text_content) VALUES ('delete', old.id, old.text_content); "
+        "INSERT INTO memory_fts (rowid, text_content) VALUES (new.id, new.text_content); END"
+    )
+    if not exists:
+        # Первое включение на существующей базе: проиндексировать уже сохраненные тексты
+        conn.execute("INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')")
+        print("[MCP_Memory] Полнотекстовый индекс памяти построен.")
+    return True
+
+
+def fold_label(label) -> str:
+    """Ключ поиска по имени: нормализованный текст без учета регистра."""
+    return normalize_text(label or "").casefold()
+
+
+def label_grams(folded: str) -> set:
+    """Триграммы имени с пробелами по краям, чтобы короткие имена и начала слов тоже учитывались."""
+    if not folded:
+        return set()
+    padded = f" {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def index_node_label(conn, namespace: str, node_id: str, label):
+    """Обновляет индекс имени одного узла (вызывается внутри транзакции записи)."""
+    folded = fold_label(label)
+    conn.execute("UPDATE graph_nodes SET label_folded = ? WHERE namespace = ? AND id = ?", (folded, namespace, node_id))
+    conn.execute("DELETE FROM graph_label_grams WHERE namespace = ? AND node_id = ?", (namespace, node_id))
+    conn.executemany("INSERT OR IGNORE INTO graph_label_grams (namespace, gram, node_id) VALUES (?, ?, ?)",
+                     [(namespace, gram, node_id) for gram in label_grams(folded)])
+
+
+def index_graph_labels(conn):
+    """Достраивает индекс имен для узлов, у которых его еще нет (старая база или перенос из JSON)."""
+    rows = conn.execute("SELECT namespace, id, label FROM graph_nodes WHERE label_folded IS NULL").fetchall()
+    if not rows:
+        return
+    with db_write_lock, conn:
+        for row in rows:
+            index_node_label(conn, row['namespace'], row['id'], row['label'])
+    print(f"[MCP_Memory] Индекс имен графа построен для узлов: {len(rows)}.")
+
+
+def migrate_graph_json(conn):
     """
-    Проверяет, загружена ли память. Если нет - загружает ее.
-    Выполняется под замком, чтобы избежать гонки состояний.
+    Однократный перенос графа из knowledge_graph.json (формат node-link NetworkX) в таблицы graph_*
+    (пространство имен 'default'). После переноса файл переименовывается в knowledge_graph.json.migrated.
+    """
+    if not os.path.exists(GRAPH_FILE):
+        return
+    if conn.execute("SELECT 1 FROM graph_nodes LIMIT 1").fetchone():
+        print(f"[MCP_Memory] {GRAPH_FILE} не перенесен: граф в базе уже не пуст.")
+        return
+    try:
+        with open(GRAPH_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"[MCP_Memory] {GRAPH_FILE} не удалось прочитать, перенос пропущен: {e}")
+        return
+
+    nodes, edges = [], []
+    for node in data.get("nodes", []):
+        attrs = {key: value for key, value in node.items() if key not in ("id", "label", "type")}
+        nodes.append((str(node["id"]), node.get("label"), node.get("type"), json.dumps(attrs, ensure_ascii=False) if attrs else None))
+    for edge in data.get("links", data.get("edges", [])):
+        attrs = {key: value for key, value in edge.items() if key not in ("source", "target", "label")}
+        edges.append((str(edge["source"]), str(edge["target"]), edge.get("label"), json.dumps(attrs, ensure_ascii=False) if attrs else None))
+    with db_write_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO graph_nodes (id, label, type, attrs) VALUES (?, ?, ?, ?)", nodes)
+        conn.executemany("INSERT OR REPLACE INTO graph_edges (source, target, label, attrs) VALUES (?, ?, ?, ?)", edges)
+    index_graph_labels(conn)
+    os.replace(GRAPH_FILE, GRAPH_FILE + ".migrated")
+    print(f"[MCP_Memory] Граф перенесен из {GRAPH_FILE} в базу: узлов {len(nodes)}, связей {len(edges)}.")
+
+LOAD_STAGES = {"db": 1, "model": 2, "index": 3, "ready": 4}
+
+def _set_stage(stage: str):
+    load_state["stage"] = stage
+    load_state["step"] = LOAD_STAGES[stage]
+
+def ensure_db_loaded():
+    """
+    Быстрый первый этап: база памяти (тексты, FTS, граф знаний) без модели и индекса.
+    Его достаточно методам графа и лексическому поиску.
+    """
+    with db_init_lock:
+        if app_globals["conn"] is not None:
+            return
+        _set_stage("db")
+        conn = open_db()
+        # Граф знаний хранится в той же базе; старый JSON-файл переносится один раз
+        migrate_graph_json(conn)
+        app_globals["conn"] = conn
+
+def load_vector_memory():
+    """
+    Тяжелый этап: модель для векторизации и FAISS-индекс.
+    Выполняется под замком, чтобы избежать гонки состояний; ошибка сохраняется в load_state.
     """
     with initialization_lock:
-        if app_globals["model"] is not None:
+        if vector_ready.is_set() or load_state["error"] is not None:
             return
+        load_state["started_at"] = load_state["started_at"] or time.time()
+        try:
+            print("[MCP_Memory] НАЧАЛО ТЯЖЕЛОЙ ИНИЦИАЛИЗАЦИИ...")
+            ensure_db_loaded()
 
-        print("[MCP_Memory] НАЧАЛО ТЯЖЕЛОЙ ИНИЦИАЛИЗАЦИИ...")
-        
-        # 1. Модель для векторизации
-        print("[MCP_Memory] Загрузка Sentence-Transformer модели...")
-        app_globals["model"] = SentenceTransformer(MODEL_NAME)
-        print("[MCP_Memory] Модель загружена.")
-        
-        # 2. SQLite для хранения текстов
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        conn.execute("CREATE TABLE IF NOT EXISTS memory_chunks (id INTEGER PRIMARY KEY, text_content TEXT NOT NULL)")
-        app_globals["conn"] = conn
-        
-        # 3. FAISS индекс для векторов
-        embedding_dim = app_globals["model"].get_sentence_embedding_dimension()
-        if os.path.exists(FAISS_INDEX_FILE):
-            print("[MCP_Memory] Загрузка FAISS индекса...")
-            app_globals["index"] = faiss.read_index(FAISS_INDEX_FILE)
-        else:
-            print("[MCP_Memory] Создание нового FAISS индекса...")
-            app_globals["index"] = faiss.IndexIDMap(faiss.IndexFlatL2(embedding_dim))
-            
-        # 4. Граф знаний
-        print("[MCP_Memory] Загрузка графа знаний...")
-        if os.path.exists(GRAPH_FILE):
+            # 1. Модель для векторизации
+            _set_stage("model")
+            print("[MCP_Memory] Загрузка Sentence-Transformer модели...")
+            app_globals["model"] = SentenceTransformer(MODEL_NAME)
+            print("[MCP_Memory] Модель загружена.")
+
+            # 2. FAISS индекс для векторов (SQLite - источник истины, из которого индекс можно перестроить).
+            # Сразу загружается только пространство 'default', остальные - при первом обращении
+            _set_stage("index")
+            get_index(DEFAULT_NAMESPACE)
+            app_globals["batcher"] = EmbeddingBatcher()
+            app_globals["embedding_cache"] = EmbeddingCache(MODEL_NAME)
+            start_index_persister()
+            start_consolidation_scheduler()
+        except Exception as e:
+            load_state["error"] = f"{type(e).__name__}: {e}"
+            print(f"[MCP_Memory] ОШИБКА ИНИЦИАЛИЗАЦИИ: {load_state['error']}")
+            raise
+        finally:
+            load_state["finished_at"] = time.time()
+
+        _set_stage("ready")
+        vector_ready.set()
+        print(f"[MCP_Memory] ИНИЦИАЛИЗАЦИЯ ЗАВЕРШЕНА за {load_state['finished_at'] - load_state['started_at']:.1f} с.")
+
+def start_background_loading():
+    """Запускает загрузку модели и индекса в фоновом потоке, не задерживая запуск сервера."""
+    load_state["started_at"] = time.time()
+    threading.Thread(target=_background_load, name="memory-loader", daemon=True).start()
+
+def _background_load():
+    try:
+        load_vector_memory()
+    except Exception:
+        pass  # Причина уже в load_state["error"], векторные методы вернут ее вызывающему
+
+def ensure_memory_loaded():
+    """
+    Ждет готовности векторной памяти (модель и индекс). Если загрузка еще не начата - выполняет ее сама.
+    Запросы к векторным методам во время загрузки ставятся в очередь не дольше MEMORY_READY_TIMEOUT секунд.
+    """
+    if vector_ready.is_set():
+        return
+    if load_state["started_at"] is None:
+        _background_load()
+    ready = vector_ready.wait(float(os.getenv("MEMORY_READY_TIMEOUT", "100")))
+    if load_state["error"] is not None:
+        raise JsonRpcError(-32000, f"Не удалось загрузить векторную память: {load_state['error']}")
+    if not ready:
+        raise JsonRpcError(-32000, f"Векторная память еще загружается (этап: {load_state['stage']}). Повторите запрос позже.")
+
+def readiness() -> dict:
+    """Состояние загрузки для /ready."""
+    now = load_state["finished_at"] or time.time()
+    return {
+        "ready": vector_ready.is_set(),
+        "graph_ready": app_globals["conn"] is not None,
+        "stage": load_state["stage"],
+        "progress": round(load_state["step"] / load_state["steps"], 2),
+        "elapsed_s": round(now - load_state["started_at"], 1) if load_state["started_at"] else 0.0,
+        "error": load_state["error"],
+    }
+
+def _to_blob(vector) -> bytes:
+    return np.asarray(vector, dtype='float32').tobytes()
+
+
+def load_vectors(conn, min_id: int = None, namespace: str = None):
+    """
+    Векторы из memory_chunks: (ids, матрица векторов). min_id - только записи с id больше указанного,
+    namespace - только записи этого пространства имен (None - всей памяти).
+    """
+    query = "SELECT id, embedding FROM memory_chunks WHERE embedding IS NOT NULL"
+    args = []
+    if min_id is not None:
+        query += " AND id > ?"
+        args.append(min_id)
+    if namespace is not None:
+        query += " AND namespace = ?"
+        args.append(namespace)
+    rows = conn.execute(query + " ORDER BY id", args).fetchall()
+    if not rows:
+        return np.empty(0, dtype='int64'), None
+    ids = np.array([row['id'] for row in rows], dtype='int64')
+    vectors = np.frombuffer(b"".join(row['embedding'] for row in rows), dtype='float32').reshape(len(rows), -1)
+    return ids, vectors
+
+
+def index_file(namespace: str) -> str:
+    """Файл индекса пространства имен: semantic_memory.index для 'default', semantic_memory.<имя>.index для остальных."""
+    if namespace == DEFAULT_NAMESPACE:
+        return FAISS_INDEX_FILE
+    base, ext = os.path.splitext(FAISS_INDEX_FILE)
+    return f"{base}.{namespace}{ext}"
+
+
+def load_vector_index(conn, embedding_dim: int, namespace: str = DEFAULT_NAMESPACE):
+    """
+    Загружает индекс пространства имен и приводит его в соответствие с memory_chunks и настройками:
+    векторы старого semantic_memory.index переносятся в колонку embedding, записи без векторов
+    кодируются заново, а если вид индекса не совпадает с нужным - индекс перестраивается.
+    """
+    path = index_file(namespace)
+    index = None
+    if os.path.exists(path):
+        mmap = index_settings()["mmap"]
+        print(f"[MCP_Memory] Загрузка FAISS индекса '{namespace}'{' (mmap)' if mmap else ''}...")
+        index = read_index_file(path, mmap)
+        configure_search(index)
+        if mmap:
+            index = MappedIndex(index)
+
+    # Миграция: раньше векторы хранились только в индексе (до пространств имен - всегда 'default')
+    missing = conn.execute(
+        "SELECT COUNT(*) FROM memory_chunks WHERE embedding IS NULL AND namespace = ?", (namespace,)
+    ).fetchone()[0]
+    if missing and index is not None and index.ntotal:
+        print(f"[MCP_Memory] Перенос векторов из {path} в базу ({missing} записей)...")
+        ids, vectors = extract_vectors(index)
+        conn.executemany(
+            "UPDATE memory_chunks SET embedding = ? WHERE id = ? AND embedding IS NULL",
+            ((_to_blob(vector), int(id_)) for id_, vector in zip(ids, vectors))
+        )
+        conn.commit()
+    rows = conn.execute(
+        "SELECT id, text_content FROM memory_chunks WHERE embedding IS NULL AND namespace = ?", (namespace,)
+    ).fetchall()
+    if rows:
+        print(f"[MCP_Memory] Кодирование {len(rows)} записей без векторов...")
+        embeddings = app_globals["model"].encode([row['text_content'] for row in rows], batch_size=64)
+        conn.executemany(
+            "UPDATE memory_chunks SET embedding = ? WHERE id = ?",
+            ((_to_blob(vector), row['id']) for row, vector in zip(rows, embeddings))
+        )
+        conn.commit()
+
+    count = conn.execute("SELECT COUNT(*) FROM memory_chunks WHERE namespace = ?", (namespace,)).fetchone()[0]
+    kind = choose_kind(count)
+    if index is not None and index.d == embedding_dim and index_kind(index) == kind and 0 < index.ntotal < count:
+        # Файл индекса сохраняется периодически, поэтому после сбоя в нем может не хватать последних записей -
+        # база остается журналом, из которого они докладываются
+        last_id = index.last_id() if isinstance(index, MappedIndex) else int(faiss.vector_to_array(index.id_map).max())
+        indexed_in_db = conn.execute(
+            "SELECT COUNT(*) FROM memory_chunks WHERE namespace = ? AND id <= ?", (namespace, last_id)
+        ).fetchone()[0]
+        if indexed_in_db == index.ntotal:
+            ids, vectors = load_vectors(conn, min_id=last_id, namespace=namespace)
+            print(f"[MCP_Memory] Дозапись в индекс {len(ids)} записей, сохраненных после последнего сброса на диск...")
+            index.add_with_ids(vectors, ids)
+            if not isinstance(index, MappedIndex):
+                write_index_file(index, path)
+    if index is None or index.ntotal != count or index.d != embedding_dim or index_kind(index) != kind:
+        print(f"[MCP_Memory] Построение индекса '{kind}' пространства '{namespace}' для {count} записей...")
+        ids, vectors = load_vectors(conn, namespace=namespace)
+        if vectors is None:
+            vectors = np.empty((0, embedding_dim), dtype='float32')
+        index = build_index(kind, embedding_dim, vectors, ids)
+        # Пустое пространство (например, новый чат) не оставляет файла, пока в него ничего не записано
+        if count or os.path.exists(path):
+            write_index_file(index, path)
+            if index_settings()["mmap"]:
+                # Построенный индекс освобождается - дальше работаем с отображенным файлом
+                del vectors
+                index = MappedIndex(read_index_file(path, mmap=True))
+                configure_search(index)
+    print(f"[MCP_Memory] Индекс '{namespace}': {index_kind(index)}, записей: {index.ntotal}.")
+    return index
+
+
+def get_index(namespace: str = DEFAULT_NAMESPACE):
+    """
+    Индекс пространства имен. Неактивное пространство загружается при первом обращении под своим замком,
+    так что поиск в уже загруженных пространствах загрузку не ждет.
+    """
+    with index_lock:
+        index = app_globals["indexes"].get(namespace)
+        if index is not None:
+            shard_state["last_used"][namespace] = time.monotonic()
+            return index
+        lock = shard_state["locks"].setdefault(namespace, threading.Lock())
+    with lock:
+        with index_lock:
+            index = app_globals["indexes"].get(namespace)
+        if index is not None:
+            return index
+        index = load_vector_index(app_globals["conn"], app_globals["model"].get_sentence_embedding_dimension(), namespace)
+        with index_lock:
+            app_globals["indexes"][namespace] = index
+            shard_state["last_used"][namespace] = time.monotonic()
+    unload_idle_namespaces()
+    return index
+
+
+def unload_idle_namespaces():
+    """
+    Держит в памяти не больше MEMORY_MAX_LOADED_NAMESPACES индексов: давно не использованные пространства
+    сохраняются и выгружаются ('default' и перестраиваемые - никогда). Записи остаются в базе,
+    поэтому следующее обращение загрузит индекс заново и доложит в него все, что не попало в файл.
+    """
+    limit = max(1, int(os.getenv("MEMORY_MAX_LOADED_NAMESPACES", "8")))
+    while True:
+        with index_lock:
+            if len(app_globals["indexes"]) <= limit:
+                return
+            candidates = [ns for ns in app_globals["indexes"] if ns != DEFAULT_NAMESPACE and ns not in rebuild_state["running"]]
+            if not candidates:
+                return
+            victim = min(candidates, key=lambda ns: shard_state["last_used"].get(ns, 0.0))
+        save_index_now(victim)
+        with index_lock:
+            index = app_globals["indexes"].get(victim)
+            # Если в пространство успели записать - выгрузим его в следующий раз (отображенный индекс
+            # остается "измененным", пока не накопит MMAP_DELTA_LIMIT записей, его выгружаем сразу)
+            if index is None or (victim in persist_state["dirty"] and not isinstance(index, MappedIndex)):
+                return
+            del app_globals["indexes"][victim]
+            persist_state["dirty"].discard(victim)
+            shard_state["last_used"].pop(victim, None)
+        print(f"[MCP_Memory] Индекс пространства '{victim}' выгружен из памяти.")
+
+
+# --- Сохранение индекса на диск ---
+# Изменения индекса не пишутся на диск при каждой записи: пространство имен помечается измененным,
+# а его индекс сохраняется фоновым потоком раз в MEMORY_INDEX_SAVE_INTERVAL секунд и при остановке сервера.
+# Потерять при сбое можно только копию на диске - векторы остаются в memory_chunks.
+persist_state = {"dirty": set(), "thread": None}
+
+
+def mark_index_dirty(namespace: str):
+    persist_state["dirty"].add(namespace)
+
+
+def save_index_now(namespace: str = None):
+    """Сохраняет индексы измененных пространств имен (или одного указанного). Возвращает True, если что-то записано."""
+    namespaces = [namespace] if namespace is not None else list(persist_state["dirty"])
+    saved = False
+    for ns in namespaces:
+        saved = _save_namespace_index(ns) or saved
+    return saved
+
+
+def _save_namespace_index(namespace: str) -> bool:
+    """Сохраняет индекс атомарно; под замком индекс только сериализуется в память, запись идет без замка."""
+    path = index_file(namespace)
+    with index_lock:
+        index = app_globals["indexes"].get(namespace)
+        if namespace not in persist_state["dirty"] or index is None:
+            return False
+        if isinstance(index, MappedIndex):
+            return _save_mapped_index(index, namespace)
+        data = faiss.serialize_index(index)
+        persist_state["dirty"].discard(namespace)
+    tmp_path = path + ".tmp"
+    try:
+        data.tofile(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        mark_index_dirty(namespace)
+        raise
+    if index_settings()["mmap"]:
+        # Индекс в памяти (после построения) заменяется отображенным файлом, если его не успели изменить
+        with index_lock:
+            if app_globals["indexes"].get(namespace) is index and namespace not in persist_state["dirty"]:
+                mapped = MappedIndex(read_index_file(path, mmap=True))
+                configure_search(mapped)
+                app_globals["indexes"][namespace] = mapped
+    return True
+
+
+def _save_mapped_index(index, namespace: str) -> bool:
+    """
+    Отображенный индекс переписывается только когда новых записей накопилось MMAP_DELTA_LIMIT:
+    до этого они живут в delta, а после перезапуска докладываются из базы. Вызывается под index_lock.
+    """
+    if index.delta.ntotal < MMAP_DELTA_LIMIT:
+        return False
+    path = index_file(namespace)
+    write_index_file(index.materialize(), path)
+    mapped = MappedIndex(read_index_file(path, mmap=True))
+    configure_search(mapped)
+    app_globals["indexes"][namespace] = mapped
+    persist_state["dirty"].discard(namespace)
+    return True
+
+
+def start_index_persister():
+    if persist_state["thread"] is not None:
+        return
+    interval = float(os.getenv("MEMORY_INDEX_SAVE_INTERVAL", "10"))
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                save_index_now()
+            except Exception as e:
+                print(f"[MCP_Memory] Ошибка сохранения индекса: {e}")
+
+    persist_state["thread"] = threading.Thread(target=run, name="memory-index-persist", daemon=True)
+    persist_state["thread"].start()
+    atexit.register(save_index_now)
+
+
+# --- Микро-пакетное кодирование ---
+class EmbeddingBatcher:
+    """
+    Очередь на кодирование текстов. Одновременные вызовы remember из разных потоков waitress
+    собираются в одну пачку (до MEMORY_ENCODE_BATCH_SIZE текстов, ожидание до MEMORY_ENCODE_BATCH_WAIT_MS)
+    и кодируются одним вызовом модели.
+    """
+
+    def __init__(self):
+        self.max_batch = int(os.getenv("MEMORY_ENCODE_BATCH_SIZE", "64"))
+        self.max_wait = float(os.getenv("MEMORY_ENCODE_BATCH_WAIT_MS", "20")) / 1000
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="memory-encode", daemon=True)
+        self._thread.start()
+
+    def encode(self, texts: list):
+        """Кодирует тексты (блокирует вызывающий поток до готовности пачки)."""
+        futures = []
+        with self._cond:
+            for text in texts:
+                future = Future()
+                self._pending.append((text, future))
+                futures.append(future)
+            self._cond.notify()
+        return np.array([future.result() for future in futures], dtype='float32')
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Даем соседним запросам шанс попасть в ту же пачку
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                embeddings = app_globals["model"].encode([text for text, _ in batch], batch_size=len(batch))
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(np.asarray(embedding, dtype='float32'))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def rebuild_index_in_background(kind: str, reason: str, namespace: str = DEFAULT_NAMESPACE):
+    """
+    Перестраивает индекс пространства имен в фоновом потоке без остановки сервиса: поиск идет по старому индексу,
+    записи, добавленные во время построения, докладываются перед заменой.
+    """
+    with index_lock:
+        if namespace in rebuild_state["running"]:
+            return False
+        rebuild_state["running"].add(namespace)
+
+    def run():
+        try:
+            rebuild_index(kind, reason, namespace)
+        except Exception as e:
+            print(f"[MCP_Memory] Ошибка перестройки индекса '{namespace}': {e}")
+        finally:
+            rebuild_state["running"].discard(namespace)
+
+    threading.Thread(target=run, name="memory-index-rebuild", daemon=True).start()
+    return True
+
+
+def rebuild_index(kind: str, reason: str, namespace: str = DEFAULT_NAMESPACE):
+    """Строит новый индекс пространства по векторам из базы и подменяет им текущий (вызывающий выставляет rebuild_state)."""
+    started = time.perf_counter()
+    conn = app_globals["conn"]
+    ids, vectors = load_vectors(conn, namespace=namespace)
+    if vectors is None:
+        dim = app_globals["model"].get_sentence_embedding_dimension()
+        index = build_index(kind, dim, np.empty((0, dim), dtype='float32'), ids)
+        last_id = 0
+    else:
+        index = build_index(kind, vectors.shape[1], vectors, ids)
+        last_id = int(ids[-1])
+    with index_lock:
+        new_ids, new_vectors = load_vectors(conn, min_id=last_id, namespace=namespace)
+        if new_vectors is not None:
+            index.add_with_ids(new_vectors, new_ids)
+        app_globals["indexes"][namespace] = index
+        shard_state["last_used"][namespace] = time.monotonic()
+        mark_index_dirty(namespace)
+    save_index_now(namespace)
+    print(f"[MCP_Memory] Индекс '{namespace}' перестроен в '{kind}' ({reason}): {index.ntotal} записей за {time.perf_counter() - started:.1f} с.")
+
+
+def maybe_upgrade_index(namespace: str):
+    """В режиме auto переводит пространство на приблизительный индекс, когда оно перерастает порог."""
+    index = get_index(namespace)
+    kind = choose_kind(index.ntotal)
+    if kind != index_kind(index):
+        rebuild_index_in_background(kind, f"{index.ntotal} записей", namespace)
+
+
+# --- Консолидация памяти ---
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def consolidate_memory_now(threshold: float, dry_run: bool = False, namespace: str = DEFAULT_NAMESPACE) -> dict:
+    """
+    Находит в пространстве имен группы почти одинаковых записей (косинусная близость >= threshold)
+    и оставляет в каждой самую новую. Остальные переносятся в memory_superseded, таблица сжимается,
+    индекс перестраивается с подменой - поиск все это время идет по старому индексу (удаленные записи в выдачу не попадают).
+    """
+    index = get_index(namespace)
+    with index_lock:
+        if namespace in rebuild_state["running"]:
+            return {"status": "busy", "namespace": namespace, "message": "Индекс сейчас перестраивается, повторите позже."}
+        rebuild_state["running"].add(namespace)
+    try:
+        started = time.perf_counter()
+        conn = app_globals["conn"]
+        save_index_now(namespace)
+        report = {
+            "status": "ok",
+            "namespace": namespace,
+            "dry_run": dry_run,
+            "threshold": threshold,
+            "entries_before": conn.execute("SELECT COUNT(*) FROM memory_chunks WHERE namespace = ?", (namespace,)).fetchone()[0],
+            "index_vectors_before": index.ntotal,
+            "index_bytes_before": _file_size(index_file(namespace)),
+            "db_bytes_before": _file_size(DB_FILE),
+        }
+        ids, vectors = load_vectors(conn, namespace=namespace)
+        clusters = find_duplicate_clusters(ids, vectors, threshold) if vectors is not None else []
+        removed = sum(len(duplicates) for _, duplicates in clusters)
+        report.update({"clusters": len(clusters), "removed": removed})
+
+        examples = []
+        for kept_id, duplicates in clusters[:5]:
+            rows = conn.execute(
+                f"SELECT id, text_content FROM memory_chunks WHERE id IN ({', '.join('?' for _ in duplicates)}, ?)",
+                (*duplicates, kept_id)
+            ).fetchall()
+            texts = {row['id']: row['text_content'] for row in rows}
+            examples.append({"kept": texts.get(kept_id), "superseded": [texts[id_] for id_ in duplicates if id_ in texts]})
+        report["examples"] = examples
+        if dry_run or not clusters:
+            report["elapsed_s"] = round(time.perf_counter() - started, 2)
+            return report
+
+        superseded_at = time.time()
+        with db_write_lock:
+            with conn:
+                for kept_id, duplicates in clusters:
+                    placeholders = ", ".join("?" for _ in duplicates)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO memory_superseded (id, kept_id, text_content, created_at, source, superseded_at, namespace) "
+                        f"SELECT id, ?, text_content, created_at, source, ?, namespace FROM memory_chunks WHERE id IN ({placeholders})",
+                        (kept_id, superseded_at, *duplicates)
+                    )
+                    conn.execute(f"DELETE FROM memory_chunks WHERE id IN ({placeholders})", duplicates)
+                if app_globals["fts"]:
+                    conn.execute("INSERT INTO memory_fts (memory_fts) VALUES ('optimize')")
+            # VACUUM нельзя выполнять внутри транзакции; если база занята, место освободится при следующей консолидации
+            try:
+                conn.execute("VACUUM")
+            except sqlite3.OperationalError as e:
+                print(f"[MCP_Memory] Сжатие базы пропущено: {e}")
+
+        remaining = report["entries_before"] - removed
+        rebuild_index(choose_kind(remaining), f"консолидация, удалено {removed}", namespace)
+        report.update({
+            "entries_after": conn.execute("SELECT COUNT(*) FROM memory_chunks WHERE namespace = ?", (namespace,)).fetchone()[0],
+            "index_vectors_after": get_index(namespace).ntotal,
+            "index_bytes_after": _file_size(index_file(namespace)),
+            "db_bytes_after": _file_size(DB_FILE),
+            "elapsed_s": round(time.perf_counter() - started, 2),
+        })
+        print(f"[MCP_Memory] Консолидация '{namespace}': групп {len(clusters)}, удалено записей {removed}, "
+              f"векторов в индексе {report['index_vectors_before']} -> {report['index_vectors_after']}.")
+        return report
+    finally:
+        rebuild_state["running"].discard(namespace)
+
+
+def start_consolidation(threshold: float, namespaces: list) -> bool:
+    """
+    Запускает консолидацию пространств имен (по очереди) в фоновом потоке;
+    отчеты сохраняются в consolidation_state["last_reports"].
+    """
+    with index_lock:
+        if consolidation_state["running"]:
+            return False
+        consolidation_state["running"] = True
+
+    def run():
+        for namespace in namespaces:
             try:
-                with open(GRAPH_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # ИСПРАВЛЕНО: Явно указываем параметр `edges`, чтобы убрать FutureWarning
-                    app_globals["graph"] = json_graph.node_link_graph(data, edges="links") 
-            except (json.JSONDecodeError, nx.NetworkXError):
-                app_globals["graph"] = nx.DiGraph()
+                report = consolidate_memory_now(threshold, namespace=namespace)
+            except Exception as e:
+                report = {"status": "error", "namespace": namespace, "message": str(e)}
+                print(f"[MCP_Memory] Ошибка консолидации памяти '{namespace}': {e}")
+            report["finished_at"] = datetime.now().isoformat(timespec='seconds')
+            consolidation_state["last_reports"][namespace] = report
+        consolidation_state["running"] = False
+
+    threading.Thread(target=run, name="memory-consolidation", daemon=True).start()
+    return True
+
+
+def start_consolidation_scheduler():
+    """
+    Периодическая консолидация раз в MEMORY_CONSOLIDATE_INTERVAL секунд (0 - выключена).
+    Обходит только загруженные пространства имен: неактивные не изменились и не загружаются ради нее.
+    """
+    interval = float(os.getenv("MEMORY_CONSOLIDATE_INTERVAL", "0"))
+    if interval <= 0 or consolidation_state["thread"] is not None:
+        return
+    threshold = float(os.getenv("MEMORY_DEDUP_THRESHOLD", "0.95"))
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with index_lock:
+                namespaces = list(app_globals["indexes"])
+            start_consolidation(threshold, namespaces)
+
+    consolidation_state["thread"] = threading.Thread(target=run, name="memory-consolidation-scheduler", daemon=True)
+    consolidation_state["thread"].start()
+
+
+# --- Кэш эмбеддингов ---
+def normalize_text(text: str) -> str:
+    """Нормализация перед кодированием и для ключа кэша: NFKC и схлопнутые пробелы."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class EmbeddingCache:
+    """
+    Кэш векторов текстов: LRU в памяти и таблица embedding_cache в базе памяти.
+    Ключ - хэш нормализованного текста вместе с именем модели, поэтому смена модели не отдает чужие векторы.
+    Общий для remember и recall.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.max_memory = int(os.getenv("MEMORY_EMBEDDING_CACHE_SIZE", "4096"))
+        self.max_disk = int(os.getenv("MEMORY_EMBEDDING_CACHE_DISK_SIZE", "100000"))
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        # Отдельное соединение: кэш не должен ждать запись в memory_chunks
+        self._conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, model TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._writes = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: list) -> dict:
+        """{нормализованный текст: вектор} для найденных в кэше."""
+        found, on_disk = {}, {}
+        with self._lock:
+            for text in texts:
+                key = self.key(text)
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    found[text] = vector
+                else:
+                    on_disk[key] = text
+            if on_disk:
+                placeholders = ", ".join("?" for _ in on_disk)
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})", tuple(on_disk)
+                ).fetchall()
+                now = time.time()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype='float32')
+                    found[on_disk[key]] = vector
+                    self._remember_in_memory(key, vector)
+                    self._counters["disk_hits"] += 1
+                if rows:
+                    self._conn.executemany("UPDATE embedding_cache SET last_used = ? WHERE key = ?", ((now, key) for key, _ in rows))
+                    self._conn.commit()
+                self._counters["misses"] += len(on_disk) - len(rows)
+        return found
+
+    def put_many(self, items: dict):
+        now = time.time()
+        with self._lock:
+            rows = []
+            for text, vector in items.items():
+                key = self.key(text)
+                self._remember_in_memory(key, vector)
+                rows.append((key, self.model_name, _to_blob(vector), now))
+            self._conn.executemany("INSERT OR REPLACE INTO embedding_cache (key, model, embedding, last_used) VALUES (?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            # Старые записи вытесняются не на каждой записи, а примерно раз в тысячу
+            if self._writes >= 1000:
+                self._writes = 0
+                self._conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN (SELECT key FROM embedding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk,)
+                )
+            self._conn.commit()
+
+    def _remember_in_memory(self, key: str, vector):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_memory:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._lru)
+            stats["disk_entries"] = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def encode_texts(texts: list, batched: bool = True) -> np.ndarray:
+    """
+    Векторы текстов через кэш эмбеддингов. Промахи кодируются моделью: через общую очередь
+    (batched=True, для записи) или сразу (для запросов recall, которым важна задержка).
+    """
+    normalized = [normalize_text(text) for text in texts]
+    cache = app_globals["embedding_cache"]
+    found = cache.get_many(list(dict.fromkeys(normalized)))
+    missing = [text for text in dict.fromkeys(normalized) if text not in found]
+    if missing:
+        if batched:
+            vectors = app_globals["batcher"].encode(missing)
         else:
-            app_globals["graph"] = nx.DiGraph()
+            vectors = np.asarray(app_globals["model"].encode(missing), dtype='float32')
+        computed = dict(zip(missing, vectors))
+        cache.put_many(computed)
+        found.update(computed)
+    return np.array([found[text] for text in normalized], dtype='float32')
 
-        print("[MCP_Memory] ИНИЦИАЛИЗАЦИЯ ЗАВЕРШЕНА.")
 
 # --- Описания функций для ИИ ---
 MEMORY_FUNCTIONS = [
     {
         "name": "remember",
+        "invalidates": ["recall"],
         "description": "Сохраняет фрагмент текста (факт, идею) в семантическую память для поиска по смыслу.",
-        "parameters": {"type": "object", "properties": {"text_chunk": {"type": "string"}}, "required": ["text_chunk"]}
+        "parameters": {"type": "object", "properties": {
+            "text_chunk": {"type": "string"},
+            "source": {"type": "string", "description": "Необязательный источник факта (например, telegram, web, user), по нему можно фильтровать recall."}
+        }, "required": ["text_chunk"]}
+    },
+    {
+        "name": "remember_batch",
+        "invalidates": ["recall"],
+        "description": "Сохраняет сразу несколько фрагментов текста в семантическую память. Используй для импорта документа или истории переписки, разбитых на отдельные факты.",
+        "parameters": {"type": "object", "properties": {
+            "text_chunks": {"type": "array", "items": {"type": "string"}},
+            "source": {"type": "string", "description": "Необязательный общий источник всех фрагментов."}
+        }, "required": ["text_chunks"]}
     },
     {
         "name": "recall",
-        "description": "Ищет в семантической памяти информацию, похожую по смыслу на запрос.",
-        "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+        # Только повторы в пределах хода: фоновая консолидация и перестройка индекса меняют записи без вызовов агента
+        "cache": {"ttl": 1},
+        "description": "Ищет в памяти информацию по запросу: по смыслу и по точным словам одновременно (имена, ID, редкие термины находятся и без перефразирования). Можно сузить поиск по времени записи и источнику.",
+        "parameters": {"type": "object", "properties": {
+            "query": {"type": "string"},
+            "top_k": {"type": "integer", "description": f"Сколько воспоминаний вернуть (по умолчанию 3, не больше {RECALL_MAX_TOP_K})."},
+            "mode": {"type": "string", "enum": ["hybrid", "vector", "lexical"], "description": "hybrid (по умолчанию) - смысл и слова, vector - только по смыслу, lexical - только по словам."},
+            "since": {"type": "string", "description": "Только записи не раньше этой даты/времени (ISO 8601, например 2024-05-01)."},
+            "until": {"type": "string", "description": "Только записи не позже этой даты/времени (ISO 8601)."},
+            "source": {"type": "string", "description": "Только записи с этим источником (как был указан при remember)."}
+        }, "required": ["query"]}
     },
     {
         "name": "create_entity",
@@ -95,13 +977,34 @@ MEMORY_FUNCTIONS = [
     },
     {
         "name": "find_entity_by_label",
-        "description": "Ищет в графе знаний ID сущности по ее человеко-понятному имени (label). Важнейшая функция для идентификации.",
-        "parameters": {"type": "object", "properties": {"label": {"type": "string"}}, "required": ["label"]}
+        # Граф меняется только методами-записями этого сервера (они сбрасывают кэш), фоновые задачи его не трогают
+        "cache": {"ttl": 600},
+        "description": "Ищет в графе знаний ID сущности по ее человеко-понятному имени (label) без учета регистра. Важнейшая функция для идентификации. Если точное имя неизвестно, используй match='prefix' (начало имени) или match='fuzzy' (похожие имена, с оценкой score).",
+        "parameters": {"type": "object", "properties": {
+            "label": {"type": "string"},
+            "match": {"type": "string", "enum": ["exact", "prefix", "fuzzy"], "description": "Режим сравнения имени. По умолчанию exact."},
+            "limit": {"type": "integer", "description": f"Максимум найденных сущностей (по умолчанию {GRAPH_DEFAULT_LIMIT}, не больше {GRAPH_MAX_LIMIT})."}
+        }, "required": ["label"]}
     },
      {
         "name": "get_entity_details",
+        "cache": {"ttl": 600},
         "description": "Получает всю информацию о сущности и ее связях по ID. Позволяет понять, с кем или чем связан объект.",
-        "parameters": {"type": "object", "properties": {"node_id": {"type": "string"}}, "required": ["node_id"]}
+        "parameters": {"type": "object", "properties": {
+            "node_id": {"type": "string"},
+            "limit": {"type": "integer", "description": f"Максимум возвращаемых связей (по умолчанию и не больше {GRAPH_MAX_LIMIT})."}
+        }, "required": ["node_id"]}
+    },
+    {
+        "name": "get_neighborhood",
+        "cache": {"ttl": 600},
+        "description": "Возвращает окрестность сущности в графе знаний: связанные с ней сущности на расстоянии до depth связей (с полем distance) и связи между ними. Используй, чтобы за один вызов увидеть контекст вокруг объекта вместо цепочки get_entity_details.",
+        "parameters": {"type": "object", "properties": {
+            "node_id": {"type": "string"},
+            "depth": {"type": "integer", "description": f"Глубина обхода, от 1 до {GRAPH_MAX_DEPTH}. По умолчанию 1."},
+            "direction": {"type": "string", "enum": ["both", "out", "in"], "description": "Какие связи обходить: исходящие, входящие или все (по умолчанию)."},
+            "limit": {"type": "integer", "description": f"Максимум сущностей в ответе (по умолчанию {GRAPH_DEFAULT_LIMIT}, не больше {GRAPH_MAX_LIMIT})."}
+        }, "required": ["node_id"]}
     },
     {
         "name": "update_entity_label",
@@ -113,120 +1016,508 @@ MEMORY_FUNCTIONS = [
 # --- Класс ошибки и хелперы ---
 class JsonRpcError(Exception):
     def __init__(self, code, message): self.code, self.message = code, message
-def make_error_response(id_, code, message): return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-def make_success_response(id_, result): return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
+
+def _namespace(params) -> str:
+    """
+    Пространство имен вызова. Параметр не описан в схеме для модели - его подставляет агент
+    (чат или профиль суб-агента); без него используется 'default'.
+    """
+    namespace = params.get('namespace') or DEFAULT_NAMESPACE
+    if not isinstance(namespace, str) or not NAMESPACE_RE.match(namespace):
+        raise JsonRpcError(-32602, "Параметр 'namespace' может содержать только латиницу, цифры, '_', '-', '.' (до 64 символов).")
+    return namespace
 
 # --- Реализация методов ---
+def store_memories(texts: list, source: str = None, namespace: str = DEFAULT_NAMESPACE) -> list:
+    """Кодирует и сохраняет тексты одной транзакцией и одним добавлением в индекс пространства. Возвращает их id."""
+    embeddings = encode_texts(texts)
+    created_at = time.time()
+    get_index(namespace)
+    with index_lock:
+        conn = app_globals["conn"]
+        ids = []
+        with db_write_lock, conn:
+            for text, embedding in zip(texts, embeddings):
+                cursor = conn.execute(
+                    "INSERT INTO memory_chunks (text_content, embedding, created_at, source, namespace) VALUES (?, ?, ?, ?, ?)",
+                    (text, _to_blob(embedding), created_at, source, namespace)
+                )
+                ids.append(cursor.lastrowid)
+        # Если индекс успели выгрузить, записи попадут в него из базы при следующей загрузке
+        index = app_globals["indexes"].get(namespace)
+        if index is not None:
+            index.add_with_ids(embeddings, np.array(ids, dtype='int64'))
+            mark_index_dirty(namespace)
+    maybe_upgrade_index(namespace)
+    return ids
+
 def remember(params):
     ensure_memory_loaded()
     text = params['text_chunk']
     if not text.strip(): raise JsonRpcError(-32602, "Нельзя запомнить пустой текст.")
-    cursor = app_globals["conn"].cursor()
-    cursor.execute("INSERT INTO memory_chunks (text_content) VALUES (?)", (text,))
-    app_globals["conn"].commit()
-    text_id = cursor.lastrowid
-    embedding = app_globals["model"].encode([text])[0].astype('float32')
-    app_globals["index"].add_with_ids(np.array([embedding]), np.array([text_id]))
-    faiss.write_index(app_globals["index"], FAISS_INDEX_FILE)
+    text_id = store_memories([text], params.get('source'), _namespace(params))[0]
     return {"status": "ok", "memory_id": text_id}
 
-def recall(params):
+def remember_batch(params):
     ensure_memory_loaded()
-    query, top_k = params['query'], params.get('top_k', 3)
-    if app_globals["index"].ntotal == 0: return {"status": "empty"}
-    query_embedding = app_globals["model"].encode([query])[0].astype('float32')
-    num_to_search = min(top_k * 2, app_globals["index"].ntotal)
-    distances, ids = app_globals["index"].search(np.array([query_embedding]), num_to_search)
-    found_ids = tuple(int(id_) for id_ in ids[0] if id_ != -1)
-    if not found_ids: return {"status": "not_found"}
-    cursor = app_globals["conn"].cursor()
-    placeholders = ','.join('?' for _ in found_ids)
-    cursor.execute(f"SELECT id, text_content FROM memory_chunks WHERE id IN ({placeholders})", found_ids)
-    rows_map = {row['id']: row['text_content'] for row in cursor.fetchall()}
-    results = [{"relevance": round(float(np.exp(-dist / 2)), 2), "memory": rows_map[id_]} for id_, dist in zip(found_ids, distances[0]) if id_ in rows_map]
-    results.sort(key=lambda x: x['relevance'], reverse=True)
-    return {"status": "ok", "recalled_memories": results[:top_k]}
-
-def save_graph():
-    data = json_graph.node_link_data(app_globals["graph"])
-    with open(GRAPH_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    texts = params.get('text_chunks')
+    if not isinstance(texts, list) or not texts:
+        raise JsonRpcError(-32602, "Параметр 'text_chunks' должен быть непустым списком строк.")
+    texts = [text for text in texts if isinstance(text, str) and text.strip()]
+    if not texts: raise JsonRpcError(-32602, "Нельзя запомнить пустой текст.")
+    ids = store_memories(texts, params.get('source'), _namespace(params))
+    return {"status": "ok", "memory_ids": ids, "count": len(ids)}
+
+def _parse_time(value, name: str):
+    """Граница фильтра времени: unix-время или дата/время ISO 8601 (локальное, если без пояса)."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        raise JsonRpcError(-32602, f"Параметр '{name}' должен быть датой ISO 8601 (например, 2024-05-01) или unix-временем.")
+
+def _recall_filters(params):
+    """Условие SQL по метаданным memory_chunks и его аргументы (None, если фильтров нет)."""
+    conditions, args = [], []
+    since, until = _parse_time(params.get('since'), 'since'), _parse_time(params.get('until'), 'until')
+    if since is not None:
+        conditions.append("created_at >= ?")
+        args.append(since)
+    if until is not None:
+        conditions.append("created_at <= ?")
+        args.append(until)
+    if params.get('source'):
+        conditions.append("source = ?")
+        args.append(params['source'])
+    if not conditions:
+        return None, ()
+    return " AND ".join(conditions), tuple(args)
+
+def _vector_search(namespace: str, query_embedding, count: int, where: str, args: tuple) -> list:
+    """Ближайшие по смыслу записи пространства имен: [(id, расстояние L2)] по возрастанию расстояния."""
+    conn = app_globals["conn"]
+    index = get_index(namespace)
+    if where is None:
+        with index_lock:
+            # Индекс могли перестроить после get_index - берем текущий
+            index = app_globals["indexes"].get(namespace, index)
+            if index.ntotal == 0:
+                return []
+            distances, ids = index.search(np.array([query_embedding]), min(count, index.ntotal))
+        return [(int(id_), float(dist)) for id_, dist in zip(ids[0], distances[0]) if id_ != -1]
+
+    where, args = f"namespace = ? AND {where}", (namespace, *args)
+    allowed = conn.execute(f"SELECT id FROM memory_chunks WHERE {where} LIMIT ?", (*args, RECALL_EXACT_FILTER_LIMIT + 1)).fetchall()
+    if not allowed:
+        return []
+    if len(allowed) <= RECALL_EXACT_FILTER_LIMIT:
+        # Немного записей после фильтра - точное расстояние по векторам из базы (HNSW с фильтром теряет соседей)
+        ids, vectors = [], []
+        for row in conn.execute(f"SELECT id, embedding FROM memory_chunks WHERE {where} AND embedding IS NOT NULL", args):
+            ids.append(row['id'])
+            vectors.append(row['embedding'])
+        if not ids:
+            return []
+        matrix = np.frombuffer(b"".join(vectors), dtype='float32').reshape(len(ids), -1)
+        distances = ((matrix - query_embedding) ** 2).sum(axis=1)
+        order = np.argsort(distances)[:count]
+        return [(ids[i], float(distances[i])) for i in order]
+
+    # Много записей - поиск по индексу с ограничением допустимых id
+    allowed_ids = np.array([row['id'] for row in conn.execute(f"SELECT id FROM memory_chunks WHERE {where}", args)], dtype='int64')
+    with index_lock:
+        index = app_globals["indexes"].get(namespace, index)
+        distances, ids = search_filtered(index, np.array([query_embedding]), min(count, index.ntotal), allowed_ids)
+    return [(int(id_), float(dist)) for id_, dist in zip(ids[0], distances[0]) if id_ != -1]
+
+def _fts_query(query: str):
+    """
+    Запрос FTS5 из свободного текста: слова в кавычках через OR (ранжирование делает BM25).
+    Составные токены вроде XK-42 или user@mail становятся фразой, чтобы совпадали целиком.
+    """
+    terms = []
+    for token in query.split():
+        words = re.findall(r"\w+", token)
+        if words:
+            terms.append('"' + " ".join(words) + '"')
+    return " OR ".join(dict.fromkeys(terms)) or None
+
+def _lexical_search(namespace: str, query: str, count: int, where: str, args: tuple) -> list:
+    """Записи пространства имен с совпадающими словами: [(id, оценка BM25)] от лучшей к худшей (в FTS5 меньше - лучше)."""
+    match = _fts_query(query)
+    if not app_globals["fts"] or match is None:
+        return []
+    sql = (
+        "SELECT memory_fts.rowid AS id, bm25(memory_fts) AS score FROM memory_fts "
+        "JOIN memory_chunks ON memory_chunks.id = memory_fts.rowid WHERE memory_fts MATCH ? AND memory_chunks.namespace = ?"
+    )
+    if where is not None:
+        sql += f" AND {where}"
+    rows = app_globals["conn"].execute(sql + " ORDER BY score LIMIT ?", (match, namespace, *args, count)).fetchall()
+    return [(row['id'], row['score']) for row in rows]
+
+def recall(params):
+    ensure_db_loaded()
+    query = params['query']
+    namespace = _namespace(params)
+    top_k = max(1, min(int(params.get('top_k', 3)), RECALL_MAX_TOP_K))
+    mode = params.get('mode', 'hybrid' if app_globals["fts"] else 'vector')
+    if mode not in ('hybrid', 'vector', 'lexical'):
+        raise JsonRpcError(-32602, f"Неизвестный режим '{mode}'. Допустимо: hybrid, vector, lexical.")
+    if mode != 'vector' and not app_globals["fts"]:
+        mode = 'vector'
+    # Лексическому поиску модель не нужна - он работает и во время загрузки
+    if mode != 'lexical':
+        ensure_memory_loaded()
+        if get_index(namespace).ntotal == 0: return {"status": "empty"}
+    where, args = _recall_filters(params)
+    candidates = max(RECALL_CANDIDATES, top_k)
+
+    vector_hits = _vector_search(namespace, encode_texts([query], batched=False)[0], candidates, where, args) if mode != 'lexical' else []
+    lexical_hits = _lexical_search(namespace, query, candidates, where, args) if mode != 'vector' else []
+
+    # Слияние рангов (reciprocal rank fusion): оценки двух поисков несравнимы, ранги - сравнимы
+    fused, distances, matched = {}, {}, {}
+    for kind, hits in (("vector", vector_hits), ("lexical", lexical_hits)):
+        for rank, (id_, score) in enumerate(hits, start=1):
+            fused[id_] = fused.get(id_, 0.0) + 1.0 / (RECALL_RRF_K + rank)
+            matched.setdefault(id_, []).append(kind)
+            if kind == "vector":
+                distances[id_] = score
+    if not fused: return {"status": "not_found"}
+    best_ids = sorted(fused, key=fused.get, reverse=True)[:top_k]
+
+    placeholders = ','.join('?' for _ in best_ids)
+    rows_map = {
+        row['id']: row for row in app_globals["conn"].execute(
+            f"SELECT id, text_content, created_at, source FROM memory_chunks WHERE id IN ({placeholders})", best_ids
+        )
+    }
+    results = []
+    for id_ in best_ids:
+        row = rows_map.get(id_)
+        if row is None:
+            continue
+        item = {"memory_id": id_, "memory": row['text_content'], "score": round(fused[id_], 4), "matched": matched[id_]}
+        if id_ in distances:
+            item["relevance"] = round(float(np.exp(-distances[id_] / 2)), 2)
+        if row['created_at'] is not None:
+            item["created_at"] = datetime.fromtimestamp(row['created_at']).isoformat(timespec='seconds')
+        if row['source'] is not None:
+            item["source"] = row['source']
+        results.append(item)
+    return {"status": "ok", "mode": mode, "recalled_memories": results}
+
+def _node_dict(row) -> dict:
+    node = {"id": row['id']}
+    if row['label'] is not None: node['label'] = row['label']
+    if row['type'] is not None: node['type'] = row['type']
+    if row['attrs']: node.update(json.loads(row['attrs']))
+    return node
+
+def _get_node(namespace, node_id):
+    return app_globals["conn"].execute(
+        "SELECT id, label, type, attrs FROM graph_nodes WHERE namespace = ? AND id = ?", (namespace, node_id)
+    ).fetchone()
 
 def create_entity(params):
-    ensure_memory_loaded()
+    ensure_db_loaded()
     node_id, label, node_type = params['node_id'], params['label'], params['node_type']
-    app_globals["graph"].add_node(node_id, label=label, type=node_type)
-    save_graph()
+    namespace = _namespace(params)
+    conn = app_globals["conn"]
+    with db_write_lock, conn:
+        # Повторное создание обновляет имя и тип, сохраняя остальные атрибуты и связи
+        conn.execute(
+            "INSERT INTO graph_nodes (namespace, id, label, type) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(namespace, id) DO UPDATE SET label = excluded.label, type = excluded.type",
+            (namespace, node_id, label, node_type)
+        )
+        index_node_label(conn, namespace, node_id, label)
     return {"status": "ok", "message": f"Сущность '{label}' создана с ID '{node_id}'."}
 
 def link_entities(params):
-    ensure_memory_loaded()
+    ensure_db_loaded()
     source_id, target_id, relation = params['source_id'], params['target_id'], params['relation']
-    if not app_globals["graph"].has_node(source_id) or not app_globals["graph"].has_node(target_id):
-        raise JsonRpcError(-32602, "Одна или обе сущности не существуют. Сначала создайте их.")
-    app_globals["graph"].add_edge(source_id, target_id, label=relation)
-    save_graph()
+    namespace = _namespace(params)
+    conn = app_globals["conn"]
+    with db_write_lock, conn:
+        if _get_node(namespace, source_id) is None or _get_node(namespace, target_id) is None:
+            raise JsonRpcError(-32602, "Одна или обе сущности не существуют. Сначала создайте их.")
+        conn.execute(
+            "INSERT INTO graph_edges (namespace, source, target, label) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(namespace, source, target) DO UPDATE SET label = excluded.label",
+            (namespace, source_id, target_id, relation)
+        )
     return {"status": "ok", "message": f"Связь '{relation}' установлена."}
 
+def _limit(params, default=GRAPH_DEFAULT_LIMIT) -> int:
+    try:
+        limit = int(params.get('limit', default))
+    except (TypeError, ValueError):
+        raise JsonRpcError(-32602, "Параметр 'limit' должен быть целым числом.")
+    return max(1, min(limit, GRAPH_MAX_LIMIT))
+
+def _depth(params) -> int:
+    try:
+        depth = int(params.get('depth', 1))
+    except (TypeError, ValueError):
+        raise JsonRpcError(-32602, "Параметр 'depth' должен быть целым числом.")
+    return max(1, min(depth, GRAPH_MAX_DEPTH))
+
+def _relation_dict(row) -> dict:
+    return {"source": row['source'], "target": row['target'], "relation": row['label']}
+
 def find_entity_by_label(params):
-    ensure_memory_loaded()
-    label_to_find = params['label'].lower()
-    found_nodes = [{"id": node, **data} for node, data in app_globals["graph"].nodes(data=True) if data.get('label', '').lower() == label_to_find]
-    return {"entities": found_nodes} if found_nodes else {"status": "not_found"}
+    ensure_db_loaded()
+    query = fold_label(params['label'])
+    match = params.get('match', 'exact')
+    limit = _limit(params)
+    namespace = _namespace(params)
+    conn = app_globals["conn"]
+    columns = "id, label, type, attrs, label_folded"
+
+    if match == 'exact':
+        rows = conn.execute(
+            f"SELECT {columns} FROM graph_nodes WHERE namespace = ? AND label_folded = ? LIMIT ?", (namespace, query, limit + 1)
+        ).fetchall()
+        found = [_node_dict(row) for row in rows]
+    elif match == 'prefix':
+        # Диапазон по индексу вместо LIKE: LIKE без учета регистра индекс не использует
+        rows = conn.execute(
+            f"SELECT {columns} FROM graph_nodes WHERE namespace = ? AND label_folded >= ? AND label_folded < ? "
+            "ORDER BY label_folded LIMIT ?",
+            (namespace, query, query + "\U0010ffff", limit + 1)
+        ).fetchall()
+        found = [_node_dict(row) for row in rows]
+    elif match == 'fuzzy':
+        # Кандидаты - узлы с наибольшим числом общих триграмм, затем точная оценка похожести
+        grams = list(label_grams(query))
+        if not grams:
+            return {"status": "not_found"}
+        placeholders = ", ".join("?" for _ in grams)
+        candidates = conn.execute(
+            f"SELECT node_id FROM graph_label_grams WHERE namespace = ? AND gram IN ({placeholders}) "
+            f"GROUP BY node_id ORDER BY COUNT(*) DESC LIMIT ?",
+            (namespace, *grams, max(limit * 5, 50))
+        ).fetchall()
+        ids = [row['node_id'] for row in candidates]
+        rows = conn.execute(
+            f"SELECT {columns} FROM graph_nodes WHERE namespace = ? AND id IN ({', '.join('?' for _ in ids)})", (namespace, *ids)
+        ).fetchall() if ids else []
+        scored = []
+        for row in rows:
+            score = difflib.SequenceMatcher(None, query, row['label_folded'] or "").ratio()
+            if score >= GRAPH_FUZZY_MIN_SCORE:
+                scored.append((score, row))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        found = [dict(_node_dict(row), score=round(score, 3)) for score, row in scored[:limit + 1]]
+    else:
+        raise JsonRpcError(-32602, f"Неизвестный режим поиска '{match}'. Допустимо: exact, prefix, fuzzy.")
+
+    if not found:
+        return {"status": "not_found"}
+    result = {"entities": found[:limit]}
+    if len(found) > limit:
+        result["truncated"] = True
+    return result
 
 def get_entity_details(params):
-    ensure_memory_loaded()
+    ensure_db_loaded()
     node_id = params['node_id']
-    if not app_globals["graph"].has_node(node_id):
+    limit = _limit(params, GRAPH_MAX_LIMIT)
+    namespace = _namespace(params)
+    row = _get_node(namespace, node_id)
+    if row is None:
         return {"status": "not_found"}
-    details = {"node": {"id": node_id, **app_globals["graph"].nodes[node_id]}}
-    details["relations"] = [{"source": u, "target": v, "relation": d.get('label')} for u, v, d in app_globals["graph"].edges(data=True) if u == node_id or v == node_id]
+    details = {"node": _node_dict(row)}
+    # Исходящие связи - по первичному ключу (namespace, source, target), входящие - по индексу (namespace, target)
+    edges = app_globals["conn"].execute(
+        "SELECT source, target, label FROM graph_edges WHERE namespace = ? AND source = ? UNION ALL "
+        "SELECT source, target, label FROM graph_edges WHERE namespace = ? AND target = ? AND source != ? LIMIT ?",
+        (namespace, node_id, namespace, node_id, node_id, limit + 1)
+    ).fetchall()
+    details["relations"] = [_relation_dict(edge) for edge in edges[:limit]]
+    if len(edges) > limit:
+        details["truncated"] = True
     return details
 
+def get_neighborhood(params):
+    """Окрестность сущности: узлы на расстоянии до depth связей и связи между ними (обход в ширину по слоям)."""
+    ensure_db_loaded()
+    node_id = params['node_id']
+    depth = _depth(params)
+    limit = _limit(params)
+    direction = params.get('direction', 'both')
+    if direction not in ('both', 'out', 'in'):
+        raise JsonRpcError(-32602, f"Неизвестное направление '{direction}'. Допустимо: both, out, in.")
+    namespace = _namespace(params)
+    if _get_node(namespace, node_id) is None:
+        return {"status": "not_found"}
+
+    conn = app_globals["conn"]
+    distances = {node_id: 0}
+    relations, seen_edges = [], set()
+    frontier = [node_id]
+    truncated = False
+    for level in range(1, depth + 1):
+        if not frontier or len(relations) >= GRAPH_MAX_RELATIONS:
+            break
+        placeholders = ", ".join("?" for _ in frontier)
+        parts, args = [], []
+        if direction in ('both', 'out'):
+            parts.append(f"SELECT source, target, label FROM graph_edges WHERE namespace = ? AND source IN ({placeholders})")
+            args.extend((namespace, *frontier))
+        if direction in ('both', 'in'):
+            parts.append(f"SELECT source, target, label FROM graph_edges WHERE namespace = ? AND target IN ({placeholders})")
+            args.extend((namespace, *frontier))
+        edges = conn.execute(" UNION ".join(parts) + " LIMIT ?", (*args, GRAPH_MAX_RELATIONS + 1)).fetchall()
+        if len(edges) > GRAPH_MAX_RELATIONS:
+            truncated = True
+
+        next_frontier = []
+        for edge in edges:
+            key = (edge['source'], edge['target'])
+            if key in seen_edges:
+                continue
+            for neighbor in key:
+                if neighbor not in distances:
+                    if len(distances) > limit:
+                        truncated = True
+                        break
+                    distances[neighbor] = level
+                    next_frontier.append(neighbor)
+            if key[0] in distances and key[1] in distances and len(relations) < GRAPH_MAX_RELATIONS:
+                seen_edges.add(key)
+                relations.append(_relation_dict(edge))
+        frontier = next_frontier
+
+    ids = list(distances)
+    rows = conn.execute(
+        f"SELECT id, label, type, attrs FROM graph_nodes WHERE namespace = ? AND id IN ({', '.join('?' for _ in ids)})", (namespace, *ids)
+    ).fetchall()
+    nodes = sorted((dict(_node_dict(row), distance=distances[row['id']]) for row in rows), key=lambda node: node['distance'])
+    result = {"center": node_id, "depth": depth, "nodes": nodes, "relations": relations}
+    if truncated:
+        result["truncated"] = True
+    return result
+
 def update_entity_label(params):
-    ensure_memory_loaded()
+    ensure_db_loaded()
     node_id, new_label = params['node_id'], params['new_label']
-    if not app_globals["graph"].has_node(node_id):
+    namespace = _namespace(params)
+    conn = app_globals["conn"]
+    with db_write_lock, conn:
+        updated = conn.execute(
+            "UPDATE graph_nodes SET label = ? WHERE namespace = ? AND id = ?", (new_label, namespace, node_id)
+        ).rowcount
+        if updated:
+            index_node_label(conn, namespace, node_id, new_label)
+    if not updated:
         raise JsonRpcError(-32602, f"Сущность с ID '{node_id}' не найдена. Сначала создайте ее.")
-    
-    app_globals["graph"].nodes[node_id]['label'] = new_label
-    save_graph()
     return {"status": "ok", "message": f"Имя для сущности '{node_id}' обновлено на '{new_label}'."}
 
+def get_memory_stats(params):
+    """
+    Служебный метод (не предлагается модели): записи и индекс каждого пространства имен
+    (index = null - пространство сейчас не загружено) и метрики кэша эмбеддингов.
+    """
+    ensure_memory_loaded()
+    namespaces = {
+        row['namespace']: {"entries": row['entries'], "index": None} for row in app_globals["conn"].execute(
+            "SELECT namespace, COUNT(*) AS entries FROM memory_chunks GROUP BY namespace"
+        )
+    }
+    with index_lock:
+        for namespace, index in app_globals["indexes"].items():
+            info = {"kind": index_kind(index), "vectors": index.ntotal, "rebuilding": namespace in rebuild_state["running"]}
+            if isinstance(index, MappedIndex):
+                info["mmap"] = {"file_vectors": index.base.ntotal, "pending_vectors": index.delta.ntotal}
+            namespaces.setdefault(namespace, {"entries": 0})["index"] = info
+    stats = {"namespaces": namespaces, "embedding_cache": app_globals["embedding_cache"].stats()}
+    stats["consolidation"] = {"running": consolidation_state["running"], "last_reports": consolidation_state["last_reports"]}
+    return stats
+
+def consolidate_memory(params):
+    """
+    Служебный метод (не предлагается модели): удаление почти одинаковых записей в пространстве имен.
+    По умолчанию запускается в фоне (отчет - в get_memory_stats); dry_run или wait - синхронно с отчетом.
+    """
+    ensure_memory_loaded()
+    namespace = _namespace(params)
+    threshold = float(params.get("threshold", os.getenv("MEMORY_DEDUP_THRESHOLD", "0.95")))
+    if not 0 < threshold <= 1:
+        raise JsonRpcError(-32602, "Параметр 'threshold' должен быть в диапазоне (0, 1].")
+    if params.get("dry_run") or params.get("wait"):
+        return consolidate_memory_now(threshold, dry_run=bool(params.get("dry_run")), namespace=namespace)
+    if not start_consolidation(threshold, [namespace]):
+        return {"status": "running", "message": "Консолидация уже выполняется."}
+    return {"status": "started", "namespace": namespace, "threshold": threshold}
+
+def evaluate_index(params):
+    """
+    Служебный метод (не предлагается модели): сравнивает виды индекса на текущих данных -
+    recall@k относительно точного поиска и задержку запроса (по записям одного пространства имен). Запуск из консоли:
+    python mcp_semantic_memory.py --evaluate-index
+    """
+    namespace = _namespace(params)
+    conn = app_globals["conn"] or open_db()
+    ids, vectors = load_vectors(conn, namespace=namespace)
+    if vectors is None:
+        return {"status": "empty"}
+    kinds = params.get("kinds") or list(INDEX_KINDS)
+    unknown = [kind for kind in kinds if kind not in INDEX_KINDS]
+    if unknown:
+        raise JsonRpcError(-32602, f"Неизвестные виды индекса: {unknown}. Допустимо: {list(INDEX_KINDS)}")
+    report = evaluate(vectors, ids, kinds, k=int(params.get("k", 10)), num_queries=int(params.get("num_queries", 200)))
+    if namespace in app_globals["indexes"]:
+        report["current_index"] = index_kind(app_globals["indexes"][namespace])
+    report["recommended_index"] = choose_kind(len(ids))
+    return report
+
 # --- Стандартная часть MCP ---
 METHODS = {
-    "remember": remember, "recall": recall, "create_entity": create_entity,
+    "remember": remember, "remember_batch": remember_batch, "recall": recall, "create_entity": create_entity,
     "link_entities": link_entities, "find_entity_by_label": find_entity_by_label,
-    "get_entity_details": get_entity_details,
-    "update_entity_label": update_entity_label
+    "get_entity_details": get_entity_details, "get_neighborhood": get_neighborhood,
+    "update_entity_label": update_entity_label,
+    "evaluate_index": evaluate_index,
+    "get_memory_stats": get_memory_stats,
+    "consolidate_memory": consolidate_memory
 }
 
 @app.route("/functions")
-def get_functions_route(): return jsonify(MEMORY_FUNCTIONS)
+def get_functions_route(): return functions_response(MEMORY_FUNCTIONS)
+
+@app.route("/ready")
+def ready_route():
+    # 200 - векторная память готова, 503 - еще загружается (методы графа уже доступны)
+    state = readiness()
+    return jsonify(state), (200 if state["ready"] else 503)
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    try:
-        req = request.get_json(force=True)
-        id_ = req.get("id")
-        method = req.get("method")
-        params = req.get("params", {})
-        if req.get("jsonrpc") != "2.0" or id_ is None or not method:
-            raise JsonRpcError(-32600, "Invalid JSON-RPC request format")
-        if method not in METHODS:
-            raise JsonRpcError(-32601, f"Method not found: {method}")
-        result = METHODS[method](params)
-        return make_success_response(id_, result)
-    except Exception as e:
-        code = e.code if isinstance(e, JsonRpcError) else -32603
-        msg = str(e.message) if isinstance(e, JsonRpcError) else str(e)
-        return make_error_response(req.get('id'), code, msg), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
 
 if __name__ == "__main__":
-    # Выполняем инициализацию сразу при старте, т.к. она теперь включает граф
-    # и другие важные компоненты, которые лучше подготовить заранее.
-    # Ленивая инициализация остается на случай сбоев.
-    ensure_memory_loaded() 
+    if "--evaluate-index" in sys.argv:
+        # Оценка видов индекса на текущей памяти без запуска сервера и загрузки модели
+        print(json.dumps(evaluate_index({}), ensure_ascii=False, indent=2))
+        sys.exit(0)
+    if "--benchmark-storage" in sys.argv:
+        # Сравнение хранения векторов (flat / int8 / PQ, с mmap и без): размер, загрузка, RSS, recall@k
+        ids, vectors = load_vectors(open_db())
+        report = benchmark_storage(vectors, ids) if vectors is not None else {"status": "empty"}
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        sys.exit(0)
+    # База и граф открываются сразу (быстро), модель и индекс грузятся в фоне:
+    # /functions и методы графа отвечают, не дожидаясь модели, а векторные методы ждут ее готовности.
+    ensure_db_loaded()
+    start_background_loading()
     port = int(os.getenv("MCP_SEMANTIC_MEMORY_PORT", 8007))
     print(f"[*] MCP_Semantic_Memory (граф+векторы) запускается на порту: {port} через Waitress.")
     serve(app, host="0.0.0.0", port=port)
\ No newline at end of file
@@ -6,6 +6,9 @@ import subprocess
 from flask import Flask, request, jsonify
 from waitress import serve
 import datetime
+
+from mcp_jsonrpc import handle_payload, functions_response
+
 app = Flask(__name__)
 
 # --- Безопасность: определяем "белый список" разрешенных команд ---
@@ -27,6 +30,7 @@ ALLOWED_COMMANDS = {
 SHELL_FUNCTIONS = [
     {
         "name": "execute_shell_command",
+        "invalidates": [], # Время от команд не зависит
         "description": "Выполняет одну из разрешенных команд в терминале. Аргументы можно передавать только для команд, которые их поддерживают.",
         "parameters": {
             "type": "object",
@@ -48,6 +52,7 @@ SHELL_FUNCTIONS = [
     # ИЗМЕНЕНО: Описание функции - теперь она получает время напрямую, а не через ОС
     {
         "name": "get_current_time",
+        "cache": {"ttl": 1}, # Только для повторов в пределах одного хода
         "description": "Возвращает текущую дату и время операционной системы. Используй эту функцию, когда пользователь спрашивает 'сколько сейчас время' или 'какая дата'.",
         "parameters": {"type": "object", "properties": {}} # Нет параметров
     }
@@ -57,8 +62,6 @@ SHELL_FUNCTIONS = [
 class JsonRpcError(Exception):
     def __init__(self, code, message): self.code, self.message = code, message
 
-def make_error_response(id_, code, message): return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-def make_success_response(id_, result): return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
 
 # --- Реализация метода --
 def execute_shell_command(params):
@@ -127,19 +130,14 @@ METHODS = {
 
 # --- Эндпоинты Flask (стандартные) ---
 @app.route("/functions")
-def get_functions_route(): return jsonify(SHELL_FUNCTIONS)
+def get_functions_route(): return functions_response(SHELL_FUNCTIONS)
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    try:
-        req = request.get_json(force=True)
-        # ... (валидация запроса, как в других MCP)
-        result = METHODS[req['method']](req.get('params', {}))
-        return make_success_response(req['id'], result)
-    except Exception as e:
-        code = e.code if isinstance(e, JsonRpcError) else -32603
-        msg = e.message if isinstance(e, JsonRpcError) else str(e)
-        return make_error_response(req.get('id'), code, msg), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
+
 
 if __name__ == "__main__":
     port = int(os.getenv("MCP_SHELL_PORT", 8003))
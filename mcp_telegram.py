@@ -9,6 +9,8 @@ from telethon import TelegramClient, errors
 from flask import Flask, request, jsonify
 from waitress import serve
 
+from mcp_jsonrpc import handle_payload, functions_response
+
 # --- Конфигурация ---
 load_dotenv()
 API_ID = int(os.getenv("TELEGRAM_API_ID"))
@@ -23,6 +25,7 @@ loop = asyncio.new_event_loop()
 TELEGRAM_FUNCTIONS = [
     {
         "name": "send_telegram_message",
+        "invalidates": ["read_last_messages", "list_telegram_dialogs"],
         "description": "Отправляет текстовое сообщение в диалог. КРАЙНЕ ВАЖНО: ID диалога (`dialog_id`) ДОЛЖЕН быть взят из РЕАЛЬНОГО результата вызова `list_telegram_dialogs`. НЕ ПРИДУМЫВАЙ ID.",
         "parameters": {
             "type": "object", "properties": {
@@ -33,11 +36,13 @@ TELEGRAM_FUNCTIONS = [
     },
     {
         "name": "list_telegram_dialogs",
+        "cache": {"ttl": 300},
         "description": "Возвращает СПИСОК реальных диалогов и их ID. Получив этот список, проанализируй его самостоятельно, чтобы найти нужный ID для других функций. Не используй другие инструменты для анализа этого списка.",
         "parameters": {"type": "object", "properties": {}}
     },
     {
         "name": "read_last_messages",
+        "cache": {"ttl": 1}, # Только для повторов в пределах одного хода: новые сообщения приходят от других людей
         "description": "Читает сообщения из диалога. КРАЙНЕ ВАЖНО: `dialog_id` ДОЛЖЕН быть взят из РЕАЛЬНОГО результата вызова `list_telegram_dialogs`.",
         "parameters": {
             "type": "object", "properties": {
@@ -49,6 +54,7 @@ TELEGRAM_FUNCTIONS = [
     
     {
         "name": "get_chat_participants",
+        "cache": {"ttl": 300},
         "description": "Возвращает список участников указанного группового чата или канала. Полезно, чтобы понять, кто состоит в чате.",
         "parameters": {
             "type": "object", "properties": {
@@ -157,33 +163,17 @@ app = Flask(__name__)
 class JsonRpcError(Exception):
     def __init__(self, code, message): self.code, self.message = code, message
 
-def make_error_response(id_, code, message): return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-def make_success_response(id_, result): return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
 
 METHODS = {func['name']: globals()[func['name']] for func in TELEGRAM_FUNCTIONS}
 
 @app.route("/functions")
-def get_functions_route(): return jsonify(TELEGRAM_FUNCTIONS)
+def get_functions_route(): return functions_response(TELEGRAM_FUNCTIONS)
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    try:
-        req = request.get_json(force=True)
-        id_ = req.get("id")
-        method = req.get("method")
-        params = req.get("params", {})
-
-        if req.get("jsonrpc") != "2.0" or id_ is None or not method:
-            raise JsonRpcError(-32600, "Invalid JSON-RPC request format")
-        if method not in METHODS:
-            raise JsonRpcError(-32601, f"Method not found: {method}")
-
-        result = METHODS[method](params)
-        return make_success_response(id_, result)
-    except Exception as e:
-        code = e.code if isinstance(e, JsonRpcError) else -32603
-        msg = str(e.message) if isinstance(e, JsonRpcError) else str(e)
-        return make_error_response(req.get('id'), code, msg), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
 
 # --- Логика запуска ---
 async def main_telethon_logic():
@@ -0,0 +1,170 @@
+# mcp_tool_cache.py
+"""
+Дисковый кэш результатов MCP-методов только для чтения.
+
+Сервер помечает кэшируемый метод в своей схеме /functions ключом "cache": {"ttl": секунды}.
+Вызов любого другого метода того же сервера считается записью и сбрасывает кэш этого сервера;
+метод может сузить сброс ключом "invalidates": [список методов] (пустой список - ничего не сбрасывать).
+Служебные ключи "cache" и "invalidates" убираются из описаний функций перед отправкой модели.
+
+Кэш хранится в SQLite (MCP_TOOL_CACHE_FILE), поэтому переживает перезапуск агента,
+и общий для всех агентов процесса. Отключается через AGENT_TOOL_CACHE=0.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+TOOL_CACHE_FILE = "mcp_tool_cache.db"
+
+# Ключи схемы, которые понимает только агент
+CACHE_SCHEMA_KEYS = ("cache", "invalidates")
+
+
+def llm_function(func: dict) -> dict:
+    """Описание функции для модели - без служебных ключей кэширования."""
+    return {key: value for key, value in func.items() if key not in CACHE_SCHEMA_KEYS}
+
+
+class CachePolicy:
+    """Правила кэширования методов одного сервера, собранные из его схемы."""
+
+    def __init__(self, functions: list):
+        # {метод: ttl в секундах}
+        self.ttls = {}
+        # {метод: список сбрасываемых методов или None - весь кэш сервера}
+        self.invalidates = {}
+        for func in functions:
+            ttl = (func.get("cache") or {}).get("ttl")
+            if ttl:
+                self.ttls[func["name"]] = float(ttl)
+            elif "invalidates" in func:
+                self.invalidates[func["name"]] = list(func["invalidates"])
+            else:
+                self.invalidates[func["name"]] = None
+
+    def ttl(self, method: str):
+        return self.ttls.get(method)
+
+    def invalidated_by(self, method: str):
+        """Что сбрасывает вызов метода: None - весь кэш сервера, [] - ничего (для кэшируемых методов)."""
+        if method in self.ttls:
+            return []
+        return self.invalidates.get(method)
+
+
+def _params_key(params) -> str:
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ToolResultCache:
+    def __init__(self, db_path: str = TOOL_CACHE_FILE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache ("
+            "server TEXT NOT NULL, method TEXT NOT NULL, params_key TEXT NOT NULL, "
+            "result TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (server, method, params_key))"
+        )
+        # Просроченные записи прошлых запусков больше не нужны
+        self._conn.execute("DELETE FROM tool_cache WHERE expires_at <= ?", (time.time(),))
+        self._conn.commit()
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def get(self, server: str, method: str, params):
+        """Возвращает (True, результат) при попадании или (False, None)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, expires_at FROM tool_cache WHERE server = ? AND method = ? AND params_key = ?",
+                (server, method, _params_key(params))
+            ).fetchone()
+            if row is None or row[1] <= time.time():
+                self._counters["misses"] += 1
+                return False, None
+            self._counters["hits"] += 1
+        return True, json.loads(row[0])
+
+    def put(self, server: str, method: str, params, result, ttl: float):
+        try:
+            raw = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tool_cache (server, method, params_key, result, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (server, method, _params_key(params), raw, time.time() + ttl)
+            )
+            self._conn.commit()
+            self._counters["stores"] += 1
+
+    def invalidate(self, server: str, methods=None):
+        """Сбрасывает записи сервера: все (methods=None) или только указанных методов."""
+        if methods is not None and not methods:
+            return
+        with self._lock:
+            if methods is None:
+                cursor = self._conn.execute("DELETE FROM tool_cache WHERE server = ?", (server,))
+            else:
+                placeholders = ", ".join("?" for _ in methods)
+                cursor = self._conn.execute(
+                    f"DELETE FROM tool_cache WHERE server = ? AND method IN ({placeholders})", (server, *methods)
+                )
+            self._conn.commit()
+            if cursor.rowcount:
+                self._counters["invalidations"] += cursor.rowcount
+                logging.info(f"Кэш MCP '{server}': сброшено записей - {cursor.rowcount}.")
+
+    def lookup(self, server: str, policy: CachePolicy, method: str, params):
+        """Как get, но только для кэшируемых по политике методов."""
+        if policy.ttl(method) is None:
+            return False, None
+        return self.get(server, method, params)
+
+    def record(self, server: str, policy: CachePolicy, method: str, params, response: dict):
+        """
+        Учитывает ответ JSON-RPC на вызов: успешный результат кэшируемого метода сохраняется,
+        вызов метода-записи сбрасывает кэш (даже если он завершился ошибкой - состояние могло измениться).
+        """
+        ttl = policy.ttl(method)
+        if ttl is None:
+            self.invalidate(server, policy.invalidated_by(method))
+        elif isinstance(response, dict) and "result" in response:
+            self.put(server, method, params, response["result"], ttl)
+
+    def stats(self) -> dict:
+        """Счетчики попаданий/промахов и число живых записей."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = self._conn.execute(
+                "SELECT COUNT(*) FROM tool_cache WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM tool_cache")
+            self._conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_tool_cache():
+    """Общий на процесс кэш результатов или None, если кэширование выключено (AGENT_TOOL_CACHE=0)."""
+    global _cache
+    if os.getenv("AGENT_TOOL_CACHE", "1") != "1":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ToolResultCache(os.getenv("MCP_TOOL_CACHE_FILE", TOOL_CACHE_FILE))
+        return _cache
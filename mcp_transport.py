@@ -0,0 +1,143 @@
+# mcp_transport.py
+"""
+Транспортный слой для обращений агента к MCP-серверам.
+
+На каждый MCP-сервер держится одна пуловая keep-alive сессия: соединения с localhost
+переиспользуются между вызовами, а не открываются заново на каждый JSON-RPC запрос.
+Таймауты подключения и чтения раздельные, идемпотентные методы повторяются с backoff.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Коды ответа, при которых имеет смысл повторить идемпотентный запрос
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class MCPTransport:
+    """Пуловая HTTP-сессия к одному MCP-серверу со счетчиками использования."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        # Настройки читаются при создании, чтобы учитывать .env, загруженный после импорта модуля
+        self.timeout = (
+            float(os.getenv("MCP_CONNECT_TIMEOUT", "3")),
+            float(os.getenv("MCP_READ_TIMEOUT", "120")),
+        )
+        self.max_retries = int(os.getenv("MCP_MAX_RETRIES", "2"))
+        self.backoff = float(os.getenv("MCP_RETRY_BACKOFF", "0.3"))
+
+        self.session = requests.Session()
+        # GET-запросы (например, /functions) повторяет сам urllib3, POST - только мы и только для идемпотентных методов
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=int(os.getenv("MCP_POOL_SIZE", "8")),
+            max_retries=Retry(
+                total=self.max_retries,
+                backoff_factor=self.backoff,
+                status_forcelist=RETRY_STATUS_CODES,
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._adapter = adapter
+
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "retries": 0, "timeouts": 0, "errors": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] += 1
+
+    def get(self, path: str, timeout=None, **kwargs) -> requests.Response:
+        """GET-запрос к серверу через общую сессию."""
+        self._count("requests")
+        try:
+            return self.session.get(f"{self.base_url}{path}", timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.Timeout:
+            self._count("timeouts")
+            raise
+        except requests.exceptions.RequestException:
+            self._count("errors")
+            raise
+
+    def post_json(self, path: str, payload, headers=None, idempotent: bool = False) -> requests.Response:
+        """
+        POST с JSON-телом. Запрос, который не дошел до сервера (таймаут подключения),
+        повторяется всегда; обрыв, таймаут чтения и 502/503/504 - только для идемпотентных методов.
+        """
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            self._count("requests")
+            try:
+                resp = self.session.post(url, json=payload, headers=headers, timeout=self.timeout)
+                if not (idempotent and resp.status_code in RETRY_STATUS_CODES and attempt < self.max_retries):
+                    return resp
+                logging.warning(f"MCP {self.base_url}: ответ {resp.status_code}, повтор запроса.")
+            except requests.exceptions.ConnectTimeout:
+                self._count("timeouts")
+                if attempt >= self.max_retries:
+                    raise
+            except requests.exceptions.ReadTimeout:
+                self._count("timeouts")
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            except requests.exceptions.ConnectionError:
+                self._count("errors")
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            attempt += 1
+            self._count("retries")
+            time.sleep(self.backoff * (2 ** (attempt - 1)))
+
+    def stats(self) -> dict:
+        """Счетчики запросов и переиспользования соединений пула."""
+        with self._lock:
+            stats = dict(self._counters)
+        new_connections = 0
+        pooled_requests = 0
+        # У urllib3-пула есть собственные счетчики созданных соединений и отправленных запросов
+        pools = self._adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            new_connections += pool.num_connections
+            pooled_requests += pool.num_requests
+        stats["new_connections"] = new_connections
+        stats["reused_connections"] = max(pooled_requests - new_connections, 0)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(base_url: str) -> MCPTransport:
+    """Возвращает общий транспорт для сервера (один пул на сервер на весь процесс)."""
+    key = base_url.rstrip("/")
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = MCPTransport(key)
+            _transports[key] = transport
+        return transport
+
+
+def get_all_stats() -> dict:
+    """Статистика по всем созданным транспортам: {base_url: stats}."""
+    with _transports_lock:
+        transports = list(_transports.items())
+    return {url: transport.stats() for url, transport in transports}
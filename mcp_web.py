@@ -11,6 +11,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from bs4 import BeautifulSoup
 
+from mcp_jsonrpc import handle_payload, functions_response
+
 # --- Глобальное состояние и инициализация ---
 app = Flask(__name__)
 browser = None
@@ -39,8 +41,6 @@ def start_browser():
 # --- Класс ошибки и хелперы ---
 class JsonRpcError(Exception):
     def __init__(self, code, message): self.code, self.message = code, message
-def make_error_response(id_, code, message): return jsonify({"jsonrpc": "2.0", "id": id_, "error": {"code": code, "message": message}})
-def make_success_response(id_, result): return jsonify({"jsonrpc": "2.0", "id": id_, "result": result})
 
 
 # --- ФИНАЛЬНЫЙ НАБОР ИНСТРУМЕНТОВ С ЧЕТКИМ РАЗДЕЛЕНИЕМ ---
@@ -187,18 +187,14 @@ WEB_FUNCTIONS = [
 METHODS = {func['name']: globals()[func['name']] for func in WEB_FUNCTIONS}
 
 @app.route("/functions")
-def get_functions_route(): return jsonify(WEB_FUNCTIONS)
+def get_functions_route(): return functions_response(WEB_FUNCTIONS)
 
 @app.route("/mcp", methods=["POST"])
 def mcp_entrypoint():
-    try:
-        req = request.get_json(force=True)
-        if req.get("method") not in METHODS: raise JsonRpcError(-32601, f"Метод не найден: {req.get('method')}")
-        result = METHODS[req['method']](req.get('params', {}))
-        return make_success_response(req.get('id'), result)
-    except Exception as e:
-        code = getattr(e, 'code', -32603); msg = getattr(e, 'message', str(e))
-        return make_error_response(req.get('id'), code, msg), 500
+    # Одиночный запрос или пакет (массив) запросов JSON-RPC 2.0
+    body, status = handle_payload(request.get_json(force=True, silent=True), METHODS, JsonRpcError)
+    return jsonify(body), status
+
 
 if __name__ == "__main__":
     port = int(os.getenv("MCP_WEB_PORT", 8002))
@@ -0,0 +1,448 @@
+# semantic_memory_index.py
+"""
+Векторные индексы FAISS для mcp_semantic_memory.
+
+Поддерживаются виды индекса (все - под IndexIDMap2, id = memory_chunks.id, метрика L2):
+  flat  - точный перебор (IndexFlatL2), по умолчанию для небольшой памяти;
+  sq8   - перебор по векторам, сжатым до int8 (в 4 раза меньше flat), почти без потери полноты;
+  pq    - перебор по кодам PQ (MEMORY_PQ_M байт на вектор), самый компактный, требует обучения;
+  hnsw  - граф HNSW, быстрый приблизительный поиск без обучения;
+  ivfpq - инвертированные списки со сжатием PQ, компактен и быстр, требует обучения.
+
+Режим задается MEMORY_INDEX_MODE: flat / hnsw / ivfpq или auto (по умолчанию) - flat,
+пока записей меньше MEMORY_INDEX_AUTO_THRESHOLD, затем MEMORY_INDEX_AUTO_KIND.
+При MEMORY_INDEX_MMAP=1 файл индекса открывается через mmap (IO_FLAG_MMAP): коды векторов
+не копируются в память процесса при загрузке, а подгружаются ОС по мере обращения.
+Здесь же - извлечение векторов из старого индекса для миграции, оценка полноты/задержки
+и поиск групп почти одинаковых записей для консолидации памяти.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import tempfile
+import subprocess
+
+import numpy as np
+import faiss
+
+INDEX_KINDS = ("flat", "sq8", "pq", "hnsw", "ivfpq")
+
+# PQ и IVF-PQ имеют смысл только при достаточном числе векторов для обучения кодовых книг PQ
+# (FAISS рекомендует не меньше 39 точек на каждый из 256 центроидов)
+PQ_MIN_VECTORS = 256 * 39
+# Диапазоны int8-квантователя оцениваются по обучающим векторам - на горстке записей они неточны
+SQ_MIN_VECTORS = 1000
+
+
+def index_settings() -> dict:
+    """Настройки индекса из окружения (читаются при каждом вызове, чтобы учитывать .env)."""
+    return {
+        "mode": os.getenv("MEMORY_INDEX_MODE", "auto").lower(),
+        "auto_threshold": int(os.getenv("MEMORY_INDEX_AUTO_THRESHOLD", "50000")),
+        "auto_kind": os.getenv("MEMORY_INDEX_AUTO_KIND", "hnsw").lower(),
+        "hnsw_m": int(os.getenv("MEMORY_HNSW_M", "32")),
+        "hnsw_ef_construction": int(os.getenv("MEMORY_HNSW_EF_CONSTRUCTION", "80")),
+        "hnsw_ef_search": int(os.getenv("MEMORY_HNSW_EF_SEARCH", "64")),
+        "ivf_nprobe": int(os.getenv("MEMORY_IVF_NPROBE", "16")),
+        "pq_m": int(os.getenv("MEMORY_PQ_M", "48")),
+        "mmap": os.getenv("MEMORY_INDEX_MMAP", "0") == "1",
+    }
+
+
+def choose_kind(count: int, settings: dict = None) -> str:
+    """Какой вид индекса нужен для памяти из count записей."""
+    settings = settings or index_settings()
+    mode = settings["mode"]
+    if mode == "auto":
+        mode = settings["auto_kind"] if count >= settings["auto_threshold"] else "flat"
+    if mode not in INDEX_KINDS:
+        raise ValueError(f"Неизвестный вид индекса: {mode}. Допустимо: {INDEX_KINDS} или auto.")
+    if mode in ("pq", "ivfpq") and count < PQ_MIN_VECTORS:
+        # Обучать нечего - до накопления данных работаем точным перебором (для pq - хотя бы int8)
+        mode = "sq8" if mode == "pq" else "flat"
+    if mode == "sq8" and count < SQ_MIN_VECTORS:
+        return "flat"
+    return mode
+
+
+def index_kind(index) -> str:
+    """Вид индекса по его внутренней структуре."""
+    if isinstance(index, MappedIndex):
+        index = index.base
+    inner = faiss.downcast_index(index.index) if hasattr(index, "index") else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return "sq8"
+    if isinstance(inner, faiss.IndexPQ):
+        return "pq"
+    return "flat"
+
+
+def _pq_subquantizers(dim: int, wanted: int) -> int:
+    """Наибольшее число подквантователей PQ, не больше wanted и делящее размерность."""
+    for m in range(min(wanted, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_index(kind: str, dim: int, vectors: np.ndarray, ids: np.ndarray, settings: dict = None):
+    """Создает индекс нужного вида и добавляет в него векторы (IVF-PQ предварительно обучается)."""
+    settings = settings or index_settings()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    ids = np.ascontiguousarray(ids, dtype="int64")
+    if kind == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, settings["hnsw_m"])
+        inner.hnsw.efConstruction = settings["hnsw_ef_construction"]
+    elif kind == "ivfpq":
+        count = len(vectors)
+        # Эвристика FAISS: ~4*sqrt(n) списков, но не меньше 39 векторов обучения на список
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        inner = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, _pq_subquantizers(dim, settings["pq_m"]), 8)
+        inner.train(vectors)
+    elif kind == "sq8":
+        inner = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+        inner.train(vectors)
+    elif kind == "pq":
+        inner = faiss.IndexPQ(dim, _pq_subquantizers(dim, settings["pq_m"]), 8)
+        inner.train(vectors)
+    else:
+        inner = faiss.IndexFlatL2(dim)
+    index = faiss.IndexIDMap2(inner)
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    configure_search(index, settings)
+    return index
+
+
+def configure_search(index, settings: dict = None):
+    """Параметры поиска (efSearch / nprobe) - они не сохраняются в файле индекса."""
+    settings = settings or index_settings()
+    if isinstance(index, MappedIndex):
+        index = index.base
+    inner = faiss.downcast_index(index.index) if hasattr(index, "index") else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = settings["hnsw_ef_search"]
+    elif isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = settings["ivf_nprobe"]
+
+
+def filter_params(index, selector):
+    """
+    Параметры поиска только среди id из selector или None, если вид индекса фильтр не поддерживает (pq).
+    Тип параметров должен совпадать с видом индекса: IVF отвергает общие SearchParameters,
+    а nprobe/efSearch иначе не берутся из настроек индекса.
+    """
+    inner = faiss.downcast_index(index.index) if hasattr(index, "index") else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    if isinstance(inner, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_filtered(index, queries, k: int, allowed_ids: np.ndarray):
+    """
+    Поиск k ближайших только среди allowed_ids - для любого вида индекса, в том числе MappedIndex.
+    Если индекс не принимает фильтр, соседи запрашиваются с запасом (вчетверо больше за шаг) и лишние отбрасываются.
+    """
+    allowed_ids = np.ascontiguousarray(allowed_ids, dtype="int64")
+    selector = faiss.IDSelectorBatch(allowed_ids)
+    base = index.base if isinstance(index, MappedIndex) else index
+    if filter_params(base, selector) is not None:
+        if isinstance(index, MappedIndex):
+            return index.search(queries, k, selector=selector)
+        return index.search(queries, k, params=filter_params(index, selector))
+
+    fetch = k
+    while True:
+        fetch = min(index.ntotal, fetch * 4)
+        distances, ids = index.search(queries, fetch)
+        allowed = np.isin(ids, allowed_ids)
+        if fetch >= index.ntotal or (allowed.sum(axis=1) >= k).all():
+            break
+    result_distances = np.full((len(queries), k), np.finfo("float32").max, dtype="float32")
+    result_ids = np.full((len(queries), k), -1, dtype="int64")
+    for row in range(len(queries)):
+        found = np.flatnonzero(allowed[row])[:k]
+        result_distances[row, :len(found)] = distances[row, found]
+        result_ids[row, :len(found)] = ids[row, found]
+    return result_distances, result_ids
+
+
+def read_index_file(path: str, mmap: bool = None):
+    """Открывает файл индекса; при mmap коды векторов остаются в файле и подгружаются по мере обращения."""
+    if mmap is None:
+        mmap = index_settings()["mmap"]
+    if not mmap:
+        return faiss.read_index(path)
+    # IO_FLAG_MMAP_IFC (FAISS >= 1.11) отображает в память коды flat/sq8/pq; в старых версиях есть только IO_FLAG_MMAP.
+    # Инвертированные списки IVF так не читаются (а с одним IO_FLAG_MMAP становятся OnDiskInvertedLists,
+    # которые нельзя сериализовать для materialize) - ivfpq загружается в память целиком
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+def write_index_file(index, path: str):
+    """
+    Пишет индекс во временный файл и атомарно подменяет им старый. Перезаписывать файл на месте нельзя:
+    он может быть отображен в память (mmap) текущим индексом.
+    """
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class MappedIndex:
+    """
+    Индекс, открытый через mmap, вместе с небольшим индексом в памяти для новых записей.
+    Отображенный индекс только для чтения (добавление в него аварийно завершает процесс),
+    поэтому новые векторы попадают в delta, а поиск объединяет результаты обоих.
+    materialize() собирает полный индекс для записи в файл, после чего его снова открывают через mmap.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.d = base.d
+        self.delta = faiss.IndexIDMap2(faiss.IndexFlatL2(base.d))
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.delta.ntotal
+
+    def add_with_ids(self, vectors, ids):
+        self.delta.add_with_ids(vectors, ids)
+
+    def search(self, queries, k: int, selector=None):
+        # Параметры фильтра строятся отдельно для базы и delta - виды их индексов различаются
+        params = lambda index: filter_params(index, selector) if selector is not None else None
+        if self.delta.ntotal == 0:
+            return self.base.search(queries, k, params=params(self.base))
+        distances, ids = self.delta.search(queries, k, params=params(self.delta))
+        if self.base.ntotal:
+            base_distances, base_ids = self.base.search(queries, k, params=params(self.base))
+            distances = np.hstack([base_distances, distances])
+            ids = np.hstack([base_ids, ids])
+        # Пустые позиции (-1) имеют расстояние float max и уходят в конец
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def last_id(self) -> int:
+        return int(faiss.vector_to_array(self.base.id_map).max()) if self.base.ntotal else 0
+
+    def materialize(self):
+        """Полная копия индекса в памяти: база из файла плюс новые записи."""
+        index = faiss.deserialize_index(faiss.serialize_index(self.base))
+        if self.delta.ntotal:
+            ids, vectors = extract_vectors(self.delta)
+            index.add_with_ids(vectors, ids)
+        configure_search(index)
+        return index
+
+
+def extract_vectors(index):
+    """
+    Извлекает (ids, векторы) из существующего индекса - для миграции старого semantic_memory.index.
+    Для flat и HNSW векторы точные, для IVF-PQ - восстановленные из кодов (приблизительные).
+    """
+    count = index.ntotal
+    dim = index.d
+    if count == 0:
+        return np.empty(0, dtype="int64"), np.empty((0, dim), dtype="float32")
+    ids = faiss.vector_to_array(index.id_map).astype("int64") if hasattr(index, "id_map") else np.arange(count, dtype="int64")
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()
+    vectors = inner.reconstruct_n(0, count)
+    return ids, np.asarray(vectors, dtype="float32")
+
+
+def evaluate(vectors: np.ndarray, ids: np.ndarray, kinds=INDEX_KINDS, k: int = 10, num_queries: int = 200, settings: dict = None) -> dict:
+    """
+    Сравнивает виды индекса на текущих данных: recall@k относительно точного поиска,
+    средняя и p95 задержка одного запроса, время построения, а также recall@k поиска с фильтром
+    по id (как recall с since/until/source на большой памяти) - среди каждой второй записи.
+    В качестве запросов берутся случайные сохраненные векторы.
+    """
+    settings = settings or index_settings()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    count, dim = vectors.shape
+    if count == 0:
+        return {"status": "empty"}
+    k = min(k, count)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(count, size=min(num_queries, count), replace=False)]
+
+    started = time.perf_counter()
+    exact = build_index("flat", dim, vectors, ids, settings)
+    exact_build_ms = (time.perf_counter() - started) * 1000
+    _, truth = exact.search(queries, k)
+    allowed_ids = np.ascontiguousarray(ids, dtype="int64")[::2]
+    _, filtered_truth = search_filtered(exact, queries, k, allowed_ids)
+
+    report = {"vectors": count, "queries": len(queries), "k": k, "indexes": {}}
+    for kind in kinds:
+        if kind in ("pq", "ivfpq") and count < PQ_MIN_VECTORS:
+            report["indexes"][kind] = {"status": "skipped", "reason": f"нужно не меньше {PQ_MIN_VECTORS} векторов"}
+            continue
+        if kind == "flat":
+            index, build_ms = exact, exact_build_ms
+        else:
+            started = time.perf_counter()
+            index = build_index(kind, dim, vectors, ids, settings)
+            build_ms = (time.perf_counter() - started) * 1000
+
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            _, found = index.search(query.reshape(1, -1), k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(set(found[0].tolist()) & set(expected.tolist()))
+        _, found = search_filtered(index, queries, k, allowed_ids)
+        filtered_hits = sum(len(set(row.tolist()) & set(expected[expected != -1].tolist())) for row, expected in zip(found, filtered_truth))
+        report["indexes"][kind] = {
+            "recall_at_k": round(hits / (len(queries) * k), 4),
+            "filtered_recall_at_k": round(filtered_hits / max(1, int((filtered_truth != -1).sum())), 4),
+            "latency_ms_mean": round(float(np.mean(latencies)), 3),
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+            "build_ms": round(build_ms, 1),
+            "bytes_per_vector": round(faiss.serialize_index(index).size / count, 1),
+        }
+    return report
+
+
+def _rss_bytes():
+    """Резидентная память процесса (psutil, если установлен, иначе /proc на Linux) или None."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def measure_load(path: str, mmap: bool, queries_path: str, k: int):
+    """
+    Выполняется в отдельном процессе benchmark_storage: загрузка индекса с mmap или без,
+    прирост RSS после загрузки и после поиска. Результат - одна строка JSON в stdout.
+    """
+    rss_start = _rss_bytes()
+    started = time.perf_counter()
+    index = read_index_file(path, mmap)
+    load_ms = (time.perf_counter() - started) * 1000
+    rss_loaded = _rss_bytes()
+    configure_search(index)
+    queries = np.load(queries_path)
+    started = time.perf_counter()
+    _, found = index.search(queries, k)
+    search_ms = (time.perf_counter() - started) * 1000
+    rss_searched = _rss_bytes()
+    mb = lambda value: round((value - rss_start) / 2 ** 20, 1) if rss_start is not None else None
+    print(json.dumps({
+        "load_ms": round(load_ms, 1),
+        "rss_load_mb": mb(rss_loaded),
+        "rss_after_search_mb": mb(rss_searched),
+        "latency_ms_mean": round(search_ms / len(queries), 3),
+        "found": found.tolist(),
+    }))
+
+
+def benchmark_storage(vectors: np.ndarray, ids: np.ndarray, kinds=("flat", "sq8", "pq"), k: int = 10,
+                      num_queries: int = 200, settings: dict = None) -> dict:
+    """
+    Сравнивает хранение векторов: размер файла индекса, время загрузки и прирост RSS процесса
+    (с mmap и без) и recall@k относительно точного flat. Каждая загрузка измеряется в чистом
+    дочернем процессе, чтобы замеры памяти не влияли друг на друга.
+    """
+    settings = settings or index_settings()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    count, dim = vectors.shape
+    if count == 0:
+        return {"status": "empty"}
+    k = min(k, count)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(count, size=min(num_queries, count), replace=False)]
+    _, truth = build_index("flat", dim, vectors, ids, settings).search(queries, k)
+
+    report = {"vectors": count, "queries": len(queries), "k": k, "indexes": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        queries_path = os.path.join(workdir, "queries.npy")
+        np.save(queries_path, queries)
+        for kind in kinds:
+            if choose_kind(count, dict(settings, mode=kind)) != kind:
+                report["indexes"][kind] = {"status": "skipped", "reason": "недостаточно векторов для обучения"}
+                continue
+            started = time.perf_counter()
+            index = build_index(kind, dim, vectors, ids, settings)
+            build_ms = (time.perf_counter() - started) * 1000
+            path = os.path.join(workdir, f"{kind}.index")
+            write_index_file(index, path)
+            del index
+            entry = {"build_ms": round(build_ms, 1), "file_mb": round(os.path.getsize(path) / 2 ** 20, 2)}
+            for mmap in (False, True):
+                result = subprocess.run(
+                    [sys.executable, "-c",
+                     f"import semantic_memory_index as s; s.measure_load({path!r}, {mmap}, {queries_path!r}, {k})"],
+                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+                )
+                if result.returncode != 0:
+                    entry["mmap" if mmap else "ram"] = {"status": "error", "message": result.stderr.strip()[-500:]}
+                    continue
+                measured = json.loads(result.stdout.strip().splitlines()[-1])
+                found = measured.pop("found")
+                hits = sum(len(set(row) & set(expected.tolist())) for row, expected in zip(found, truth))
+                measured["recall_at_k"] = round(hits / (len(queries) * k), 4)
+                entry["mmap" if mmap else "ram"] = measured
+            report["indexes"][kind] = entry
+    return report
+
+
+def find_duplicate_clusters(ids: np.ndarray, vectors: np.ndarray, threshold: float, batch_size: int = 1024) -> list:
+    """
+    Группы почти одинаковых записей: косинусная близость к представителю группы не ниже threshold.
+    Представитель - самая новая запись (наибольший id), к ней присоединяются еще не занятые соседи;
+    цепочек (A~B, B~C, но A не похож на C) не образуется. Возвращает [(id представителя, [id дубликатов])].
+    """
+    count = len(ids)
+    if count < 2:
+        return []
+    normalized = np.ascontiguousarray(vectors, dtype="float32").copy()
+    faiss.normalize_L2(normalized)
+    index = faiss.IndexFlatIP(normalized.shape[1])
+    index.add(normalized)
+
+    # Соседи каждой записи выше порога; range_search идет пачками, чтобы не держать в памяти матрицу N x N
+    neighbors = {}
+    for start in range(0, count, batch_size):
+        lims, _, found = index.range_search(normalized[start:start + batch_size], threshold)
+        for offset in range(len(lims) - 1):
+            row = start + offset
+            close = [int(j) for j in found[lims[offset]:lims[offset + 1]] if j != row]
+            if close:
+                neighbors[row] = close
+
+    clusters, assigned = [], set()
+    for row in sorted(neighbors, key=lambda position: ids[position], reverse=True):
+        if row in assigned:
+            continue
+        duplicates = [j for j in neighbors[row] if j not in assigned and j != row]
+        if not duplicates:
+            continue
+        assigned.add(row)
+        assigned.update(duplicates)
+        clusters.append((int(ids[row]), sorted(int(ids[j]) for j in duplicates)))
+    return clusters
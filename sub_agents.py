@@ -0,0 +1,257 @@
+# sub_agents.py
+"""
+Суб-агенты и делегирование задач.
+
+SUB_AGENT_REGISTRY описывает специализированных агентов: свой системный промпт и свой
+фильтр MCP. Оркестратор получает локальный инструмент delegate_tasks, которым отдает
+одну или несколько независимых подзадач; подзадачи выполняются одновременно,
+каждая - со своим бюджетом токенов и времени. Экземпляры суб-агентов создаются
+по мере надобности и затем переиспользуются; один экземпляр не выполняет
+две подзадачи одновременно.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Чтобы добавить суб-агента, достаточно добавить запись в этот словарь.
+# Необязательные "max_tokens" и "timeout" переопределяют бюджет по умолчанию
+# (AGENT_SUBAGENT_MAX_TOKENS, AGENT_SUBAGENT_TIMEOUT). Необязательный "memory_namespace" -
+# собственное пространство имен семантической памяти; без него суб-агент работает в пространстве сессии владельца.
+SUB_AGENT_REGISTRY = {
+    "researcher": {
+        "prompt": "prompts/researcher_prompt.txt",
+        "mcp_filter": ["web"],
+        "description": "Исследователь: ищет и читает информацию в интернете через браузер, возвращает краткую сводку с источниками.",
+    },
+    "file_worker": {
+        "prompt": "prompts/file_worker_prompt.txt",
+        "mcp_filter": ["files", "shell"],
+        "description": "Работа с файлами в рабочей папке и безопасными командами терминала: найти, прочитать, создать или изменить файлы.",
+    },
+    "memory_keeper": {
+        "prompt": "prompts/memory_keeper_prompt.txt",
+        "mcp_filter": ["semantic_memory"],
+        "description": "Долговременная память: сохранить факты, вспомнить похожие, работать с графом знаний (сущности и связи).",
+        "max_tokens": 10000,
+    },
+}
+
+
+class RunBudget:
+    """
+    Бюджет одного запуска агента: токены (оценка по context_budget) и время.
+    call_ai проверяет его перед каждой итерацией и останавливается, если бюджет исчерпан.
+    """
+
+    def __init__(self, max_tokens: int = None, timeout: float = None):
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.tokens_used = 0
+        self.cancelled = None
+
+    def cancel(self, reason: str):
+        """Останавливает запуск извне: агент завершится на ближайшей проверке бюджета."""
+        self.cancelled = reason
+
+    def add_tokens(self, tokens: int):
+        self.tokens_used += tokens
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining_time(self):
+        if self.timeout is None:
+            return None
+        return max(self.timeout - self.elapsed(), 0.0)
+
+    def exceeded(self):
+        """Причина остановки или None, если бюджет еще есть."""
+        if self.cancelled is not None:
+            return self.cancelled
+        if self.max_tokens is not None and self.tokens_used >= self.max_tokens:
+            return f"исчерпан бюджет токенов ({self.tokens_used} из {self.max_tokens})"
+        if self.timeout is not None and self.elapsed() >= self.timeout:
+            return f"истекло время ({self.timeout:.0f} с)"
+        return None
+
+
+def delegate_tasks_schema(agent_names: list) -> dict:
+    """Описание локального инструмента delegate_tasks для доступных оркестратору суб-агентов."""
+    agents_help = "\n".join(f"- {name}: {SUB_AGENT_REGISTRY[name]['description']}" for name in agent_names)
+    return {
+        "name": "delegate_tasks",
+        "description": (
+            "Поручает одну или несколько НЕЗАВИСИМЫХ подзадач специализированным суб-агентам. "
+            "Все подзадачи одного вызова выполняются одновременно, результат - список ответов в том же порядке. "
+            "Формулируй каждую подзадачу полностью: суб-агент не видит историю чата.\n"
+            f"Доступные суб-агенты:\n{agents_help}"
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "tasks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "agent": {"type": "string", "enum": list(agent_names), "description": "Имя суб-агента."},
+                            "task": {"type": "string", "description": "Самодостаточное описание подзадачи."}
+                        },
+                        "required": ["agent", "task"]
+                    }
+                }
+            },
+            "required": ["tasks"]
+        }
+    }
+
+
+def available_sub_agents(active_mcp_keys) -> list:
+    """Суб-агенты, все MCP которых сейчас запущены."""
+    active = set(active_mcp_keys)
+    return [name for name, spec in SUB_AGENT_REGISTRY.items() if set(spec["mcp_filter"]) <= active]
+
+
+class SubAgentPool:
+    """
+    Экземпляры суб-агентов и запуск подзадач с бюджетами. Подзадача получает свободный экземпляр
+    (или новый, если все заняты) и возвращает его по завершении, поэтому две подзадачи одного
+    суб-агента не делят историю и состояние одного экземпляра.
+    :param factory: Функция (имя, описание из SUB_AGENT_REGISTRY) -> новый экземпляр агента.
+    :param agent_names: Суб-агенты, разрешенные владельцу пула.
+    """
+
+    def __init__(self, factory, agent_names: list):
+        self.factory = factory
+        self.agent_names = list(agent_names)
+        # {имя: все созданные экземпляры} и {имя: свободные экземпляры}
+        self._agents = {}
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.default_max_tokens = int(os.getenv("AGENT_SUBAGENT_MAX_TOKENS", "20000"))
+        self.default_timeout = float(os.getenv("AGENT_SUBAGENT_TIMEOUT", "120"))
+        # Потоки только для синхронных агентов; асинхронные выполняются в цикле событий
+        self._executor = None
+        self._max_workers = int(os.getenv("AGENT_MAX_SUBAGENTS", "4"))
+
+    def acquire(self, name: str):
+        """Свободный экземпляр суб-агента: простаивающий или новый, если все заняты."""
+        with self._lock:
+            idle = self._idle.setdefault(name, [])
+            if idle:
+                return idle.pop()
+            logging.info(f"Создается суб-агент '{name}' (экземпляр {len(self._agents.get(name, [])) + 1}).")
+            agent = self.factory(name, SUB_AGENT_REGISTRY[name])
+            self._agents.setdefault(name, []).append(agent)
+            return agent
+
+    def release(self, name: str, agent):
+        with self._lock:
+            self._idle.setdefault(name, []).append(agent)
+
+    def agents(self) -> list:
+        with self._lock:
+            return [agent for instances in self._agents.values() for agent in instances]
+
+    @staticmethod
+    def namespace_for(name: str, owner_namespace: str = None):
+        """Пространство памяти подзадачи: собственное у суб-агента с "memory_namespace" (None - его по умолчанию), иначе владельца."""
+        return None if "memory_namespace" in SUB_AGENT_REGISTRY[name] else owner_namespace
+
+    def budget_for(self, name: str) -> RunBudget:
+        spec = SUB_AGENT_REGISTRY[name]
+        return RunBudget(spec.get("max_tokens", self.default_max_tokens), spec.get("timeout", self.default_timeout))
+
+    def _validate(self, tasks) -> list:
+        """Проверяет аргументы delegate_tasks. Возвращает список (индекс, имя, задача) и заготовки ответов."""
+        results, runnable = [], []
+        for index, item in enumerate(tasks or []):
+            name = item.get("agent") if isinstance(item, dict) else None
+            task = item.get("task") if isinstance(item, dict) else None
+            if name not in self.agent_names:
+                results.append({"agent": name, "status": "error", "result": f"Суб-агент '{name}' недоступен. Доступны: {self.agent_names}"})
+            elif not task:
+                results.append({"agent": name, "status": "error", "result": "Не указана подзадача."})
+            else:
+                results.append({"agent": name, "task": task})
+                runnable.append((index, name, task))
+        return runnable, results
+
+    @staticmethod
+    def _finish(entry: dict, budget: RunBudget, status: str, result):
+        entry.update({
+            "status": status,
+            "result": result,
+            "tokens": budget.tokens_used,
+            "elapsed_ms": round(budget.elapsed() * 1000),
+        })
+
+    def run(self, tasks: list, memory_namespace: str = None) -> list:
+        """
+        Выполняет подзадачи синхронных суб-агентов одновременно (в отдельных потоках).
+        :param memory_namespace: Пространство памяти сессии владельца (см. namespace_for).
+        """
+        runnable, results = self._validate(tasks)
+        if not runnable:
+            return results
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="sub-agent")
+
+        started = time.perf_counter()
+        jobs = []
+        for index, name, task in runnable:
+            budget = self.budget_for(name)
+            agent = self.acquire(name)
+            future = self._executor.submit(agent.call_ai, [{"role": "user", "content": task}], run_budget=budget,
+                                           memory_namespace=self.namespace_for(name, memory_namespace))
+            # Экземпляр освобождается, только когда его запуск действительно закончился (в том числе опоздавший)
+            future.add_done_callback(lambda _, name=name, agent=agent: self.release(name, agent))
+            jobs.append((index, budget, future))
+
+        # Ждем не дольше самого длинного бюджета времени
+        wait([future for _, _, future in jobs], timeout=max(budget.timeout for _, budget, _ in jobs))
+        for index, budget, future in jobs:
+            if not future.done():
+                # Поток нельзя прервать: агент остановится на ближайшей проверке бюджета и не начнет новых вызовов
+                budget.cancel("оркестратор перестал ждать ответа")
+                self._finish(results[index], budget, "timeout", f"Суб-агент не уложился в {budget.timeout:.0f} с.")
+            elif future.exception() is not None:
+                self._finish(results[index], budget, "error", str(future.exception()))
+            else:
+                self._finish(results[index], budget, "budget" if budget.exceeded() else "ok", future.result())
+        logging.info(f"Делегирование: {len(jobs)} подзадач выполнено за {(time.perf_counter() - started) * 1000:.0f} мс.")
+        return results
+
+    async def arun(self, tasks: list, on_action=None, memory_namespace: str = None) -> list:
+        """Выполняет подзадачи асинхронных суб-агентов одновременно в текущем цикле событий."""
+        runnable, results = self._validate(tasks)
+        if not runnable:
+            return results
+
+        async def run_one(index, name, task):
+            budget = self.budget_for(name)
+            agent = self.acquire(name)
+            forward = (lambda text: on_action(f"[{name}] {text}") if text else None) if on_action else None
+            try:
+                reply = await asyncio.wait_for(
+                    agent.call_ai([{"role": "user", "content": task}], on_action=forward, run_budget=budget,
+                                  memory_namespace=self.namespace_for(name, memory_namespace)),
+                    timeout=budget.timeout
+                )
+                self._finish(results[index], budget, "budget" if budget.exceeded() else "ok", reply)
+            except asyncio.TimeoutError:
+                self._finish(results[index], budget, "timeout", f"Суб-агент не уложился в {budget.timeout:.0f} с.")
+            except Exception as e:
+                self._finish(results[index], budget, "error", str(e))
+            finally:
+                self.release(name, agent)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_one(index, name, task) for index, name, task in runnable))
+        logging.info(f"Делегирование: {len(runnable)} подзадач выполнено за {(time.perf_counter() - started) * 1000:.0f} мс.")
+        return results